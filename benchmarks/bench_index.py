@@ -0,0 +1,103 @@
+"""Benchmark finding outputs through the GeoParquet index against listing
+
+--tiles records of a tile grid are added to an index in --parts parts, as
+shards and batches of the retiler would, and merged. The same tiles are
+written as empty files named like the retiler's outputs. Finding the tiles
+of one date in a small area is timed by querying the index, and by
+listing the directory and parsing the names, which still leaves the
+footprints to look up. Results are printed as JSON, e.g.
+
+    python benchmarks/bench_index.py --tiles 200000
+"""
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+
+from bench_retiler import REPO, git_commit
+
+sys.path.insert(0, str(REPO))
+
+DATES = ["2021-06", "2021-12"]
+
+
+def make_records(n_tiles, res, tile_size):
+    """Records and footprints of n_tiles tiles per date on a square grid"""
+    from maputil.tile_grid import tile_grid_bounds
+    from shapely import box
+
+    side = tile_size * res * int(np.ceil(np.sqrt(n_tiles)))
+    grid = tile_grid_bounds((30.0, -5.0, 30.0 + side, -5.0 + side),
+                            tile_size, res)
+    grid = {k: v[:n_tiles] for k, v in grid.items()}
+    geoms = box(grid["minx"], grid["miny"], grid["maxx"], grid["maxy"])
+    records = [{"tile": int(t), "date": d,
+                "path": f"tiles/tile{t}_{d}_buf179_cog.tif", "bytes": 1}
+               for d in DATES for t in grid["tile"]]
+    return records, list(geoms) * len(DATES), grid
+
+
+@click.command()
+@click.option("--tiles", "n_tiles", default=100000, help="Tiles per date")
+@click.option("--parts", default=20, help="Index parts before merging")
+@click.option("--queries", default=20, help="Queries to time")
+def main(n_tiles, parts, queries):
+    from maputil.output_index import append_index, merge_index, query_index
+
+    res, tile_size = 0.005 / 200, 200
+    records, geoms, grid = make_records(n_tiles, res, tile_size)
+    rng = np.random.default_rng(0)
+    span = 20 * tile_size * res
+    lo = np.array([grid["minx"].min(), grid["miny"].min()])
+    hi = np.array([grid["maxx"].max(), grid["maxy"].max()]) - span
+    boxes = [(x, y, x + span, y + span)
+             for x, y in rng.uniform(lo, hi, (queries, 2))]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        index_dir = str(root / "index")
+        t0 = time.perf_counter()
+        step = int(np.ceil(len(records) / parts))
+        for k in range(0, len(records), step):
+            append_index(records[k:k + step], geoms[k:k + step], "EPSG:4326",
+                         index_dir, "tiles")
+        append_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        merge_index(index_dir)
+        merge_s = time.perf_counter() - t0
+        index_mb = os.path.getsize(root / "index" / "tiles.parquet") / 2 ** 20
+
+        t0 = time.perf_counter()
+        hits = [len(query_index(index_dir, bbox=b, dates=[DATES[0]]))
+                for b in boxes]
+        query_s = (time.perf_counter() - t0) / queries
+
+        tile_dir = root / "tiles"
+        tile_dir.mkdir()
+        for r in records:
+            (root / r["path"]).touch()
+        pattern = re.compile(r"tile(\d+)_(.+)_buf179_cog\.tif$")
+        t0 = time.perf_counter()
+        for _ in range(queries):
+            found = [m.groups() for m in
+                     (pattern.match(e.name) for e in os.scandir(tile_dir))
+                     if m and m.group(2) == DATES[0]]
+        list_s = (time.perf_counter() - t0) / queries
+
+    print(json.dumps({
+        "benchmark": "index", "commit": git_commit(), "timestamp": time.time(),
+        "tiles": n_tiles, "dates": len(DATES), "parts": parts,
+        "append_s": append_s, "merge_s": merge_s, "index_mb": index_mb,
+        "query_s": query_s, "mean_hits": float(np.mean(hits)),
+        "list_parse_s": list_s, "listed": len(found),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
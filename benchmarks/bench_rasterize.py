@@ -0,0 +1,168 @@
+"""Benchmark label rasterization on synthetic labeller shapefiles
+
+For every combination of polygon count and vertex count, one shapefile of
+random star-shaped fields is written per labeller site, with a catalog and a
+grid of chips covering the sites. rasterize_grids is then timed in binary
+and three_class mode, end to end and per stage, writing to a local
+directory and to a moto-backed S3 bucket. Results are printed as JSON, e.g.
+
+    python benchmarks/bench_rasterize.py --polygons 50 --polygons 500 \
+        --vertices 8 --vertices 64 > rasterize.json
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO))
+
+DIAM = 0.0025
+RESOLUTION = 0.000025
+BUCKET = "maputil-bench"
+
+
+def star_polygon(rng, cx, cy, radius, n_vertices):
+    """A random star-shaped polygon with n_vertices around (cx, cy)"""
+    from shapely.geometry import Polygon
+
+    angles = np.sort(rng.uniform(0, 2 * np.pi, n_vertices))
+    radii = radius * rng.uniform(0.5, 1.0, n_vertices)
+    return Polygon(zip(cx + radii * np.cos(angles),
+                       cy + radii * np.sin(angles)))
+
+
+def make_inputs(root, n_sites, chips_per_side, n_polygons, n_vertices,
+                seed=0):
+    """Write shapefiles, a catalog and a grid CSV, returning their paths"""
+    import geopandas as gpd
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    side = chips_per_side * DIAM
+    catalog, grids = [], []
+    for s in range(n_sites):
+        name = f"site{s}"
+        x0, y0 = 30.0 + s * side * 2, -5.0
+        polys = [
+            star_polygon(rng, rng.uniform(x0, x0 + side),
+                         rng.uniform(y0, y0 + side),
+                         rng.uniform(0.2, 1.0) * DIAM, n_vertices)
+            for _ in range(n_polygons)
+        ]
+        shp_path = root / "shapefiles" / f"{name}.shp"
+        shp_path.parent.mkdir(parents=True, exist_ok=True)
+        gpd.GeoDataFrame(geometry=polys, crs="EPSG:4326").to_file(shp_path)
+        catalog.append({"name": name, "dir_shp": str(shp_path)})
+        for c in range(chips_per_side):
+            for r in range(chips_per_side):
+                grids.append({
+                    "name": name,
+                    "name_col_row": f"{name}_{c}_{r}",
+                    "x": x0 + (c + 0.5) * DIAM,
+                    "y": y0 + (r + 0.5) * DIAM,
+                })
+    pd.DataFrame(catalog).to_csv(root / "catalog.csv", index=False)
+    pd.DataFrame(grids).to_csv(root / "grids.csv", index=False)
+    return root / "catalog.csv", root / "grids.csv", len(grids)
+
+
+def run_mode(root, mode, sink):
+    """Rasterize all grids once and return wall time and stage times"""
+    from maputil import rasterizer
+    from maputil.metrics import Metrics, summarize_metrics
+
+    # start every run with a cold shapefile cache
+    rasterizer._read_labels.cache_clear()
+    if sink == "s3":
+        dir_out = f"s3://{BUCKET}/{mode}/"
+    else:
+        dir_out = str(root / f"out_{mode}")
+        os.makedirs(dir_out, exist_ok=True)
+    params = {
+        "raster_mode": mode,
+        "dir_grids": str(root / "grids.csv"),
+        "dir_catalog": str(root / "catalog.csv"),
+        "col_shapefile": "dir_shp",
+        "dir_out": dir_out,
+        "resolution": RESOLUTION,
+        "diam": DIAM,
+        "crs_epsg": 4326,
+    }
+    metrics = Metrics(str(root / f"metrics_{mode}_{sink}.jsonl"))
+    t0 = time.perf_counter()
+    rasterizer.rasterize_grids(params, run_local=False, metrics=metrics)
+    wall = time.perf_counter() - t0
+    summary = summarize_metrics(metrics.path, metrics.run_id)
+    return wall, {k: v["total_s"] for k, v in summary["stages"].items()}, \
+        summary["counters"].get("chip_bytes", 0)
+
+
+def run_s3(root, mode):
+    """run_mode against a moto S3 bucket"""
+    import boto3
+    try:
+        from moto import mock_aws
+    except ImportError:  # moto < 5
+        from moto import mock_s3 as mock_aws
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket=BUCKET)
+        return run_mode(root, mode, "s3")
+
+
+def git_commit():
+    p = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO,
+                       capture_output=True, text=True)
+    return p.stdout.strip() or None
+
+
+@click.command()
+@click.option("--sites", default=2, help="Labeller shapefiles to generate")
+@click.option("--chips", default=8, help="Chips per side of each site")
+@click.option("--polygons", multiple=True, type=int, default=[50, 500],
+              help="Polygons per shapefile, repeatable")
+@click.option("--vertices", multiple=True, type=int, default=[8, 64],
+              help="Vertices per polygon, repeatable")
+@click.option("--mode", "modes", multiple=True,
+              type=click.Choice(["binary", "three_class"]),
+              default=["binary", "three_class"])
+@click.option("--sink", "sinks", multiple=True,
+              type=click.Choice(["local", "s3"]), default=["local", "s3"])
+def main(sites, chips, polygons, vertices, modes, sinks):
+    results = []
+    for n_polygons in polygons:
+        for n_vertices in vertices:
+            with tempfile.TemporaryDirectory() as tmp:
+                root = Path(tmp)
+                _, _, n_chips = make_inputs(root, sites, chips, n_polygons,
+                                            n_vertices)
+                for mode in modes:
+                    for sink in sinks:
+                        if sink == "s3":
+                            wall, stages, nbytes = run_s3(root, mode)
+                        else:
+                            wall, stages, nbytes = run_mode(root, mode, sink)
+                        results.append({
+                            "polygons": n_polygons, "vertices": n_vertices,
+                            "mode": mode, "sink": sink, "chips": n_chips,
+                            "wall_s": wall, "chips_per_s": n_chips / wall,
+                            "stages_s": stages, "bytes_written": nbytes,
+                        })
+
+    print(json.dumps({"benchmark": "rasterize", "commit": git_commit(),
+                      "timestamp": time.time(), "results": results},
+                     indent=2))
+
+
+if __name__ == "__main__":
+    main()
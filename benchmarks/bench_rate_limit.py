@@ -0,0 +1,181 @@
+"""Benchmark quad downloads against a mock API that throttles
+
+A local HTTP server stands in for Planet: it serves quads of random bytes,
+accepts requests at a quota of --quota per second with at most
+--max-in-flight at once, and answers requests over the quota with 429 and
+a Retry-After. A share of the others fail with 503. Quads are downloaded
+with download_tiles at several client rates, and the throughput, the
+throttled responses and whether every quad arrived intact are printed as
+JSON, e.g.
+
+    python benchmarks/bench_rate_limit.py --quads 200 --quota 20
+"""
+import hashlib
+import json
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import click
+import numpy as np
+
+from bench_retiler import REPO, git_commit
+
+sys.path.insert(0, str(REPO))
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    """Serves /quads/<id> under a quota like a rate limited API"""
+
+    quota = 20.0
+    max_in_flight = 8
+    error_rate = 0.02
+    retry_after = 1
+    delay = 0.05
+    payloads = {}
+    lock = threading.Lock()
+    state = {}
+
+    @classmethod
+    def reset(cls):
+        cls.state = {"tokens": cls.quota, "refilled": time.monotonic(),
+                     "in_flight": 0, "served": 0, "throttled": 0,
+                     "errors": 0}
+        cls.rng = np.random.default_rng(0)
+
+    def admit(self):
+        s = self.state
+        with self.lock:
+            now = time.monotonic()
+            s["tokens"] = min(s["tokens"] + (now - s["refilled"]) *
+                              self.quota, self.quota)
+            s["refilled"] = now
+            if s["tokens"] < 1 or s["in_flight"] >= self.max_in_flight:
+                s["throttled"] += 1
+                return 429
+            s["tokens"] -= 1
+            if self.rng.random() < self.error_rate:
+                s["errors"] += 1
+                return 503
+            s["in_flight"] += 1
+            return 200
+
+    def do_GET(self):
+        quad_id = self.path.rsplit("/", 1)[-1]
+        if quad_id not in self.payloads:
+            self.send_error(404)
+            return
+        status = self.admit()
+        if status != 200:
+            self.send_response(status)
+            if status == 429:
+                self.send_header("Retry-After", str(self.retry_after))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        try:
+            # time to first byte of a busy API
+            time.sleep(self.delay)
+            body = self.payloads[quad_id]
+            self.send_response(200)
+            self.send_header("Content-Type", "image/tiff")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with self.lock:
+                self.state["in_flight"] -= 1
+                self.state["served"] += 1
+
+    def log_message(self, *args):
+        pass
+
+
+def download(root, name, url_pt, quads, rate, threads):
+    """Download every quad into root/name, returning the wall time"""
+    from maputil.planet_downloader import PlanetDownloader
+    from maputil.metrics import Metrics
+
+    quad_dir = root / name
+    quad_dir.mkdir()
+    downloader = PlanetDownloader(
+        metrics=Metrics(), rate_limit={"rate": rate,
+                                       "max_concurrency": threads}
+    )
+    t0 = time.perf_counter()
+    downloader.download_tiles(
+        None, str(quad_dir), "<quad_dir>/<qname>.tif", quads_gdf=quads,
+        download_url=url_pt, download_threads=threads
+    )
+    return time.perf_counter() - t0, downloader.limiter.concurrency
+
+
+def intact(quad_dir, quads):
+    for quad_id in quads["tile"]:
+        path = quad_dir / f"{quad_id}.tif"
+        if not path.is_file() or hashlib.md5(path.read_bytes()).digest() \
+                != hashlib.md5(ThrottlingHandler.payloads[quad_id]).digest():
+            return False
+    return not list(quad_dir.glob("*.part"))
+
+
+@click.command()
+@click.option("--quads", "n_quads", default=200, help="Quads to download")
+@click.option("--quad-kb", default=256, help="Size of each quad in KB")
+@click.option("--quota", default=20.0, help="Requests per second the "
+              "server accepts")
+@click.option("--max-in-flight", default=8, help="Requests the server "
+              "serves at once")
+@click.option("--error-rate", default=0.02, help="Share of requests "
+              "failing with 503")
+@click.option("--threads", default=16, help="Download threads")
+@click.option("--rate", "rates", multiple=True, type=float,
+              default=[10.0, 18.0, 40.0],
+              help="Client rates, below, near and above the quota")
+def main(n_quads, quad_kb, quota, max_in_flight, error_rate, threads, rates):
+    import pandas as pd
+
+    rng = np.random.default_rng(0)
+    ThrottlingHandler.payloads = {
+        f"q{i}": rng.bytes(quad_kb * 1024) for i in range(n_quads)
+    }
+    ThrottlingHandler.quota = quota
+    ThrottlingHandler.max_in_flight = max_in_flight
+    ThrottlingHandler.error_rate = error_rate
+    quads = pd.DataFrame({"tile": list(ThrottlingHandler.payloads),
+                          "file": list(ThrottlingHandler.payloads)})
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url_pt = f"http://127.0.0.1:{server.server_port}/quads/<id>"
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        for rate in rates:
+            ThrottlingHandler.reset()
+            name = f"rate_{rate:g}"
+            wall_s, concurrency = download(root, name, url_pt, quads, rate,
+                                           threads)
+            s = ThrottlingHandler.state
+            results.append({
+                "rate": rate, "quota": quota, "threads": threads,
+                "wall_s": wall_s, "quads_per_s": n_quads / wall_s,
+                "quota_used": n_quads / wall_s / quota,
+                "throttled": s["throttled"], "server_errors": s["errors"],
+                "final_concurrency": concurrency,
+                "intact": intact(root / name, quads),
+            })
+    server.shutdown()
+
+    print(json.dumps({"benchmark": "rate_limit", "commit": git_commit(),
+                      "quads": n_quads, "quad_kb": quad_kb,
+                      "timestamp": time.time(), "results": results},
+                     indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Benchmark quad layouts written by ingest.relayout_quad
+
+The synthetic quads of bench_retiler, written as plain striped GeoTIFFs,
+are rewritten with each layout. For each layout the ingest time, the size
+on disk, the time of random windowed reads the size of a tile's footprint
+and the retile wall time are measured, and the pixels are checked against
+the original. Results are printed as JSON, e.g.
+
+    python benchmarks/bench_relayout.py --layout zstd_512 --layout lerc_512
+"""
+import json
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+
+from bench_retiler import (DATE, QUAD_RES, REPO, TILE_RES, TILE_SIZE,
+                           git_commit, make_quads, make_tiles)
+
+sys.path.insert(0, str(REPO))
+
+LAYOUTS = {
+    "original": None,
+    "deflate_256": {"block_size": 256, "compress": "DEFLATE",
+                    "overviews": ()},
+    "zstd_256": {"block_size": 256, "compress": "ZSTD", "overviews": ()},
+    "zstd_512": {"block_size": 512, "compress": "ZSTD", "overviews": ()},
+    "zstd_512_ovr": {"block_size": 512, "compress": "ZSTD",
+                     "overviews": (2, 4, 8, 16)},
+    "lerc_512": {"block_size": 512, "compress": "LERC_ZSTD",
+                 "overviews": ()},
+}
+
+
+def read_windows(quad_dir, n_reads, seed=0):
+    """Time reads of random windows the size of a tile's footprint"""
+    import rasterio
+    from rasterio.windows import Window
+
+    rng = np.random.default_rng(seed)
+    side = int(TILE_SIZE * TILE_RES * 111320 / QUAD_RES)
+    paths = sorted(quad_dir.glob("*.tif"))
+    t0 = time.perf_counter()
+    for _ in range(n_reads):
+        with rasterio.open(paths[rng.integers(len(paths))]) as src:
+            side_ = min(side, src.width)
+            col = int(rng.integers(0, src.width - side_ + 1))
+            row = int(rng.integers(0, src.height - side_ + 1))
+            src.read(window=Window(col, row, side_, side_))
+    return (time.perf_counter() - t0) / n_reads
+
+
+def same_pixels(dir_a, dir_b):
+    import rasterio
+
+    for path in dir_a.glob("*.tif"):
+        with rasterio.open(path) as a, rasterio.open(dir_b / path.name) as b:
+            if not np.array_equal(a.read(), b.read()):
+                return False
+    return True
+
+
+def retile(root, name, quads, tiles):
+    """Retile from root/name and return the wall time"""
+    from maputil.planet_downloader import PlanetDownloader
+
+    temp_dir = root / f"temp_{name}"
+    temp_dir.mkdir(exist_ok=True)
+    t0 = time.perf_counter()
+    errors = PlanetDownloader().retiler(
+        str(root / f"tiles_{name}"), str(root / name), str(temp_dir), tiles,
+        [DATE], TILE_SIZE, TILE_SIZE, 4, "EPSG:4326",
+        "<tile_dir>/tile<tile_id>_<date>.tif", verbose=False,
+        quads_gdf=quads
+    )
+    if errors:
+        raise click.ClickException(f"{name} failed: {errors}")
+    return time.perf_counter() - t0
+
+
+@click.command()
+@click.option("--size", default=4096, help="Quad width and height in pixels")
+@click.option("--reads", default=20, help="Random windowed reads per layout")
+@click.option("--tiles", "n_tiles", default=2,
+              help="Tiles to retile per layout, 0 to skip retiling")
+@click.option("--layout", "layouts", multiple=True,
+              type=click.Choice(list(LAYOUTS)), default=list(LAYOUTS),
+              help="Layouts to run")
+def main(size, reads, n_tiles, layouts):
+    from maputil.ingest import relayout_quad
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        (root / "original").mkdir()
+        quads = make_quads(root / "original", size)
+        tiles = make_tiles(quads, "four", n_tiles) if n_tiles else None
+
+        results = []
+        for name in layouts:
+            options = LAYOUTS[name]
+            quad_dir = root / name
+            if options is not None:
+                shutil.copytree(root / "original", quad_dir)
+            t0 = time.perf_counter()
+            if options is not None:
+                for path in sorted(quad_dir.glob("*.tif")):
+                    relayout_quad(str(path), **options)
+            ingest_s = time.perf_counter() - t0
+            nbytes = sum(p.stat().st_size for p in quad_dir.glob("*.tif"))
+            results.append({
+                "layout": name, "options": options,
+                "ingest_s_per_quad": ingest_s / len(quads),
+                "mb_per_quad": nbytes / len(quads) / 2 ** 20,
+                "window_read_s": read_windows(quad_dir, reads),
+                "retile_wall_s": retile(root, name, quads, tiles)
+                if n_tiles else None,
+                "lossless": same_pixels(root / "original", quad_dir),
+            })
+
+    print(json.dumps({"benchmark": "relayout", "commit": git_commit(),
+                      "quad_size": size, "timestamp": time.time(),
+                      "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
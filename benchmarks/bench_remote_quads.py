@@ -0,0 +1,177 @@
+"""Benchmark retiling from remote quads against a local HTTP server
+
+The synthetic quads of bench_retiler are rewritten as tiled GeoTIFFs and
+served by a local HTTP server that honours Range requests. Each case is
+retiled once from quad_dir and once through quad_url_pt, and the bytes the
+server sent are compared with the size of the quads a full download would
+fetch. The remote tiles are checked to match the local ones. --latency
+delays every response like a distant object store, and --pipeline-depth
+retiles the remote case with the per-worker I/O pipeline. Results are
+printed as JSON, e.g.
+
+    python benchmarks/bench_remote_quads.py --case single --case four
+"""
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import click
+import numpy as np
+
+from bench_retiler import (DATE, REPO, TILE_SIZE, git_commit, make_quads,
+                           make_tiles)
+
+sys.path.insert(0, str(REPO))
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """Serves files with single byte-range support and counts bytes sent"""
+
+    sent = [0]
+    lock = threading.Lock()
+    latency = 0.0
+
+    def send_head(self):
+        time.sleep(self.latency)
+        match = re.match(r"bytes=(\d+)-(\d*)$",
+                         self.headers.get("Range", ""))
+        if not match:
+            return super().send_head()
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2) or size - 1), size - 1)
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", "image/tiff")
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        self.range_left = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        left = getattr(self, "range_left", None)
+        data = source.read() if left is None else source.read(left)
+        with self.lock:
+            self.sent[0] += len(data)
+        outputfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def tile_quads(quad_dir):
+    """Rewrite quads as 512 x 512 tiled GeoTIFFs, like Planet's quads"""
+    import rasterio
+
+    for path in quad_dir.glob("*.tif"):
+        with rasterio.open(path) as src:
+            profile = src.profile
+            data = src.read()
+        profile.update(tiled=True, blockxsize=512, blockysize=512,
+                       compress="deflate")
+        with rasterio.open(path, "w", **profile) as dst:
+            dst.write(data)
+
+
+def retile(root, name, quads, tiles, num_cores, quad_url_pt=None,
+           pipeline_depth=0):
+    """Retile into root/name and return the wall time"""
+    from maputil.planet_downloader import PlanetDownloader
+
+    temp_dir = root / f"temp_{name}"
+    temp_dir.mkdir(exist_ok=True)
+    # the test server answers one range per request
+    downloader = PlanetDownloader(
+        {"options": {"GDAL_HTTP_MULTIRANGE": "SERIAL"}}
+    )
+    t0 = time.perf_counter()
+    errors = downloader.retiler(
+        str(root / name), str(root / "quads"), str(temp_dir), tiles, [DATE],
+        TILE_SIZE, TILE_SIZE, 4, "EPSG:4326",
+        "<tile_dir>/tile<tile_id>_<date>.tif", num_cores=num_cores,
+        verbose=False, quads_gdf=quads, quad_url_pt=quad_url_pt,
+        pipeline_depth=pipeline_depth
+    )
+    if errors:
+        raise click.ClickException(f"{name} failed: {errors}")
+    return time.perf_counter() - t0
+
+
+def same_tiles(dir_a, dir_b):
+    import rasterio
+
+    for path in dir_a.glob("*_cog.tif"):
+        with rasterio.open(path) as a, rasterio.open(dir_b / path.name) as b:
+            if not np.array_equal(a.read(), b.read()):
+                return False
+    return True
+
+
+@click.command()
+@click.option("--size", default=4096, help="Quad width and height in pixels")
+@click.option("--tiles", "n_tiles", default=2, help="Tiles per case")
+@click.option("--cores", default=1, help="Number of cores to retile with")
+@click.option("--case", "cases", multiple=True,
+              type=click.Choice(["single", "two", "four"]),
+              default=["single", "two", "four"], help="Overlap cases to run")
+@click.option("--latency", default=0.0,
+              help="Seconds the server waits before each response")
+@click.option("--pipeline-depth", default=0,
+              help="pipeline_depth of the remote retile")
+def main(size, n_tiles, cores, cases, latency, pipeline_depth):
+    RangeHandler.latency = latency
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        (root / "quads").mkdir()
+        quads = make_quads(root / "quads", size)
+        tile_quads(root / "quads")
+
+        handler = partial(RangeHandler, directory=str(root / "quads"))
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        quad_url_pt = f"http://127.0.0.1:{server.server_port}/<id>.tif"
+
+        results = []
+        for case in cases:
+            tiles = make_tiles(quads, case, n_tiles)
+            tiles_prj = tiles.to_crs(quads.crs)
+            used = quads[quads.intersects(tiles_prj.unary_union)]
+            full_bytes = sum(os.path.getsize(root / "quads" / f)
+                             for f in used["file"])
+            local_s = retile(root, f"{case}_local", quads, tiles, cores)
+            RangeHandler.sent[0] = 0
+            remote_s = retile(root, f"{case}_remote", quads, tiles, cores,
+                              quad_url_pt, pipeline_depth)
+            results.append({
+                "case": case, "tiles": len(tiles), "cores": cores,
+                "latency_s": latency, "pipeline_depth": pipeline_depth,
+                "local_wall_s": local_s, "remote_wall_s": remote_s,
+                "quad_bytes": full_bytes,
+                "fetched_bytes": RangeHandler.sent[0],
+                "fetched_fraction": RangeHandler.sent[0] / full_bytes,
+                "identical": same_tiles(root / f"{case}_local",
+                                        root / f"{case}_remote"),
+            })
+        server.shutdown()
+
+    print(json.dumps({"benchmark": "remote_quads", "commit": git_commit(),
+                      "quad_size": size, "timestamp": time.time(),
+                      "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Benchmark resampling methods and overview reads in the retiler
+
+The synthetic quads of bench_retiler get internal overviews and are retiled
+at their native tile resolution and at coarser ones, with each resampling
+method, reading the quads at full resolution and through their overviews.
+Quality is the RMSE and PSNR of each tile against lanczos from the full
+resolution quads at the same output resolution. Results are printed as
+JSON, e.g.
+
+    python benchmarks/bench_resampling.py --factor 1 --factor 8
+"""
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+
+from bench_retiler import (DATE, REPO, TILE_RES, TILE_SIZE, git_commit,
+                           make_quads, make_tiles)
+
+sys.path.insert(0, str(REPO))
+
+METHODS = ["nearest", "bilinear", "cubic", "average", "lanczos"]
+
+
+def add_overviews(quad_dir, factors=(2, 4, 8, 16)):
+    """Build internal overviews in the quads, as Planet's quads have"""
+    import rasterio
+    from rasterio.enums import Resampling
+
+    for path in quad_dir.glob("*.tif"):
+        with rasterio.open(path, "r+") as dst:
+            dst.build_overviews(list(factors), Resampling.average)
+
+
+def retile(root, name, quads, tiles, factor, method, use_overviews):
+    """Retile into root/name and return the wall time and tiles"""
+    import rasterio
+    from maputil.planet_downloader import PlanetDownloader
+
+    temp_dir = root / f"temp_{name}"
+    temp_dir.mkdir(exist_ok=True)
+    size = TILE_SIZE // factor
+    t0 = time.perf_counter()
+    errors = PlanetDownloader().retiler(
+        str(root / name), str(root / "quads"), str(temp_dir), tiles, [DATE],
+        size, size, 4, "EPSG:4326", "<tile_dir>/tile<tile_id>_<date>.tif",
+        verbose=False, quads_gdf=quads, dst_res=TILE_RES * factor,
+        resampling=method, use_overviews=use_overviews
+    )
+    wall_s = time.perf_counter() - t0
+    if errors:
+        raise click.ClickException(f"{name} failed: {errors}")
+    data = {}
+    for path in sorted((root / name).glob("*_cog.tif")):
+        with rasterio.open(path) as src:
+            data[path.name] = src.read().astype("float64")
+    return wall_s, data
+
+
+def quality(data, reference):
+    """RMSE and PSNR (for uint16 range of the reference) against reference"""
+    diff = np.concatenate([(data[k] - reference[k]).ravel()
+                           for k in reference])
+    peak = max(float(v.max()) for v in reference.values())
+    rmse = float(np.sqrt(np.mean(diff ** 2)))
+    psnr = float("inf") if rmse == 0 else 20 * np.log10(peak / rmse)
+    return rmse, psnr
+
+
+@click.command()
+@click.option("--size", default=4096, help="Quad width and height in pixels")
+@click.option("--tiles", "n_tiles", default=2, help="Tiles per run")
+@click.option("--case", default="four",
+              type=click.Choice(["single", "two", "four"]),
+              help="Overlap case of the tiles")
+@click.option("--factor", "factors", multiple=True, type=int,
+              default=[1, 4, 8],
+              help="Output resolution as a multiple of the tile resolution")
+@click.option("--method", "methods", multiple=True,
+              type=click.Choice(METHODS), default=METHODS,
+              help="Resampling methods to run")
+def main(size, n_tiles, case, factors, methods):
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        (root / "quads").mkdir()
+        quads = make_quads(root / "quads", size)
+        add_overviews(root / "quads")
+        tiles = make_tiles(quads, case, n_tiles)
+
+        results = []
+        for factor in factors:
+            _, reference = retile(root, f"ref_{factor}", quads, tiles,
+                                  factor, "lanczos", False)
+            for method in methods:
+                for use_overviews in (False, True):
+                    name = f"{method}_{factor}_{int(use_overviews)}"
+                    wall_s, data = retile(root, name, quads, tiles, factor,
+                                          method, use_overviews)
+                    rmse, psnr = quality(data, reference)
+                    results.append({
+                        "factor": factor, "res": TILE_RES * factor,
+                        "tile_size": TILE_SIZE // factor, "method": method,
+                        "use_overviews": use_overviews,
+                        "wall_s": wall_s, "tiles_per_s": len(tiles) / wall_s,
+                        "rmse": rmse, "psnr_db": psnr,
+                    })
+
+    print(json.dumps({"benchmark": "resampling", "commit": git_commit(),
+                      "quad_size": size, "case": case, "tiles": n_tiles,
+                      "timestamp": time.time(), "results": results},
+                     indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Benchmark PlanetDownloader.retiler on synthetic quads and tiles
+
+Four 4-band quads are written in a 2 x 2 Web Mercator layout, like Planet
+basemap quads, and tiles are placed so each case needs one, two or four
+quads. Each case is retiled serially and with every requested number of
+cores, in a fresh process so peak RSS is per run. Results are printed as
+JSON, e.g.
+
+    python benchmarks/bench_retiler.py --cores 1 --cores 4 > retiler.json
+"""
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+
+REPO = Path(__file__).resolve().parents[1]
+QUAD_RES = 4.777314267823516  # Web Mercator zoom 15, as Planet quads
+ORIGIN = (-111319.49, 782715.17)  # upper left, near lon -1, lat 7
+DATE = "2021-06"
+TILE_RES = 0.005 / 200
+TILE_SIZE = 2358
+
+
+def make_quads(quad_dir, size, seed=0):
+    """Write a 2 x 2 grid of synthetic quads, returning their catalog"""
+    import geopandas as gpd
+    import rasterio
+    from rasterio.warp import transform_bounds
+    from shapely.geometry import box
+
+    rng = np.random.default_rng(seed)
+    rows = []
+    for r in range(2):
+        for c in range(2):
+            name = f"quad_{r}_{c}"
+            west = ORIGIN[0] + c * size * QUAD_RES
+            north = ORIGIN[1] - r * size * QUAD_RES
+            transform = rasterio.transform.from_origin(west, north, QUAD_RES,
+                                                       QUAD_RES)
+            # smooth field plus noise so codecs see image-like data
+            yy, xx = np.mgrid[0:size, 0:size]
+            base = (1000 + 500 * np.sin(xx / 97.0) * np.cos(yy / 61.0))
+            data = np.stack([
+                base + b * 300 + rng.normal(0, 50, (size, size))
+                for b in range(4)
+            ]).astype("uint16")
+            profile = {"driver": "GTiff", "dtype": "uint16", "count": 4,
+                       "width": size, "height": size, "crs": "EPSG:3857",
+                       "transform": transform}
+            with rasterio.open(quad_dir / f"{name}.tif", "w", **profile) \
+                    as dst:
+                dst.write(data)
+            bounds = transform_bounds(
+                "EPSG:3857", "EPSG:4326", west, north - size * QUAD_RES,
+                west + size * QUAD_RES, north
+            )
+            rows.append({"tile": name, "date": DATE,
+                         "file": f"{name}.tif", "geometry": box(*bounds)})
+    return gpd.GeoDataFrame(rows, crs="EPSG:4326")
+
+
+def make_tiles(quads, case, n_tiles):
+    """Tiles that each overlap 1 ('single'), 2 ('two') or 4 ('four') quads"""
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    minx, miny, maxx, maxy = quads.total_bounds
+    midx, midy = (minx + maxx) / 2, (miny + maxy) / 2
+    w = TILE_SIZE * TILE_RES
+    centers = {
+        "single": ((minx + midx) / 2, (midy + maxy) / 2),
+        "two": (midx, (midy + maxy) / 2),
+        "four": (midx, midy),
+    }
+    cx, cy = centers[case]
+    rows = []
+    for i in range(n_tiles):
+        # shift along the shared edge so tiles differ but keep the overlap
+        dx = 0 if case != "single" else (i - n_tiles / 2) * w * 0.1
+        dy = (i - n_tiles / 2) * w * 0.1 if case != "four" else 0
+        x, y = cx + dx, cy + dy
+        rows.append({"tile": str(i),
+                     "geometry": box(x - w / 2, y - w / 2, x + w / 2,
+                                     y + w / 2)})
+    return gpd.GeoDataFrame(rows, crs="EPSG:4326")
+
+
+def run_case(work_dir, quads, tiles, num_cores, result_queue,
+             pipeline_depth=0):
+    """Retile one case in this (fresh) process and report measurements"""
+    import sys
+    sys.path.insert(0, str(REPO))
+    from maputil.planet_downloader import PlanetDownloader
+    from maputil.metrics import Metrics, summarize_metrics
+
+    name = f"{num_cores}_{pipeline_depth}"
+    tile_dir = work_dir / f"tiles_{name}"
+    temp_dir = work_dir / f"temp_{name}"
+    temp_dir.mkdir(exist_ok=True)
+    metrics = Metrics(str(work_dir / f"metrics_{name}.jsonl"))
+    downloader = PlanetDownloader(metrics=metrics)
+
+    t0 = time.perf_counter()
+    downloader.retiler(
+        str(tile_dir), str(work_dir / "quads"), str(temp_dir), tiles, [DATE],
+        TILE_SIZE, TILE_SIZE, 4, "EPSG:4326",
+        "<tile_dir>/tile<tile_id>_<date>.tif", num_cores=num_cores,
+        verbose=False, quads_gdf=quads, pipeline_depth=pipeline_depth
+    )
+    wall = time.perf_counter() - t0
+
+    summary = summarize_metrics(metrics.path, metrics.run_id)
+    written = sum(f.stat().st_size for f in tile_dir.glob("*"))
+    # ru_maxrss is in KB on Linux
+    rss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    result_queue.put({
+        "cores": num_cores,
+        "pipeline_depth": pipeline_depth,
+        "tiles": len(tiles),
+        "wall_s": wall,
+        "tiles_per_s": len(tiles) / wall,
+        "stages_s": {k: v["total_s"] for k, v in summary["stages"].items()},
+        "peak_rss_mb": max(rss_self, rss_children) / 1024,
+        "bytes_written": written,
+    })
+
+
+def git_commit():
+    p = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO,
+                       capture_output=True, text=True)
+    return p.stdout.strip() or None
+
+
+@click.command()
+@click.option("--size", default=4096, help="Quad width and height in pixels")
+@click.option("--tiles", "n_tiles", default=2, help="Tiles per case")
+@click.option("--cores", multiple=True, type=int, default=[1, 2],
+              help="Core counts to run, repeatable")
+@click.option("--case", "cases", multiple=True,
+              type=click.Choice(["single", "two", "four"]),
+              default=["single", "two", "four"], help="Overlap cases to run")
+@click.option("--pipeline-depth", "depths", multiple=True, type=int,
+              default=[0], help="pipeline_depth values to run, repeatable")
+@click.option("--keep", default=None,
+              help="Directory to keep generated data in")
+def main(size, n_tiles, cores, cases, depths, keep):
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(keep or tmp)
+        (root / "quads").mkdir(parents=True, exist_ok=True)
+        quads = make_quads(root / "quads", size)
+
+        results = []
+        for case in cases:
+            tiles = make_tiles(quads, case, n_tiles)
+            for num_cores in cores:
+                for depth in depths:
+                    work_dir = root / case
+                    work_dir.mkdir(exist_ok=True)
+                    if not (work_dir / "quads").exists():
+                        os.symlink(root / "quads", work_dir / "quads")
+                    queue = ctx.Queue()
+                    p = ctx.Process(target=run_case, args=(
+                        work_dir, quads, tiles, num_cores, queue, depth
+                    ))
+                    p.start()
+                    p.join()
+                    if p.exitcode != 0:
+                        raise click.ClickException(
+                            f"{case} with {num_cores} cores failed"
+                        )
+                    result = queue.get()
+                    results.append({"case": case, **result})
+
+    print(json.dumps({"benchmark": "retiler", "commit": git_commit(),
+                      "quad_size": size, "timestamp": time.time(),
+                      "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
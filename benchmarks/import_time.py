@@ -0,0 +1,51 @@
+"""Measure import time of the maputil package and its submodules
+
+Each module is imported in a fresh interpreter so nothing is cached between
+measurements. Results are printed as JSON so runs can be compared across
+commits, e.g.
+
+    python benchmarks/import_time.py --repeat 5 > import_time.json
+"""
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import click
+
+REPO = Path(__file__).resolve().parents[1]
+MODULES = [
+    "maputil",
+    "maputil.utils",
+    "maputil.rasterizer",
+    "maputil.get_rasterization",
+    "maputil.planet_downloader",
+]
+
+
+def time_import(module):
+    """Wall time, in seconds, of importing module in a new interpreter"""
+    code = (
+        "import time; t = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - t)"
+    )
+    p = subprocess.run([sys.executable, "-c", code], cwd=REPO,
+                       capture_output=True, text=True, check=True)
+    return float(p.stdout.strip())
+
+
+@click.command()
+@click.option("--repeat", default=3, help="Imports per module")
+def main(repeat):
+    results = {}
+    for module in MODULES:
+        times = [time_import(module) for _ in range(repeat)]
+        results[module] = {"min_s": min(times), "max_s": max(times)}
+    print(json.dumps({"python": sys.version.split()[0],
+                      "timestamp": time.time(),
+                      "import_time": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
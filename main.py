@@ -1,14 +1,50 @@
-from maputil import *
-import yaml
 import os
+import logging
+import click
+import yaml
+import numpy as np
 from pathlib import Path
 import pandas as pd
 import geopandas as gpd
+from maputil.planet_downloader import PlanetDownloader
+from maputil.utils import progress_reporter, setup_logger, get_gdal_options
+from maputil.metrics import Metrics, report_metrics
+from maputil.profiling import profile_options, profile_stage, report_profiles
+from maputil.sharding import get_manifest_path
 
 
-def main(config_path):
+def get_tiles(config, aoi):
+    """tilefile_path, or tiles generated in chunks over the AOI or bbox"""
+    if config.get('tilefile_path'):
+        return config['tilefile_path']
+    from maputil.tile_grid import iter_tile_grid
+    grid = config.get('tile_grid') or {}
+    buffer = grid.get('buffer', 0)
+    tile_size = grid.get('tile_size', config['dst_width'] - 2 * buffer)
+    # the retiler writes dst_width x dst_height pixels per tile
+    for key in ('dst_width', 'dst_height'):
+        if tile_size + 2 * buffer != config[key]:
+            raise click.ClickException(
+                f"tile_grid tile_size {tile_size} plus 2 x buffer {buffer} "
+                f"must equal {key} {config[key]}"
+            )
+    coverage = None
+    if grid.get('drop_empty', True) and os.path.isfile(config['catalog_path']):
+        coverage = gpd.read_file(config['catalog_path'])
+    return iter_tile_grid(
+        aoi if aoi is not None else tuple(config['bbox']),
+        tile_size, config.get('dst_res', 0.005 / 200), buffer,
+        config['dst_crs'], coverage, grid.get('chunk_size', 10000)
+    )
+
+
+def main(config_path, shard_index=None, shard_count=None, plan=False,
+         merge=False, profile_dir=None):
     with open(config_path, "r") as config:
         config = yaml.safe_load(config)
+    if profile_dir:
+        config['profile'] = {**(config.get('profile') or {}),
+                             'dir': profile_dir}
     
     PLANET_API_KEY = config['key']
     geom_path = config['geom_path']
@@ -19,9 +55,11 @@ def main(config_path):
     bbox = config['bbox']
     batch_size = config['batch_size']
     quad_dir = config['quad_dir']
+    quad_url = config.get('quad_url')
+    if quad_url:
+        quad_url = quad_url.replace('<api_key>', PLANET_API_KEY or '')
     tile_dir = config['tile_dir']
     temp_dir = config['temp_dir']
-    tilefile_path = config['tilefile_path']
     dst_width = config['dst_width']
     dst_height = config['dst_height']
     nbands = config['nbands']
@@ -34,24 +72,74 @@ def main(config_path):
     log_dir = config['log_dir']
     log_name = config['log_name']
     use_date = config['use_date']
-    
+    # command line shard options override the config
+    shard_index = config.get('shard_index', 0) if shard_index is None \
+        else shard_index
+    shard_count = config.get('shard_count', 1) if shard_count is None \
+        else shard_count
+    manifest_dir = config.get('manifest_dir')
+    stats_path = config.get('stats_path')
+    if stats_path and shard_count > 1:
+        # a table per shard, combined with merge_manifests
+        stats_path = get_manifest_path(
+            os.path.dirname(stats_path), shard_index, shard_count,
+            os.path.splitext(os.path.basename(stats_path))[0]
+        )
+
     if os.path.isfile(geom_path):
         geom_gdf = gpd.read_file(geom_path)
         aoi = geom_gdf[['geometry']].dissolve()
     else:
         aoi = None
 
-    downloader = PlanetDownloader()
+    if merge:
+        # fold the index parts of all shards into <index_dir>/tiles.parquet
+        from maputil.output_index import merge_index
+        if not config.get('index_dir'):
+            raise click.ClickException("Set index_dir to merge the index")
+        merged = merge_index(config['index_dir'], "tiles")
+        print(f"{len(merged)} tiles in the index of {config['index_dir']}")
+        return
+
+    if plan:
+        # offline estimate from the catalog, the tile file and outputs
+        from maputil.planner import plan_run, format_plan
+        if not os.path.isfile(catalog_path):
+            raise click.ClickException(
+                f"Planning needs the quad catalog {catalog_path}, run "
+                "with doGetGrid first"
+            )
+        gdal_env = config.get('gdal_env') or {}
+        print(format_plan(plan_run(
+            gpd.read_file(catalog_path), get_tiles(config, aoi), dates,
+            quad_dir, quad_name, tile_dir, tile_name, dst_width, dst_height, nbands,
+            num_cores, get_gdal_options(gdal_env, num_cores),
+            gdal_env.get('warp_mem_mb', 0), config.get('metrics_path'),
+            shard_index, shard_count
+        )))
+        return
+
+    metrics = Metrics(config.get('metrics_path'))
+    profile = profile_options(config.get('profile'), metrics.run_id)
+    downloader = PlanetDownloader(config.get('gdal_env'), metrics,
+                                  config.get('rate_limit'),
+                                  config.get('relayout'), profile)
     quads_url = None
+    # read by the retiler from catalog_path unless a stage above loaded it
+    quads_gdf = None
 
     # Logging
     if create_log:
         log = True
         if not os.path.isdir(log_dir):
             os.mkdir(log_dir)
+        # one listener thread writes the file; retiler workers enqueue
+        setup_logger(log_dir, log_name, use_date,
+                     config.get('log_level', 'INFO'))
         logger = logging.getLogger("maputils")
     else: 
         log = False
+        logger = None
 
     if config['doGetGrid']:
         if not os.path.isfile(catalog_path):
@@ -68,10 +156,11 @@ def main(config_path):
                     temp_file = Path(catalog_temp_dir) / f'temp_{k}.geojson'
                     if not os.path.isfile(temp_file):
                         bbox_aoi = g.total_bounds 
-                        quads_gdf, quads_url = downloader.get_basemap_grid (
-                            PLANET_API_KEY, list_quad_URL, temp_file, 
-                            dates=dates, bbox=bbox_aoi
-                        )
+                        with profile_stage(profile, "grid"):
+                            quads_gdf, quads_url = downloader.get_basemap_grid (
+                                PLANET_API_KEY, list_quad_URL, temp_file,
+                                dates=dates, bbox=bbox_aoi
+                            )
                         quads_gdf = gpd.overlay(aoi, quads_gdf)
                         quads_gdf = gpd.sjoin(left_df=quads_gdf, right_df=aoi)\
                             .drop(columns=['index_right'])
@@ -91,10 +180,11 @@ def main(config_path):
                                   log, logger)
                 
             else:
-                quads_gdf, quads_url = downloader.get_basemap_grid (
-                    PLANET_API_KEY, list_quad_URL, catalog_path, 
-                    dates=dates, aoi=aoi, bbox=bbox
-                )
+                with profile_stage(profile, "grid"):
+                    quads_gdf, quads_url = downloader.get_basemap_grid (
+                        PLANET_API_KEY, list_quad_URL, catalog_path,
+                        dates=dates, aoi=aoi, bbox=bbox
+                    )
         
     if config['doDownload']:
         if not os.path.isdir(quad_dir):
@@ -107,34 +197,83 @@ def main(config_path):
                                   logger)
                 mini_cat_path = Path(catalog_temp_dir) / mini_cat
                 quads_gdf = gpd.read_file(mini_cat_path)
+                with profile_stage(profile, "download"):
+                    downloader.download_tiles(
+                        PLANET_API_KEY, quad_dir, quad_name,
+                        quads_gdf=quads_gdf, download_url=quads_url,
+                        list_quad_URL=list_quad_URL,
+                        dates=dates, bbox=bbox,
+                        download_threads=config.get('download_threads', 8)
+                    )
+        else:
+            quads_gdf = gpd.read_file(catalog_path)
+            progress_reporter(f"Downloading {len(quads_gdf.index)} quads",
+                              verbose, log, logger)
+            with profile_stage(profile, "download"):
                 downloader.download_tiles(
                     PLANET_API_KEY, quad_dir, quad_name, quads_gdf=quads_gdf, 
                     download_url=quads_url, list_quad_URL=list_quad_URL, 
-                    dates=dates, bbox=bbox
+                    dates=dates, bbox=bbox,
+                    download_threads=config.get('download_threads', 8)
                 )
-        else:
-            quads_gdf = gpd.read_file(catalog_path)
-            progress_reporter(f"Downloading {len(quads_gdf.index)} quads", 
-                              verbose, log, logger)
-            downloader.download_tiles(
-                PLANET_API_KEY, quad_dir, quad_name, quads_gdf=quads_gdf, 
-                download_url=quads_url, list_quad_URL=list_quad_URL, 
-                dates=dates, bbox=bbox
-            )
 
     if config['doRetile']:
         progress_reporter("Retiling images", verbose, log, logger)
-        if not os.path.isdir(tile_dir):
+        if not tile_dir.startswith("s3://") and not os.path.isdir(tile_dir):
             os.mkdir(tile_dir)
         if not os.path.isdir(temp_dir):
             os.mkdir(temp_dir)
-        errors = downloader.retiler(
-            tile_dir, quad_dir, temp_dir, tilefile_path, dates, 
-            dst_width, dst_height, nbands, dst_crs, 
-            tile_name, num_cores, verbose, log, logger, quads_gdf
-        )
+        with profile_stage(profile, "retile"):
+            errors = downloader.retiler(
+                tile_dir, quad_dir, temp_dir, get_tiles(config, aoi), dates,
+                dst_width, dst_height, nbands, dst_crs,
+                tile_name, num_cores, verbose, log, quads_gdf=quads_gdf,
+                catalog_path=catalog_path,
+                shard_index=shard_index, shard_count=shard_count,
+                manifest_path=get_manifest_path(
+                    manifest_dir, shard_index, shard_count, 'tiles'
+                ) if manifest_dir else None,
+                queue_path=config.get('queue_path'),
+                lease_seconds=config.get('lease_seconds', 600),
+                upload_threads=config.get('upload_threads', 4),
+                quad_url_pt=quad_url,
+                quad_fetches=config.get('quad_fetches', 4),
+                by_tile=config.get('by_tile', False),
+                stack=config.get('stack', False),
+                dst_res=config.get('dst_res', 0.005 / 200),
+                resampling=config.get('resampling', 'cubic'),
+                use_overviews=config.get('use_overviews', True),
+                quad_cache_gb=config.get('quad_cache_gb'),
+                pipeline_depth=config.get('pipeline_depth', 0),
+                pipeline_batch=config.get('pipeline_batch', 8),
+                stats_path=stats_path,
+                stats_options=config.get('stats_options'),
+                min_coverage=config.get('min_coverage', 0),
+                index_dir=config.get('index_dir')
+            )
         progress_reporter(f"errors: {errors}", verbose, log, logger)
 
-setup_logger(log_dir, log_name, True)       
+    report_metrics(metrics, config.get('metrics_prom_path'))
+    report_profiles(profile)
+
+@click.command()
+@click.option('--config', 'config_path', default='config/config.yml',
+              help='Path to config file')
+@click.option('--shard-index', type=int, default=None,
+              help='Shard of the tiles to retile, from 0')
+@click.option('--shard-count', type=int, default=None,
+              help='Number of shards the tiles are split into')
+@click.option('--plan', is_flag=True,
+              help='Estimate quads, bytes, tiles, resources and wall time '
+                   'of the run without running it')
+@click.option('--merge-index', 'merge', is_flag=True,
+              help='Merge the tile index parts of all shards and exit')
+@click.option('--profile', 'profile_dir', default=None,
+              help='Directory for profiles of the run, overrides profile.dir '
+                   'of the config')
+def cli(config_path, shard_index, shard_count, plan, merge, profile_dir):
+    main(config_path, shard_index, shard_count, plan, merge, profile_dir)
+
+
 if __name__ =='__main__':
-    main('config/config.yml')
+    cli()
@@ -1,3 +1,90 @@
-from .planet_downloader import *
-from .rasterize_labels import *
-from .utils import *
\ No newline at end of file
+"""Tools for downloading and retiling Planet imagery and making label chips
+
+Public names are imported from their submodule on first use, so importing
+the package (in a CLI or a Pool worker) does not pay for geopandas, rasterio
+or boto3 until they are needed.
+"""
+import importlib
+
+_submodules = {
+    "planet_downloader": [
+        "PlanetDownloader", "get_quad_download_url", "get_quad_source",
+        "get_quad_path", "get_source_bounds", "get_overview_level",
+        "open_source", "download_tiles_helper", "list_quads", "setup_session",
+        "get_tempfile_name", "dst_transform", "reproject_retile_image",
+        "read_mosaic", "warp_mosaic", "process_tile", "process_tile_args",
+        "process_tile_dates", "process_tile_dates_args",
+        "process_tiles", "get_tile_quads",
+        "get_tiles_quads", "job_tiles", "retile_queue_worker",
+        "get_tile_path",
+        "upload_tile", "upload_tiles"
+    ],
+    "rasterizer": [
+        "get_grid_from_centroid", "get_chip_meta", "load_labels",
+        "BinaryScheme", "ThreeClassScheme", "CLASS_SCHEMES",
+        "register_scheme", "write_chip", "write_label_by_grid",
+        "write_threeclass_by_grid", "write_binary_by_grid", "rasterize_grids"
+    ],
+    "rasterize_state": [
+        "load_state", "save_state", "get_source_stamps",
+        "select_changed_grids", "update_state"
+    ],
+    "output_index": ["append_index", "merge_index", "query_index"],
+    "tile_stats": [
+        "compute_tile_stats", "write_tile_stats", "summarize_tile_stats"
+    ],
+    "chips": [
+        "tile_sources", "quad_sources", "get_label_chip_metas",
+        "group_chips_by_source", "extract_image_chips"
+    ],
+    "rasterize_labels": ["rasterize_labels"],
+    "get_rasterization": ["get_rasterization"],
+    "metrics": [
+        "Metrics", "summarize_metrics", "format_summary", "write_prometheus",
+        "report_metrics"
+    ],
+    "profiling": [
+        "profile_options", "profile_stage", "profile_sample",
+        "merge_profiles", "format_profile_report", "report_profiles"
+    ],
+    "sharding": [
+        "check_shard", "hilbert_index", "assign_shards", "select_tile_shard",
+        "select_grid_shard_names", "get_manifest_path", "write_manifest",
+        "merge_manifests"
+    ],
+    "planner": [
+        "plan_downloads", "plan_tiles", "estimate_worker_resources",
+        "estimate_wall_time", "plan_run", "format_plan"
+    ],
+    "quad_cache": ["QuadCache"],
+    "ingest": ["quad_layout_matches", "relayout_quad"],
+    "rate_limit": [
+        "RETRY_STATUS", "parse_retry_after", "RateLimiter", "send_request"
+    ],
+    "tile_grid": ["tile_grid_bounds", "iter_tile_grid"],
+    "work_queue": ["get_worker_id", "WorkQueue", "keep_lease", "run_worker"],
+    "utils": [
+        "read_table", "reads3csv_with_credential", "list_s3_urls",
+        "get_gdal_options",
+        "gdal_env_context", "progress_reporter", "setup_logger",
+        "get_log_queue", "init_worker_logging"
+    ],
+}
+
+_lazy_names = {name: module for module, names in _submodules.items()
+               for name in names}
+
+__all__ = list(_lazy_names)
+
+
+def __getattr__(name):
+    if name in _lazy_names:
+        module = importlib.import_module(f".{_lazy_names[name]}", __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
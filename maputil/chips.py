@@ -0,0 +1,260 @@
+import os
+from contextlib import ExitStack
+
+import numpy as np
+import geopandas as gpd
+import shapely
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import array_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from .metrics import Metrics
+from .planet_downloader import get_tile_path, get_quad_source
+from .rasterizer import get_grid_from_centroid, get_chip_meta, write_chip
+
+
+def tile_sources(tiles, tile_dir, dst_img_pt, date):
+    """Retiled tiles of one date as image sources for extract_image_chips
+
+    Parameters
+    ----------
+    tiles : GeoDataFrame
+        Tiles with a 'tile' column, as passed to retiler
+    tile_dir : str
+        Directory or s3:// prefix of the tiles
+    dst_img_pt : str
+        Tile path pattern, see get_tile_path
+    date : str
+        Date of the tiles, or 'stack'
+
+    Returns:
+    --------
+    GeoDataFrame with a 'path' column, the COG of each tile
+    """
+    paths = [get_tile_path(t, date, tile_dir, dst_img_pt)[1] for t in tiles['tile']]
+    return gpd.GeoDataFrame({'path': [_gdal_path(p) for p in paths]},
+                            geometry=tiles.geometry.values, crs=tiles.crs)
+
+
+def quad_sources(quads_gdf, quad_dir, date, quad_url_pt=None):
+    """Quads of one date as image sources for extract_image_chips
+
+    Parameters
+    ----------
+    quads_gdf : GeoDataFrame
+        Quad catalog with 'tile', 'date' and 'file' columns
+    quad_dir : str
+        Directory of downloaded quads
+    date : str
+        Date of the quads
+    quad_url_pt : str
+        URL pattern of remote quads, see get_quad_source
+
+    Returns:
+    --------
+    GeoDataFrame with a 'path' column
+    """
+    quads = quads_gdf[quads_gdf['date'] == date]
+    paths = [get_quad_source(quad_dir, f, str(q), date, quad_url_pt)
+             for f, q in zip(quads['file'], quads['tile'])]
+    return gpd.GeoDataFrame({'path': paths}, geometry=quads.geometry.values, crs=quads.crs)
+
+
+def _gdal_path(path):
+    return "/vsis3/" + path[len("s3://"):] if path.startswith("s3://") else path
+
+
+def get_label_chip_metas(grids, resolution, diam, crs):
+    """Transform and shape of the label chip of each grid
+
+    The chips are built with the functions write_label_by_grid uses, so an
+    image chip lines up pixel for pixel with its label chip.
+
+    Parameters
+    ----------
+    grids : DataFrame
+        Grid rows with 'x' and 'y'
+    resolution : float
+        Pixel size in units of crs
+    diam : float
+        Chip size parameter, as in write_label_by_grid
+    crs : int
+        EPSG code of the chips
+
+    Returns:
+    --------
+    list of rasterio profiles from get_chip_meta
+    """
+    return [get_chip_meta(get_grid_from_centroid((x, y), diam, diam, crs, crs), resolution, crs)[1]
+            for x, y in zip(grids['x'], grids['y'])]
+
+
+def group_chips_by_source(metas, sources):
+    """Sources each chip is read from, and the chips of each set of sources
+
+    A chip inside one source is read from it alone. A chip across sources
+    is read from all the sources it intersects.
+
+    Parameters
+    ----------
+    metas : list
+        Chip profiles from get_label_chip_metas, all in one CRS
+    sources : GeoDataFrame
+        Images with a 'path' column
+
+    Returns:
+    --------
+    dict of tuples of source paths to the positions of their chips in
+    metas. Chips no source intersects are left out
+    """
+    if not metas:
+        return {}
+    bounds = np.array([array_bounds(m['height'], m['width'], m['transform']) for m in metas])
+    # array_bounds is (west, south, east, north)
+    boxes = shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3])
+    sources = sources.to_crs(metas[0]['crs']).reset_index(drop=True)
+    within = sources.sindex.query(boxes, predicate="within")
+    hits = sources.sindex.query(boxes, predicate="intersects")
+    chip_sources = {}
+    for chip, src in zip(*within):
+        chip_sources.setdefault(int(chip), (sources['path'][src],))
+    spanning = {}
+    for chip, src in zip(*hits):
+        if int(chip) not in chip_sources:
+            spanning.setdefault(int(chip), []).append(sources['path'][src])
+    chip_sources.update({c: tuple(sorted(p)) for c, p in spanning.items()})
+    groups = {}
+    for chip in sorted(chip_sources):
+        groups.setdefault(chip_sources[chip], []).append(chip)
+    return groups
+
+
+def _aligned_window(src, meta):
+    """Window of src that is the chip's grid, or None if the grids differ"""
+    if src.crs != meta['crs']:
+        return None
+    st, ct = src.transform, meta['transform']
+    if not (np.isclose(st.a, ct.a) and np.isclose(st.e, ct.e) and st.b == st.d == 0):
+        return None
+    col = (ct.c - st.c) / st.a
+    row = (ct.f - st.f) / st.e
+    if not (np.isclose(col, round(col), atol=1e-6) and np.isclose(row, round(row), atol=1e-6)):
+        return None
+    return Window(int(round(col)), int(round(row)), meta['width'], meta['height'])
+
+
+def _read_chips(srcs, metas, resampling, batch_pixels):
+    """Read chips from open sources, yielding (position, array) pairs
+
+    Chips on the grid of a single source are read with one windowed read
+    over all of them when it stays under batch_pixels, and sliced. Other
+    chips are warped onto their own grid, and chips across sources take
+    each pixel from the first source that has data there.
+    """
+    windows = [_aligned_window(srcs[0], m) for m in metas] if len(srcs) == 1 else [None] * len(metas)
+    aligned = [i for i, w in enumerate(windows) if w is not None]
+    if aligned:
+        col0 = min(windows[i].col_off for i in aligned)
+        row0 = min(windows[i].row_off for i in aligned)
+        col1 = max(windows[i].col_off + windows[i].width for i in aligned)
+        row1 = max(windows[i].row_off + windows[i].height for i in aligned)
+        src = srcs[0]
+        fill = src.nodata or 0
+        if (col1 - col0) * (row1 - row0) <= batch_pixels:
+            block = src.read(window=Window(col0, row0, col1 - col0, row1 - row0), boundless=True,
+                             fill_value=fill)
+            for i in aligned:
+                w = windows[i]
+                yield i, block[:, w.row_off - row0:w.row_off - row0 + w.height,
+                               w.col_off - col0:w.col_off - col0 + w.width]
+        else:
+            for i in aligned:
+                yield i, src.read(window=windows[i], boundless=True, fill_value=fill)
+    for i, meta in enumerate(metas):
+        if windows[i] is not None:
+            continue
+        out = None
+        for src in srcs:
+            # without nodata the warped mask is all valid, so take it from an alpha band
+            alpha = src.nodata is None
+            with WarpedVRT(src, crs=meta['crs'], transform=meta['transform'], width=meta['width'],
+                           height=meta['height'], resampling=resampling, add_alpha=alpha) as vrt:
+                arr = vrt.read(src.indexes)
+                valid = (vrt.read(vrt.count) if alpha else vrt.read_masks(1)) > 0
+            if out is None:
+                out = np.where(valid, arr, src.nodata or 0).astype(arr.dtype)
+                filled = valid
+            else:
+                out = np.where(~filled & valid, arr, out)
+                filled |= valid
+        yield i, out
+
+
+def extract_image_chips(grids, sources, resolution, diam, crs, dir_out, s3_client, resampling="nearest",
+                        batch_pixels=4096 * 4096, metrics=None):
+    """Write an image chip for each grid on the exact grid of its label chip
+
+    Chips are grouped by the source images they fall in, so each image is
+    opened once for all its chips, and chips on its pixel grid are read in
+    one batch. Image chips are written like label chips, with the same
+    file names, to dir_out.
+
+    Parameters
+    ----------
+    grids : DataFrame
+        Grid rows with 'x', 'y' and 'name_col_row', as for
+        write_label_by_grid
+    sources : GeoDataFrame
+        Images with a 'path' column GDAL can open, e.g. from tile_sources
+        or quad_sources
+    resolution : float
+        Pixel size of the label chips
+    diam : float
+        Chip size parameter of the label chips
+    crs : int
+        EPSG code of the label chips
+    dir_out : str
+        Local directory or s3:// prefix for the image chips
+    s3_client : boto3.client
+        Client used when dir_out is on S3
+    resampling : str
+        Resampling of images that are not on the chip grid
+    batch_pixels : int
+        Largest window read at once for the chips of one image
+    metrics : Metrics
+        Records the time of each stage
+
+    Returns:
+    --------
+    list with the path of each grid's image chip, None where no image
+    covers the grid
+    """
+    metrics = metrics or Metrics()
+    if not dir_out.startswith("s3") and not os.path.exists(dir_out):
+        os.makedirs(dir_out)
+    resampling = Resampling[resampling] if isinstance(resampling, str) else resampling
+    with metrics.span("chip_geometry"):
+        metas = get_label_chip_metas(grids, resolution, diam, crs)
+        groups = group_chips_by_source(metas, sources)
+    names = list(grids['name_col_row'])
+    paths = [None] * len(metas)
+    for group, chips in groups.items():
+        with ExitStack() as stack:
+            with metrics.span("open"):
+                srcs = [stack.enter_context(rasterio.open(p)) for p in group]
+            reads = _read_chips(srcs, [metas[i] for i in chips], resampling, batch_pixels)
+            while True:
+                with metrics.span("read"):
+                    item = next(reads, None)
+                if item is None:
+                    break
+                j, arr = item
+                meta = dict(metas[chips[j]], count=arr.shape[0], dtype=arr.dtype.name,
+                            nodata=srcs[0].nodata)
+                paths[chips[j]] = write_chip(arr, meta, "{}.tif".format(names[chips[j]]), dir_out,
+                                             s3_client, metrics)
+        metrics.count("image_chip_sources")
+    metrics.count("image_chips_missing", paths.count(None))
+    return paths
@@ -0,0 +1,82 @@
+import os
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+
+def quad_layout_matches(src, block_size=512, compress="ZSTD", overviews=()):
+    """Whether an open quad already has the layout relayout_quad writes"""
+    return (
+        src.profile.get("tiled", False)
+        and src.block_shapes[0] == (block_size, block_size)
+        and (src.compression.value if src.compression else "NONE").upper()
+        == compress.upper()
+        and len(src.overviews(1)) >= len(overviews)
+    )
+
+
+def relayout_quad(src_path, dst_path=None, block_size=512, compress="ZSTD",
+                  overviews=(2, 4, 8, 16), level=None, max_z_error=0,
+                  num_threads=1):
+    """
+    Rewrite a quad with square internal blocks, compression and overviews
+
+    Planet serves quads in its own GeoTIFF layout. Rewritten into blocks of
+    about the size the retiler reads, a tile's windowed read only decodes
+    the blocks it overlaps, and coarse tiles read the overviews.
+
+    Parameters:
+    ----------
+    src_path: str
+        Quad to rewrite
+    dst_path: str
+        Output path. None rewrites src_path in place
+    block_size: int
+        Width and height of the internal blocks
+    compress: str
+        GDAL codec, e.g. 'ZSTD', 'DEFLATE', 'LERC' or 'LERC_ZSTD'
+    overviews: tuple
+        Decimation factors of the internal overviews. Empty for none
+    level: int
+        ZSTD or DEFLATE level. None keeps GDAL's default
+    max_z_error: float
+        Largest error LERC may introduce. 0 is lossless
+    num_threads: int
+        Threads GDAL compresses blocks with
+
+    Returns
+    -------
+    True if the quad was rewritten, False if it already had the layout
+    """
+    dst_path = dst_path or src_path
+    tmp_path = f"{dst_path}.relayout"
+    with rasterio.open(src_path) as src:
+        if quad_layout_matches(src, block_size, compress, overviews):
+            if dst_path != src_path:
+                os.replace(src_path, dst_path)
+            return False
+        profile = src.profile
+        profile.update(driver="GTiff", tiled=True, blockxsize=block_size,
+                       blockysize=block_size, compress=compress,
+                       bigtiff="IF_SAFER", num_threads=num_threads)
+        profile.pop("interleave", None)
+        if compress.upper().startswith("LERC"):
+            profile.pop("predictor", None)
+            profile["max_z_error"] = max_z_error
+        else:
+            profile["predictor"] = 2
+        codec = compress.upper().split("_")[-1]
+        if level is not None and codec in ("ZSTD", "DEFLATE"):
+            profile["zstd_level" if codec == "ZSTD" else "zlevel"] = level
+        with rasterio.open(tmp_path, "w", **profile) as dst:
+            # whole rows of blocks, so striped sources are read once
+            for row in range(0, src.height, block_size):
+                window = Window(0, row, src.width,
+                                min(block_size, src.height - row))
+                dst.write(src.read(window=window), window=window)
+            if overviews:
+                dst.build_overviews(list(overviews), Resampling.average)
+    os.replace(tmp_path, dst_path)
+    if dst_path != src_path:
+        os.remove(src_path)
+    return True
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+class Metrics():
+    """Timing spans, counters and gauges for one pipeline run
+
+    Every measurement is appended as one JSON line to path, so that records
+    from Pool workers and from the parent end up in the same file. Lines are
+    small and the file is opened in append mode, so concurrent writers do
+    not interleave within a record. With path None nothing is recorded.
+    """
+
+    def __init__(self, path=None, run_id=None) -> None:
+        """
+        Parameters:
+        ----------
+        path: str
+            JSON lines file to append records to
+        run_id: str
+            Identifier stored with each record. Defaults to the start time
+            and PID of the creating process
+        """
+        self.path = path
+        self.run_id = run_id or "{}-{}".format(
+            time.strftime("%Y%m%dT%H%M%S"), os.getpid()
+        )
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _emit(self, kind, name, value, labels):
+        if not self.path:
+            return
+        record = {"run": self.run_id, "ts": time.time(), "pid": os.getpid(),
+                  "type": kind, "name": name, "value": value}
+        if labels:
+            record["labels"] = labels
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """Time the enclosed block as one call of stage"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._emit("span", stage, time.perf_counter() - t0, labels)
+
+    def count(self, name, value=1, **labels):
+        """Add value to counter name, e.g. bytes or tiles"""
+        self._emit("counter", name, value, labels)
+
+    def gauge(self, name, value, **labels):
+        """Record the current value of gauge name, e.g. a throughput"""
+        self._emit("gauge", name, value, labels)
+
+
+def summarize_metrics(path, run_id=None):
+    """Aggregate the records of one run
+
+    Parameters:
+    ----------
+    path: str
+        JSON lines file written by Metrics
+    run_id: str
+        Run to summarize. Defaults to the last run in the file
+
+    Returns
+    -------
+    summary: dict
+        'stages' maps stage to calls, total_s, mean_s and max_s, 'counters'
+        maps name to total, 'gauges' maps name to the last value and
+        'wall_s' is the time between the first and last record
+    """
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue  # a worker was killed mid-write
+    if run_id is None and records:
+        run_id = records[-1]["run"]
+    records = [r for r in records if r["run"] == run_id]
+
+    stages = defaultdict(list)
+    counters = defaultdict(float)
+    gauges = {}
+    for r in records:
+        if r["type"] == "span":
+            stages[r["name"]].append(r["value"])
+        elif r["type"] == "counter":
+            counters[r["name"]] += r["value"]
+        else:
+            gauges[r["name"]] = r["value"]
+
+    ts = [r["ts"] for r in records]
+    return {
+        "run": run_id,
+        "wall_s": max(ts) - min(ts) if ts else 0.0,
+        "stages": {
+            k: {"calls": len(v), "total_s": sum(v), "mean_s": sum(v) / len(v),
+                "max_s": max(v)}
+            for k, v in stages.items()
+        },
+        "counters": dict(counters),
+        "gauges": gauges
+    }
+
+
+def format_summary(summary):
+    """Render a summary from summarize_metrics as a text table"""
+    lines = [f"Run {summary['run']}: {summary['wall_s']:.1f} s wall",
+             f"{'stage':<12}{'calls':>8}{'total s':>12}{'mean s':>10}"
+             f"{'max s':>10}"]
+    for stage, s in sorted(summary["stages"].items(),
+                           key=lambda x: -x[1]["total_s"]):
+        lines.append(f"{stage:<12}{s['calls']:>8}{s['total_s']:>12.2f}"
+                     f"{s['mean_s']:>10.3f}{s['max_s']:>10.3f}")
+    for name, value in sorted(summary["counters"].items()):
+        rate = value / summary["wall_s"] if summary["wall_s"] else 0.0
+        lines.append(f"{name:<28}{value:>16,.0f}  ({rate:,.1f}/s)")
+    for name, value in sorted(summary["gauges"].items()):
+        lines.append(f"{name:<28}{value:>16,.2f}")
+    return "\n".join(lines)
+
+
+def write_prometheus(summary, path):
+    """Write a summary in the Prometheus text exposition format
+
+    Parameters:
+    ----------
+    summary: dict
+        Summary from summarize_metrics
+    path: str
+        Output file, e.g. in a node_exporter textfile collector directory
+    """
+    lines = []
+    for stage, s in summary["stages"].items():
+        lines.append(f'maputil_stage_seconds_total{{stage="{stage}"}} '
+                     f'{s["total_s"]}')
+        lines.append(f'maputil_stage_calls_total{{stage="{stage}"}} '
+                     f'{s["calls"]}')
+    for name, value in summary["counters"].items():
+        lines.append(f"maputil_{name}_total {value}")
+    for name, value in summary["gauges"].items():
+        lines.append(f"maputil_{name} {value}")
+    lines.append(f"maputil_run_wall_seconds {summary['wall_s']}")
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+
+def report_metrics(metrics, prom_path=None):
+    """Print the end-of-run summary of metrics and optionally export it
+
+    Parameters:
+    ----------
+    metrics: Metrics
+        Metrics of the finished run. Nothing is reported if it has no path
+    prom_path: str
+        If given, also write the summary to this Prometheus text file
+
+    Returns
+    -------
+    summary: dict
+        Summary from summarize_metrics, or None
+    """
+    if not metrics.path or not os.path.isfile(metrics.path):
+        return None
+    summary = summarize_metrics(metrics.path, metrics.run_id)
+    print(format_summary(summary))
+    if prom_path:
+        write_prometheus(summary, prom_path)
+    return summary
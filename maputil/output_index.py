@@ -0,0 +1,220 @@
+import io
+import os
+import time
+import uuid
+import urllib.parse as urlparse
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import box
+from .sharding import hilbert_index
+
+
+def _join(index_dir, *names):
+    if index_dir.startswith("s3://"):
+        return "/".join([index_dir.rstrip("/"), *names])
+    return os.path.join(index_dir, *names)
+
+
+def _s3(path, s3_client):
+    if s3_client is None:
+        import boto3
+        s3_client = boto3.client("s3")
+    parsed = urlparse.urlparse(path)
+    return s3_client, parsed.netloc, parsed.path.lstrip("/")
+
+
+def _write_parquet(frame, path, s3_client=None):
+    if path.startswith("s3://"):
+        s3_client, bucket, key = _s3(path, s3_client)
+        buf = io.BytesIO()
+        frame.to_parquet(buf, index=False, row_group_size=10000)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=buf.getvalue())
+        return
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written aside and renamed, so readers never see part of a file
+    frame.to_parquet(f"{path}.tmp", index=False, row_group_size=10000)
+    os.replace(f"{path}.tmp", path)
+
+
+def _read_parquet(path, s3_client=None, filters=None):
+    if path.startswith("s3://"):
+        s3_client, bucket, key = _s3(path, s3_client)
+        path = io.BytesIO(
+            s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        )
+    return gpd.read_parquet(path, filters=filters)
+
+
+def _exists(path, s3_client=None):
+    if not path.startswith("s3://"):
+        return os.path.isfile(path)
+    s3_client, bucket, key = _s3(path, s3_client)
+    return bool(s3_client.list_objects_v2(Bucket=bucket, Prefix=key,
+                                          MaxKeys=1).get("Contents"))
+
+
+def _list_parts(index_dir, kind, s3_client=None):
+    """Part files of kind, oldest first"""
+    prefix = _join(index_dir, kind, "part-")
+    if not prefix.startswith("s3://"):
+        part_dir = os.path.dirname(prefix)
+        if not os.path.isdir(part_dir):
+            return []
+        return sorted(os.path.join(part_dir, f) for f in os.listdir(part_dir)
+                      if f.startswith("part-") and f.endswith(".parquet"))
+    s3_client, bucket, key = _s3(prefix, s3_client)
+    paths = []
+    for page in s3_client.get_paginator("list_objects_v2").paginate(
+            Bucket=bucket, Prefix=key):
+        paths.extend(f"s3://{bucket}/{obj['Key']}"
+                     for obj in page.get("Contents", [])
+                     if obj["Key"].endswith(".parquet"))
+    return sorted(paths)
+
+
+def append_index(records, geometries, crs, index_dir, kind, s3_client=None):
+    """
+    Add outputs to the index as a new GeoParquet part
+
+    Each call writes its own part under index_dir/kind, so workers and
+    shards add to one index without coordinating. merge_index folds the
+    parts into one file.
+
+    Parameters:
+    ----------
+    records: list
+        One dict per output with at least 'path'. Nested 'stats' dicts are
+        flattened into columns
+    geometries: list
+        Footprint of each output
+    crs: str
+        CRS of the geometries
+    index_dir: str
+        Directory or s3:// prefix of the index
+    kind: str
+        Kind of output, e.g. 'tiles' or 'chips'
+    s3_client: boto3.client
+        Client used when index_dir is on S3
+
+    Returns
+    -------
+    Path of the part, or None if there were no records
+    """
+    if not records:
+        return None
+    frame = gpd.GeoDataFrame(
+        pd.DataFrame([{**{k: v for k, v in r.items() if k != "stats"},
+                       **(r.get("stats") or {})} for r in records]),
+        geometry=list(geometries), crs=crs
+    )
+    # plain columns, so readers can filter row groups by bounding box
+    bounds = frame.geometry.bounds
+    for col in ("minx", "miny", "maxx", "maxy"):
+        frame[col] = bounds[col].values
+    frame["indexed_at"] = time.time()
+    path = _join(index_dir, kind, "part-{}-{}-{}.parquet".format(
+        time.strftime("%Y%m%dT%H%M%S"), os.getpid(), uuid.uuid4().hex[:8]
+    ))
+    _write_parquet(frame, path, s3_client)
+    return path
+
+
+def merge_index(index_dir, kind="tiles", out_path=None, compact=True,
+                s3_client=None):
+    """
+    Fold the parts of an index, e.g. of all shards, into one GeoParquet
+
+    Outputs indexed more than once keep their latest record. Rows are
+    sorted along a Hilbert curve so that a row group covers a compact area
+    and bounding box queries read few of them.
+
+    Parameters:
+    ----------
+    index_dir: str
+        Directory or s3:// prefix of the index
+    kind: str
+        Kind of output, see append_index
+    out_path: str
+        Merged file. Defaults to <index_dir>/<kind>.parquet, which is read
+        back on the next merge
+    compact: bool
+        Delete the parts once they are in the merged file
+    s3_client: boto3.client
+        Client used when index_dir is on S3
+
+    Returns
+    -------
+    GeoDataFrame of the merged index
+    """
+    out_path = out_path or _join(index_dir, f"{kind}.parquet")
+    parts = _list_parts(index_dir, kind, s3_client)
+    paths = ([out_path] if _exists(out_path, s3_client) else []) + parts
+    if not paths:
+        return gpd.GeoDataFrame()
+    merged = pd.concat([_read_parquet(p, s3_client) for p in paths],
+                       ignore_index=True)
+    merged = merged.sort_values("indexed_at", kind="stable") \
+        .drop_duplicates("path", keep="last")
+    order = np.argsort(hilbert_index((merged["minx"] + merged["maxx"]) / 2,
+                                     (merged["miny"] + merged["maxy"]) / 2),
+                       kind="stable")
+    merged = merged.iloc[order].reset_index(drop=True)
+    _write_parquet(merged, out_path, s3_client)
+    if compact:
+        for part in parts:
+            if part.startswith("s3://"):
+                client, bucket, key = _s3(part, s3_client)
+                client.delete_object(Bucket=bucket, Key=key)
+            else:
+                os.remove(part)
+    return merged
+
+
+def query_index(index_dir, kind="tiles", bbox=None, dates=None,
+                s3_client=None):
+    """
+    Outputs in an area and of some dates, from the index instead of
+    listing storage
+
+    Reads the merged file and any parts not merged yet, skipping row
+    groups outside bbox.
+
+    Parameters:
+    ----------
+    index_dir: str
+        Directory or s3:// prefix of the index
+    kind: str
+        Kind of output, see append_index
+    bbox: tuple
+        (minx, miny, maxx, maxy) in the CRS of the index. Outputs whose
+        footprint intersects it are returned
+    dates: list
+        Dates to return, for tiles
+    s3_client: boto3.client
+        Client used when index_dir is on S3
+
+    Returns
+    -------
+    GeoDataFrame of the matching outputs, the latest record of each
+    """
+    filters = []
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        filters += [("maxx", ">=", minx), ("minx", "<=", maxx),
+                    ("maxy", ">=", miny), ("miny", "<=", maxy)]
+    if dates is not None:
+        filters.append(("date", "in", [str(d) for d in dates]))
+    merged = _join(index_dir, f"{kind}.parquet")
+    paths = ([merged] if _exists(merged, s3_client) else []) + \
+        _list_parts(index_dir, kind, s3_client)
+    frames = [_read_parquet(p, s3_client, filters or None) for p in paths]
+    if not frames:
+        return gpd.GeoDataFrame()
+    found = pd.concat(frames, ignore_index=True) \
+        .sort_values("indexed_at", kind="stable") \
+        .drop_duplicates("path", keep="last")
+    if bbox is not None:
+        found = found[found.intersects(box(*bbox))]
+    return found.reset_index(drop=True)
@@ -2,33 +2,72 @@
 import os
 import re
 import requests
-import urllib
-from joblib import Parallel, delayed
+import urllib.parse as urlparse
 import logging
-# from logging.handlers import QueueHandler, QueueListener
-# from multiprocessing import Manager
 from multiprocessing import Pool
 from subprocess import run
+from concurrent.futures import ThreadPoolExecutor
 import time
+import queue
+import threading
+from contextlib import ExitStack
+from itertools import islice
 import numpy as np
-import matplotlib.pyplot as plt
+import pandas as pd
 import geopandas as gpd
 from geopandas.tools import sjoin
+import shapely
 from shapely.geometry import box
 import affine
 import tempfile
 import rasterio
 from rasterio.merge import merge
-from rasterio import fill
-from rasterio.plot import show
 from rasterio.io import MemoryFile
-from rasterio.warp import reproject, Resampling
+from rasterio.warp import reproject, transform_bounds, Resampling
 from .utils import *
+from .metrics import Metrics
+from .sharding import select_tile_shard, write_manifest
+from .work_queue import WorkQueue, run_worker
+from .rate_limit import RateLimiter, send_request
+from .quad_cache import QuadCache
+from .ingest import relayout_quad
+from .tile_stats import compute_tile_stats, write_tile_stats
+from .output_index import append_index
+from .profiling import profile_sample
+
+
+# default tile resolution in degrees, about 2.8 m at the equator
+DST_RES = 0.005 / 200
 
 
 class PlanetDownloader():
-    def __init__(self) -> None:
-        pass
+    def __init__(self, gdal_env=None, metrics=None, rate_limit=None,
+                 relayout=None, profile=None) -> None:
+        """
+        Parameters:
+        ----------
+        gdal_env: dict
+            The gdal_env config section, applied to every raster stage
+            (see utils.get_gdal_options)
+        metrics: Metrics
+            Where stage timings and counters are recorded. Defaults to not
+            recording
+        rate_limit: dict
+            The rate_limit config section, arguments of the RateLimiter
+            that listing and download requests to Planet share
+        relayout: dict
+            The relayout config section, arguments of ingest.relayout_quad.
+            If given, every downloaded quad is rewritten with that layout
+            by the thread that downloaded it
+        profile: dict
+            Profile options from profiling.profile_options. A sample of the
+            tiles is then profiled in the retile workers
+        """
+        self.gdal_env = gdal_env or {}
+        self.metrics = metrics or Metrics()
+        self.limiter = RateLimiter(metrics=self.metrics, **(rate_limit or {}))
+        self.relayout = relayout
+        self.profile = profile
 
     def get_basemap_grid(self, PLANET_API_KEY, API_URL, catalog_path=None, 
                          dates=None, aoi=None, bbox=None, _page_size=250):
@@ -82,9 +121,11 @@ class PlanetDownloader():
                 bbox = aoi.total_bounds
 
             for date in dates:
-                quads, mosaic_name, quads_url = list_quads(
-                    PLANET_API_KEY, API_URL, date, bbox, _page_size
-                )
+                with self.metrics.span("list", date=date):
+                    quads, mosaic_name, quads_url = list_quads(
+                        PLANET_API_KEY, API_URL, date, bbox, _page_size,
+                        self.limiter
+                    )
                 for quad in quads['items']:
                     ids.append(quad['id'])
                     geometries.append(box(quad['bbox'][0], quad['bbox'][1], 
@@ -113,8 +154,9 @@ class PlanetDownloader():
     
     def download_tiles(
             self, PLANET_API_KEY, quad_dir, quad_name, quads_gdf=None, 
-            catalog_path=None, download_url=None, list_quad_URL=None,  
-            dates=None, bbox=None, verbose=False, log=False
+            catalog_path=None, download_url=None, list_quad_URL=None,
+            dates=None, bbox=None, verbose=False, log=False,
+            download_threads=8
         ):
         """
         Download basemaps from PlanetScope to local server
@@ -146,23 +188,43 @@ class PlanetDownloader():
             Print messages to console or not
         log : boolstr
             Whether to log or not
+        download_threads : int
+            Quads downloaded at once at most. The rate limiter may allow
+            fewer while Planet throttles
+
 
-        
         Returns
         -------
         """
+        session = requests.Session()
+
+        def download_all(jobs):
+            # jobs are (url, filename) pairs. The span is the wall time of
+            # the downloads, their 'download' spans overlap
+            with self.metrics.span("download_all"), \
+                    ThreadPoolExecutor(max(download_threads, 1)) as pool:
+                list(pool.map(
+                    lambda job: download_tiles_helper(
+                        job[0], job[1], verbose=verbose, log=log,
+                        metrics=self.metrics, limiter=self.limiter,
+                        session=session, relayout=self.relayout
+                    ), jobs
+                ))
+
         if download_url is not None:
             if quads_gdf is not None:
                 pass
             elif catalog_path is not None:
                 quads_gdf = gpd.read_file(catalog_path)
 
+            jobs = []
             for i, row in quads_gdf.iterrows():
                 # print(i)
                 link = get_quad_download_url(download_url, row['tile'])
-                filename = get_quad_path(quad_name, quad_dir, row['file'])#, 
+                filename = get_quad_path(quad_name, quad_dir, row['file'])#,
                                         #  row['tile'])
-                download_tiles_helper(link, filename, verbose=verbose, log=log)
+                jobs.append((link, filename))
+            download_all(jobs)
             return
 
         else:
@@ -171,18 +233,24 @@ class PlanetDownloader():
             if dates is None:
                 raise ValueError('Must supply dates to query quads')
             for date in dates:
-                quads, mosaic_name, _ = list_quads(PLANET_API_KEY, 
-                                                   list_quad_URL, date, bbox)
+                with self.metrics.span("list", date=date):
+                    quads, mosaic_name, _ = list_quads(PLANET_API_KEY,
+                                                       list_quad_URL, date,
+                                                       bbox,
+                                                       limiter=self.limiter)
+                jobs = []
                 for idx, i in enumerate(quads['items']):
                     # print(idx)
                     if quads_gdf is not None:
                         if i['id'] not in list(quads_gdf['tile']):
                             continue
                     link = i['_links']['download']
-                    filename = get_quad_path(quad_name, quad_dir, mosaic_name)#, 
-                                             #i['id'])
-                    download_tiles_helper(link, filename, verbose=verbose, 
-                                          log=log)
+                    # named as in the catalog of get_basemap_grid, so that
+                    # concurrent downloads write files of their own
+                    filename = get_quad_path(quad_name, quad_dir,
+                                             f"{mosaic_name}_{i['id']}")
+                    jobs.append((link, filename))
+                download_all(jobs)
                 return
             # function to enable parallel processing
             
@@ -190,7 +258,12 @@ class PlanetDownloader():
     def retiler(
         self, tile_dir, quad_dir, temp_dir, tile_file, dates, dst_width, 
         dst_height, nbands, dst_crs, dst_img_pt, num_cores=1, verbose=True, 
-        log=False, quads_gdf=None, catalog_path=None 
+        log=False, quads_gdf=None, catalog_path=None, shard_index=0,
+        shard_count=1, manifest_path=None, queue_path=None, lease_seconds=600,
+        upload_threads=4, quad_url_pt=None, quad_fetches=4, by_tile=False,
+        stack=False, dst_res=DST_RES, resampling="cubic", use_overviews=True,
+        quad_cache_gb=None, pipeline_depth=0, pipeline_batch=8,
+        stats_path=None, stats_options=None, min_coverage=0, index_dir=None
     ):
         """
         retile quads from quad_dir into smaller tiles and write tiles to 
@@ -198,14 +271,20 @@ class PlanetDownloader():
         
         Parameters:
         ----------
-        tile_dir : str 
-            Directory to store tiles
+        tile_dir : str
+            Directory to store tiles, or an s3:// prefix. Tiles for S3 are
+            built in temp_dir and uploaded while the next tiles are
+            processed, and tiles already in S3 are found with one listing
+            and skipped
         quad_dir: str
-            Directory storing quads
+            Directory storing quads. Not used with quad_url_pt
         temp_dir: str
             Directory to create temporary files
-        tile_file: str or GeoDataFrame
-            File path to the tile catalog or geopandas GeoDataFrame of tiles
+        tile_file: str, GeoDataFrame or iterable
+            File path to the tile catalog, geopandas GeoDataFrame of tiles,
+            or an iterable of GeoDataFrames such as iter_tile_grid, whose
+            chunks are retiled one after the other. Shards are then taken
+            from each chunk
         dates: list
             List of dates in string format
             Should be in format 'yyyy-dd' or 'yyyy-dd_yyyy-dd' for a time range
@@ -219,7 +298,8 @@ class PlanetDownloader():
         dst_crs : str
             Code for output CRS, e.g "EPSG:4326"
         dst_img_pt : str
-            Output file path and name pattern for output geotiff
+            Output file path and name pattern for output geotiff. May be an
+            s3:// URL pattern
         num_cores : int
             Number of cores used for processing. Defaults to 1 for serial mode
         verbose : bool
@@ -230,11 +310,85 @@ class PlanetDownloader():
             geopandas of quads
         catalog_path : str
             File path to the quad catalog
+        shard_index : int
+            Shard of the tiles to process, from 0 to shard_count - 1
+        shard_count : int
+            Number of nodes the tiles are split between. Tiles are split
+            into spatially compact shards so each node needs few quads
+        manifest_path : str
+            CSV the processed tiles are appended to, see
+            sharding.merge_manifests
+        queue_path : str
+            If given, tile jobs for all dates are put in this work queue
+            (see work_queue.WorkQueue) and num_cores workers pull from it
+            until it is empty. Retilers on other machines started with the
+            same queue_path share the work and take over jobs whose worker
+            died
+        lease_seconds : float
+            How long a worker may go without a heartbeat before its tile is
+            handed to another worker
+        upload_threads : int
+            Number of concurrent uploads when writing to S3
+        quad_url_pt : str
+            URL pattern with <id> (and optionally <date>) of quads to read
+            remotely instead of from quad_dir, e.g. the download URL of
+            download_tiles or an s3:// mirror. Quads are read through GDAL
+            with range requests, so only the part a tile overlaps is
+            fetched and the download step can be skipped
+        quad_fetches : int
+            Number of remote quads a worker opens concurrently
+        by_tile : bool
+            Dispatch one task per tile that retiles all dates, instead of
+            looping over dates. The tile is joined with the quads once and
+            one Pool serves all dates
+        stack : bool
+            Write one COG per tile with the bands of all dates, in the order
+            of dates, instead of one COG per date. Implies by_tile. Its path
+            is dst_img_pt with <date> set to 'stack'
+        dst_res : float
+            Resolution of the tiles in units of dst_crs. dst_width and
+            dst_height should cover the tiles at this resolution
+        resampling : str
+            Name of the rasterio Resampling method, e.g. 'nearest',
+            'bilinear', 'cubic' or 'average'
+        use_overviews : bool
+            When tiles are coarser than the quads, read from the quads'
+            internal or external overviews at the best matching level
+        quad_cache_gb : float
+            With quad_url_pt, download quads into quad_dir as tiles need
+            them instead of reading them remotely, keeping quad_dir under
+            this many GB (see quad_cache.QuadCache). Quads no pending tile
+            needs are deleted first. Not supported with queue_path
+        pipeline_depth : int
+            If over 0, each worker reads the quads of its next tiles and
+            writes its previous tiles in background threads while it warps,
+            holding at most this many tiles in memory per stage (see
+            process_tiles). Not used with stack or for the per-date jobs of
+            queue_path
+        pipeline_batch : int
+            Tiles per task with pipeline_depth, the tiles a worker's
+            pipeline runs over. With by_tile the dates of a tile are
+            pipelined instead
+        stats_path : str
+            CSV the band statistics and coverage of each tile are appended
+            to, computed from the tile in memory before it is written (see
+            tile_stats.compute_tile_stats). Not recorded for stacked tiles
+        stats_options : dict
+            Options of compute_tile_stats, e.g. {'bins': 64,
+            'hist_range': [0, 10000]}
+        min_coverage : float
+            Tiles with data over a smaller fraction of their pixels are not
+            written and get the status 'empty'. With stack, dates below it
+            are left empty
+        index_dir : str
+            Directory or s3:// prefix of a GeoParquet index the written
+            tiles are added to, with their footprint, date, path, size and
+            statistics (see output_index.append_index and merge_index)
 
         Returns
         -------
         errors: list
-            A list of error
+            Records of the tiles that failed
         """
         
         if log:
@@ -242,13 +396,43 @@ class PlanetDownloader():
         else:
             logger = None
 
-        if not os.path.isdir(tile_dir):
-            os.makedirs(tile_dir)
+        remote = tile_dir.startswith("s3://") or \
+            dst_img_pt.startswith("s3://")
+        if remote:
+            import boto3
+            s3_client = boto3.client("s3")
+        else:
+            s3_client = None
+            if not os.path.isdir(tile_dir):
+                os.makedirs(tile_dir)
+
+        if not isinstance(tile_file, (str, gpd.GeoDataFrame)):
+            if quads_gdf is None and catalog_path:
+                quads_gdf = gpd.read_file(catalog_path)
+            errors = []
+            for tiles in tile_file:
+                errors.extend(self.retiler(
+                    tile_dir, quad_dir, temp_dir, tiles, dates, dst_width,
+                    dst_height, nbands, dst_crs, dst_img_pt, num_cores,
+                    verbose, log, quads_gdf, catalog_path, shard_index,
+                    shard_count, manifest_path, queue_path, lease_seconds,
+                    upload_threads, quad_url_pt, quad_fetches, by_tile,
+                    stack, dst_res, resampling, use_overviews, quad_cache_gb,
+                    pipeline_depth, pipeline_batch, stats_path, stats_options,
+                    min_coverage, index_dir
+                ) or [])
+            return errors
 
         if type(tile_file) is str:
             tiles = gpd.read_file(tile_file).astype({"tile": "str"})
         else: 
             tiles = tile_file.astype({"tile": "str"})
+        if shard_count > 1:
+            tiles = select_tile_shard(tiles, shard_index, shard_count)
+            progress_reporter(
+                f"Shard {shard_index} of {shard_count}: {len(tiles)} tiles",
+                verbose, log, logger
+            )
 
         if quads_gdf is None:
             if catalog_path:
@@ -266,14 +450,47 @@ class PlanetDownloader():
                 raise KeyError("Make sure the quads_gdf has 'tile' and\
                                date 'columns'")
         
-        # errors = []
-        for date in dates:
-            progress_reporter(f"Processing for date: {date}", verbose, log, 
-                              logger)
-            quads = quads_gdf[quads_gdf['date'] == date]
-            # tiles_prj = tiles.to_crs(quads.crs)
+        # each worker gets its share of the GDAL cache and threads
+        gdal_options = get_gdal_options(self.gdal_env, num_cores)
+        cache = None
+        if quad_cache_gb:
+            if not quad_url_pt:
+                raise ValueError("quad_cache_gb needs quad_url_pt to "
+                                 "download quads from")
+            if queue_path:
+                raise ValueError("quad_cache_gb does not work with "
+                                 "queue_path")
+
+            download_url_pt = quad_url_pt
+
+            def fetch(quad, path):
+                file, quad_id, date = quad
+                url = re.sub('<date>', date,
+                             get_quad_download_url(download_url_pt, quad_id))
+                download_tiles_helper(url, path, log, verbose, self.metrics,
+                                      self.limiter, relayout=self.relayout)
 
-            tile_meta = {
+            cache = QuadCache(quad_dir, quad_cache_gb * 2 ** 30, fetch,
+                              metrics=self.metrics)
+            # workers read the quads the cache downloaded
+            quad_url_pt = None
+        if quad_url_pt and not urlparse.urlparse(quad_url_pt).path.lower()\
+                .endswith((".tif", ".tiff")):
+            # e.g. Planet's .../<id>/full, which the default would refuse
+            gdal_options.pop("CPL_VSIL_CURL_ALLOWED_EXTENSIONS", None)
+
+        if shard_count > 1 and not queue_path:
+            # only the quads this shard's tiles need. A queue also hands
+            # out tiles of other shards and chunks
+            shard_area = tiles.to_crs(quads_gdf.crs)[['geometry']]
+            quads_gdf = quads_gdf[
+                quads_gdf.index.isin(
+                    sjoin(quads_gdf, shard_area, how='inner').index
+                )
+            ]
+
+        def get_tile_meta(date):
+            return {
                 "tile_dir": tile_dir,
                 "quad_dir": quad_dir,
                 "temp_dir": temp_dir,
@@ -284,34 +501,309 @@ class PlanetDownloader():
                 "dst_width": dst_width, 
                 "dst_height": dst_height, 
                 "dst_crs": f"EPSG:{tiles.crs.to_epsg()}",
-                "nbands": nbands
+                "nbands": nbands,
+                "gdal_options": gdal_options,
+                "warp_mem_mb": self.gdal_env.get("warp_mem_mb", 0),
+                "metrics": self.metrics,
+                "remote": remote,
+                "quad_url_pt": quad_url_pt,
+                "quad_fetches": quad_fetches,
+                "dst_res": dst_res,
+                "resampling": resampling,
+                "use_overviews": use_overviews,
+                "pipeline_depth": pipeline_depth,
+                "stats": dict(stats_options or {}) if stats_path else None,
+                "min_coverage": min_coverage,
+                "profile": self.profile
+            }
+
+        # tiles already in S3, from one listing instead of a call per tile
+        out_dates = ["stack"] if stack else dates
+        existing = set()
+        if remote:
+            existing = list_s3_urls(
+                [get_tile_path(tile, date, tile_dir, dst_img_pt)[1]
+                 for date in out_dates for tile in tiles['tile']], s3_client
+            )
+            progress_reporter(f"{len(existing)} tiles already in {tile_dir}",
+                              verbose, log, logger)
+        elif cache is not None:
+            # so that no quads are downloaded for them
+            existing = {
+                path for path in (
+                    get_tile_path(tile, date, tile_dir, dst_img_pt)[1]
+                    for date in out_dates for tile in tiles['tile']
+                ) if os.path.exists(path)
             }
+        tile_quads = get_tiles_quads(tiles, quads_gdf) if cache else {}
 
-            # Parallelize 
+        def todo_dates(tile):
+            todo = [date for date in out_dates
+                    if get_tile_path(tile, date, tile_dir, dst_img_pt)[1]
+                    not in existing]
+            return dates if todo and stack else todo
+
+        tile_metas = {date: get_tile_meta(date) for date in dates}
+        if queue_path:
+            return self._retile_from_queue(
+                queue_path, lease_seconds, tiles, quads_gdf, tile_metas,
+                num_cores, manifest_path, todo_dates, by_tile or stack, stack,
+                verbose, log, logger, stats_path, index_dir
+            )
+        if by_tile or stack:
+            return self._retile_by_tile(
+                tiles, quads_gdf, tile_metas, num_cores, manifest_path,
+                todo_dates, stack, s3_client, upload_threads, verbose, log,
+                logger, cache, tile_quads, stats_path, index_dir
+            )
+
+        errors = []
+        for date in dates:
+            progress_reporter(f"Processing for date: {date}", verbose, log,
+                              logger)
+            quads = quads_gdf[quads_gdf['date'] == date]
+            # tiles_prj = tiles.to_crs(quads.crs)
+
+            tile_meta = tile_metas[date]
+            t0 = time.perf_counter()
+
+            skipped = []
+            items = []
+            for i, tile in enumerate(tiles['tile']):
+                path = get_tile_path(tile, date, tile_dir, dst_img_pt)[1]
+                if date not in todo_dates(tile):
+                    skipped.append({"tile": int(float(tile)), "date": date,
+                                    "path": path, "status": "exists"})
+                else:
+                    items.append((i, tiles, quads, tile_meta))
+            if skipped:
+                self.metrics.count("tiles_skipped", len(skipped))
+            if cache is not None:
+                def quads_of(item, date=date):
+                    return [q for q in tile_quads.get(item[0], [])
+                            if q[2] == date]
+
+                def fetch_failed(item, e, date=date):
+                    # only the tiles of the quad fail, not the run
+                    progress_reporter(f"Quads not fetched: {e!r}", verbose,
+                                      log, logger, logging.WARNING)
+                    return _error_record(item[0], item[1], date, item[3], e)
+                cache.need(q for item in items for q in quads_of(item))
+                items = cache.acquire_each(items, quads_of, fetch_failed)
+            if pipeline_depth:
+                # a task is a batch of tiles the worker pipelines. Tiles are
+                # acquired one by one, so a quad that fails only fails its
+                # tiles
+                items = _batches(items, pipeline_batch)
+                process_args = process_tiles
+            else:
+                process_args = process_tile_args
+
+            # Parallelize
             if num_cores > 1:
-                progress_reporter(f'Processing job with {num_cores} cores', 
+                progress_reporter(f'Processing job with {num_cores} cores',
                                   verbose, log, logger)
-                # results = Parallel(n_jobs=num_cores)(
-                #     delayed(process_tile)(i) for i in range(len(tile_polys_prj))
-                # )
-                with Pool(num_cores) as p:
-                    items = [(i, tiles, quads, tile_meta) 
-                             for i in range(len(tiles))]
-                    results = []
-                    for result in p.starmap(process_tile, items):
-                        results.append(result)
+                with Pool(num_cores, init_worker_logging,
+                          (get_log_queue(), logging.getLogger("maputils").level)
+                          ) as p:
+                    results = p.imap(process_args, items)
+                    if pipeline_depth:
+                        results = (r for batch in results for r in batch)
+                    if cache is not None:
+                        results = cache.release_each(results)
+                    results = upload_tiles(results, s3_client, upload_threads,
+                                           self.metrics)
 
             else:  # serial
                 progress_reporter("Processing serial", verbose, log, logger)
-                results = [process_tile(i, tiles, quads, tile_meta) 
-                           for i in range(len(tiles))]
+                results = (process_args(item) for item in items)
+                if pipeline_depth:
+                    results = (r for batch in results for r in batch)
+                if cache is not None:
+                    results = cache.release_each(results)
+                results = upload_tiles(results, s3_client, upload_threads,
+                                       self.metrics)
+
+            records = skipped + [r for r in results if r is not None]
+            errors.extend(r for r in records if r['status'] == 'error')
+            self._write_records(records, manifest_path, stats_path,
+                                index_dir, tiles)
 
+            self.metrics.gauge("retile_tiles_per_s",
+                               len(tiles) / (time.perf_counter() - t0),
+                               date=date)
             progress_reporter(f"Completed processing tiles for {date}", 
                               verbose, log, logger)   
              
         progress_reporter("All processed", verbose, log, logger)   
         
-        # return errors
+        return errors
+
+    def _write_records(self, records, manifest_path, stats_path,
+                       index_dir=None, tiles=None):
+        """Append the statistics of records to stats_path, the written
+        tiles to the index in index_dir and the records without statistics
+        to manifest_path"""
+        if stats_path:
+            write_tile_stats(records, stats_path)
+        written = [r for r in records if r is not None and
+                   r['status'] == "written"]
+        if index_dir and written:
+            footprints = dict(zip(tiles['tile'].astype(float).astype(int),
+                                  tiles.geometry))
+            append_index(
+                [{k: v for k, v in r.items() if k not in ("status", "error")}
+                 for r in written],
+                [footprints[r['tile']] for r in written], tiles.crs,
+                index_dir, "tiles"
+            )
+        if manifest_path:
+            write_manifest([{k: v for k, v in r.items() if k != "stats"}
+                            for r in records], manifest_path)
+
+    def _retile_by_tile(
+        self, tiles, quads_gdf, tile_metas, num_cores, manifest_path,
+        todo_dates, stack, s3_client, upload_threads, verbose, log, logger,
+        cache=None, tile_quads=None, stats_path=None, index_dir=None
+    ):
+        """Retile all dates of a tile in one task
+
+        Returns the error records
+        """
+        t0 = time.perf_counter()
+        skipped = []
+        items = []
+        for i, tile in enumerate(tiles['tile']):
+            todo = todo_dates(tile)
+            if todo:
+                items.append((i, tiles, quads_gdf,
+                              {date: tile_metas[date] for date in todo},
+                              stack))
+            elif stack:
+                skipped.append({"tile": int(float(tile)), "date": "stack"})
+            else:
+                skipped.extend({"tile": int(float(tile)), "date": date}
+                               for date in tile_metas)
+        meta = next(iter(tile_metas.values()))
+        for record in skipped:
+            record["path"] = get_tile_path(record["tile"], record["date"],
+                                           meta['tile_dir'],
+                                           meta['dst_img_pt'])[1]
+            record["status"] = "exists"
+            if stack:
+                record["dates"] = ";".join(tile_metas)
+        if skipped:
+            self.metrics.count("tiles_skipped", len(skipped))
+        if cache is not None:
+            def quads_of(item):
+                return [q for q in tile_quads.get(item[0], [])
+                        if q[2] in item[3]]
+
+            def fetch_failed(item, e):
+                progress_reporter(f"Quads not fetched: {e!r}", verbose, log,
+                                  logger, logging.WARNING)
+                i, _, _, metas, _ = item
+                if stack:
+                    return [{**_error_record(i, tiles, "stack", meta, e),
+                             "dates": ";".join(metas)}]
+                return [_error_record(i, tiles, date, metas[date], e)
+                        for date in metas]
+            cache.need(q for item in items for q in quads_of(item))
+            items = cache.acquire_each(items, quads_of, fetch_failed)
+
+        if num_cores > 1:
+            progress_reporter(f'Processing job with {num_cores} cores',
+                              verbose, log, logger)
+            with Pool(num_cores, init_worker_logging,
+                      (get_log_queue(), logging.getLogger("maputils").level)
+                      ) as p:
+                results = p.imap(process_tile_dates_args, items)
+                if cache is not None:
+                    results = cache.release_each(results)
+                results = upload_tiles(
+                    (r for records in results for r in records),
+                    s3_client, upload_threads, self.metrics
+                )
+        else:  # serial
+            progress_reporter("Processing serial", verbose, log, logger)
+            results = (process_tile_dates(*item) for item in items)
+            if cache is not None:
+                results = cache.release_each(results)
+            results = upload_tiles(
+                (r for records in results for r in records),
+                s3_client, upload_threads, self.metrics
+            )
+
+        records = skipped + [r for r in results if r is not None]
+        self._write_records(records, manifest_path, stats_path, index_dir,
+                            tiles)
+        self.metrics.gauge("retile_tiles_per_s",
+                           len(tiles) / (time.perf_counter() - t0))
+        progress_reporter("All processed", verbose, log, logger)
+        return [r for r in records if r['status'] == 'error']
+
+    def _retile_from_queue(
+        self, queue_path, lease_seconds, tiles, quads_gdf, tile_metas,
+        num_cores, manifest_path, todo_dates, by_tile, stack, verbose, log,
+        logger, stats_path=None, index_dir=None
+    ):
+        """Retile every tile and date through a shared work queue
+
+        Returns the error records of the jobs that used up their attempts
+        """
+        queue = WorkQueue(queue_path, lease_seconds)
+        # with its geometry, so that a worker on another chunk can run it
+        crs = tiles.crs.to_string()
+        tile_jobs = [{"tile": str(tile), "geometry": shapely.to_wkb(geom, hex=True),
+                      "crs": crs}
+                     for tile, geom in zip(tiles['tile'], tiles.geometry)]
+        if by_tile:
+            jobs = ((job["tile"], {**job, "dates": todo_dates(job["tile"]),
+                                   "stack": stack})
+                    for job in tile_jobs if todo_dates(job["tile"]))
+        else:
+            jobs = ((f"{job['tile']}_{date}", {**job, "date": date})
+                    for job in tile_jobs for date in todo_dates(job["tile"]))
+        added = queue.add(jobs)
+        progress_reporter(f"Queued {added} new tile jobs in {queue_path}: "
+                          f"{queue.counts()}", verbose, log, logger)
+        t0 = time.perf_counter()
+
+        args = (queue_path, lease_seconds, tiles, quads_gdf, tile_metas)
+        if num_cores > 1:
+            progress_reporter(f'Processing job with {num_cores} cores',
+                              verbose, log, logger)
+            with Pool(num_cores, init_worker_logging,
+                      (get_log_queue(), logging.getLogger("maputils").level)
+                      ) as p:
+                results = p.starmap(retile_queue_worker, [args] * num_cores)
+            records = [r for worker in results for r in worker]
+        else:
+            records = retile_queue_worker(*args)
+
+        known = set(tiles['tile'].astype(float).astype(int))
+        if index_dir and any(r['tile'] not in known for r in records):
+            # tiles of other chunks, claimed here after their lease expired
+            others = [p for _, p, _ in queue.results() if "geometry" in p
+                      and int(float(p['tile'])) not in known]
+            tiles = pd.concat([tiles[['tile', 'geometry']],
+                               job_tiles(others).to_crs(tiles.crs)],
+                              ignore_index=True)
+        self._write_records(records, manifest_path, stats_path, index_dir,
+                            tiles)
+        errors = []
+        for _, _, result in queue.results("failed"):
+            # a record, the records of a tile, or an exception message
+            if isinstance(result, dict):
+                errors.append(result)
+            elif isinstance(result, list):
+                errors.extend(r for r in result if r['status'] == 'error')
+
+        self.metrics.gauge("retile_tiles_per_s",
+                           len(records) / (time.perf_counter() - t0))
+        progress_reporter(f"All processed: {queue.counts()}", verbose, log,
+                          logger)
+        return errors
 
 
 def get_quad_download_url(url_pt, id):
@@ -333,6 +825,35 @@ def get_quad_download_url(url_pt, id):
 
 
 # def get_quad_path(quad_name_pt, quad_dir, qname, id):
+def get_quad_source(quad_dir, file, quad_id, date, quad_url_pt=None):
+    """
+    Path GDAL reads a quad from
+
+    Parameters:
+    ----------
+    quad_dir: str
+        Directory of downloaded quads
+    file: str
+        File name of the quad in quad_dir
+    quad_id: str
+        Quad id, substituted for <id> in quad_url_pt
+    date: str
+        Quad date, substituted for <date> in quad_url_pt
+    quad_url_pt: str
+        URL pattern of remote quads. If None the quad is read from quad_dir
+
+    Returns
+    -------
+    Local path, or a /vsicurl/ or /vsis3/ path for remote quads
+    """
+    if not quad_url_pt:
+        return f"{quad_dir}/{file}"
+    url = re.sub('<date>', date, get_quad_download_url(quad_url_pt, quad_id))
+    if url.startswith("s3://"):
+        return f"/vsis3/{url[len('s3://'):]}"
+    return f"/vsicurl/{url}"
+
+
 def get_quad_path(quad_name_pt, quad_dir, qname):
     """
     Replace placeholder with values to get actual file path
@@ -357,7 +878,8 @@ def get_quad_path(quad_name_pt, quad_dir, qname):
     return filename
 
 
-def download_tiles_helper(url, filename, log, verbose):
+def download_tiles_helper(url, filename, log, verbose, metrics=None,
+                          limiter=None, session=None, relayout=None):
     """
     A helper function to download file to local server
     
@@ -371,7 +893,17 @@ def download_tiles_helper(url, filename, log, verbose):
         Print messages to console or not
     log : bool
         Write messages to logger or not
-    
+    metrics : Metrics
+        Records download time and bytes
+    limiter : RateLimiter
+        Limiter shared by the requests to Planet. Throttled and failed
+        requests are retried, see send_request
+    session : requests.Session
+        Session to download with
+    relayout : dict
+        Arguments of ingest.relayout_quad to rewrite the quad with after
+        the download, outside of its request slot
+
     Returns
     -------
     """
@@ -379,18 +911,40 @@ def download_tiles_helper(url, filename, log, verbose):
         logger = logging.getLogger("maputils")
     else:
         logger = None
+    metrics = metrics or Metrics()
+
+    def save(res):
+        res.raise_for_status()
+        # a partial file is never mistaken for a downloaded quad
+        with open(f"{filename}.part", "wb") as dst:
+            for chunk in res.iter_content(2 ** 20):
+                dst.write(chunk)
 
     if not os.path.isfile(filename):
-        urllib.request.urlretrieve(url, filename)
+        with metrics.span("download"):
+            res = send_request(session or requests.Session(), "GET", url,
+                               limiter, handle=save, metrics=metrics,
+                               stream=True)
+            if res is not None:  # retries ran out
+                res.raise_for_status()
+        metrics.count("quads_downloaded")
+        metrics.count("download_bytes", os.path.getsize(f"{filename}.part"))
+        if relayout is None:
+            os.replace(f"{filename}.part", filename)
+        else:
+            with metrics.span("relayout"):
+                relayout_quad(f"{filename}.part", filename, **relayout)
         # print(f"Downloaded: {filename}")
-        progress_reporter(f"Downloaded: {filename}", verbose, log, logger)
+        progress_reporter(f"Downloaded: {filename}", verbose, log, logger,
+                          logging.DEBUG)
     else:
         progress_reporter(f"File already exists: {filename}", verbose, log, 
-                          logger)
+                          logger, logging.DEBUG)
         # print(f"File already exists: {filename}")
 
 
-def list_quads(PLANET_API_KEY, API_URL, date, bbox=None, _page_size=250):
+def list_quads(PLANET_API_KEY, API_URL, date, bbox=None, _page_size=250,
+               limiter=None):
     """
     Helper function: actual function to query quads from the Planet API
     
@@ -406,7 +960,10 @@ def list_quads(PLANET_API_KEY, API_URL, date, bbox=None, _page_size=250):
     bbox: list
         Coordinates of the area to be queried
         Should be in format [xmin, ymin, xmax, ymax]
-    
+    limiter: RateLimiter
+        Limiter shared by the requests to Planet. Throttled and failed
+        requests are retried, see send_request
+
     Returns
     -------
     quads: dict
@@ -417,7 +974,8 @@ def list_quads(PLANET_API_KEY, API_URL, date, bbox=None, _page_size=250):
         URL pattern to download quads
     """
     session = setup_session(PLANET_API_KEY)
-    res = session.get(API_URL, params = {"name__contains" : date})
+    res = send_request(session, "GET", API_URL, limiter,
+                       params={"name__contains": date})
     mosaic = res.json()
     try:
         mosaic_id = mosaic['mosaics'][0]['id']
@@ -433,7 +991,8 @@ def list_quads(PLANET_API_KEY, API_URL, date, bbox=None, _page_size=250):
     # List mosaics
     quads_url = f"{API_URL}/{mosaic_id}/quads"
     params = {'bbox': bbox_str,'minimal': True, '_page_size': _page_size}
-    res = session.get(quads_url, params=params, stream=True)
+    res = send_request(session, "GET", quads_url, limiter, params=params)
+    res.raise_for_status()
     quads = res.json()
     return quads, mosaic_name, quads_url
 
@@ -456,6 +1015,210 @@ def setup_session(API_KEY):
     session.auth = (API_KEY, "")
     return session
 
+def get_source_bounds(srcs, dst_transform, dst_width, dst_height, dst_crs,
+                      pad=8):
+    """
+    Bounds of the source pixels needed to fill a destination grid
+
+    Parameters:
+    ----------
+    srcs: list
+        Source images (rasterio datasets) on one pixel grid. The bounds
+        are snapped to that grid and clipped to the extent of the images
+    dst_transform: affine
+        Transform of the destination grid
+    dst_width: int
+        Width of the destination grid
+    dst_height: int
+        Height of the destination grid
+    dst_crs: str
+        CRS of the destination grid
+    pad: int
+        Source pixels added on every side for the resampling kernel
+
+    Returns
+    -------
+    (left, bottom, right, top) in the CRS of src
+    """
+    src = srcs[0]
+    west, south, east, north = transform_bounds(
+        dst_crs, src.crs,
+        *rasterio.transform.array_bounds(dst_height, dst_width, dst_transform),
+        densify_pts=21
+    )
+    # snap to the source grid so merge does not shift pixels
+    x0, y0 = src.transform.c, src.transform.f
+    xres, yres = src.res
+    left = x0 + (np.floor((west - x0) / xres) - pad) * xres
+    right = x0 + (np.ceil((east - x0) / xres) + pad) * xres
+    top = y0 - (np.floor((y0 - north) / yres) - pad) * yres
+    bottom = y0 - (np.ceil((y0 - south) / yres) + pad) * yres
+    # beyond the images there is no data to pad with
+    return (max(left, min(s.bounds.left for s in srcs)),
+            max(bottom, min(s.bounds.bottom for s in srcs)),
+            min(right, max(s.bounds.right for s in srcs)),
+            min(top, max(s.bounds.top for s in srcs)))
+
+
+def get_overview_level(src, dst_transform, dst_width, dst_height, dst_crs):
+    """
+    Overview of an image to read for a destination grid
+
+    Parameters:
+    ----------
+    src: rasterio dataset
+        Source image, with internal or external (.ovr) overviews
+    dst_transform: affine
+        Transform of the destination grid
+    dst_width: int
+        Width of the destination grid
+    dst_height: int
+        Height of the destination grid
+    dst_crs: str
+        CRS of the destination grid
+
+    Returns
+    -------
+    Index of the coarsest overview still at least as fine as the
+    destination, as for gdalwarp -ovr AUTO, or None for full resolution
+    """
+    factors = src.overviews(1)
+    if not factors:
+        return None
+    west, south, east, north = transform_bounds(
+        dst_crs, src.crs,
+        *rasterio.transform.array_bounds(dst_height, dst_width, dst_transform),
+        densify_pts=21
+    )
+    ratio = min((east - west) / dst_width, (north - south) / dst_height) / \
+        min(src.res)
+    levels = [i for i, f in enumerate(factors) if f <= ratio * (1 + 1e-6)]
+    return levels[-1] if levels else None
+
+
+def open_source(path, dst_transform, dst_width, dst_height, dst_crs,
+                use_overviews=True):
+    """
+    Open a source image at the overview level matching a destination grid
+
+    Parameters:
+    ----------
+    path: str
+        Path GDAL can open
+    dst_transform, dst_width, dst_height, dst_crs
+        Destination grid, see get_overview_level
+    use_overviews: bool
+        If False the image is opened at full resolution
+
+    Returns
+    -------
+    rasterio dataset
+    """
+    src = rasterio.open(path)
+    if not use_overviews:
+        return src
+    level = get_overview_level(src, dst_transform, dst_width, dst_height,
+                               dst_crs)
+    if level is None:
+        return src
+    src.close()
+    return rasterio.open(path, overview_level=level)
+
+
+def read_mosaic(images, dst_transform, dst_width, dst_height, dst_crs,
+                metrics=None):
+    """
+    Merge the part of open source images under a destination grid
+
+    Parameters:
+    ----------
+    images: list
+        Open source images (rasterio datasets) on one pixel grid
+    dst_transform, dst_width, dst_height, dst_crs
+        Destination grid, see get_source_bounds
+    metrics: Metrics
+        Records the mosaic time
+
+    Returns
+    -------
+    (mosaic array, profile of the mosaic)
+    """
+    metrics = metrics or Metrics()
+    # read only the part of the images under the tile
+    bounds = get_source_bounds(images, dst_transform, dst_width, dst_height,
+                               dst_crs)
+    left, bottom, right, top = bounds
+    overlapping = [s for s in images
+                   if s.bounds.left < right and s.bounds.right > left and
+                   s.bounds.bottom < top and s.bounds.top > bottom]
+    if not overlapping:
+        # the tile misses the images, the output stays empty either way
+        overlapping, bounds = images, None
+    with metrics.span("mosaic"):
+        mosaic, out_trans = merge(overlapping, bounds=bounds)
+
+    out_meta = images[-1].meta.copy()
+    out_meta.update({
+        "height": mosaic.shape[1],
+        "width": mosaic.shape[2],
+        "transform": out_trans,
+    })
+    return mosaic, out_meta
+
+
+def warp_mosaic(mosaic, profile, dst_transform, dst_width, dst_height,
+                dst_crs, dst_dtype=np.int16, resampling=Resampling.cubic,
+                warp_mem_limit=0, num_threads=1):
+    """
+    Reproject an in-memory mosaic onto a destination grid
+
+    Parameters:
+    ----------
+    mosaic: numpy.ndarray
+        (bands, rows, cols) array, e.g. from read_mosaic
+    profile: dict
+        rasterio profile of the mosaic
+    dst_transform, dst_width, dst_height, dst_crs
+        Destination grid, see reproject_retile_image
+    dst_dtype: numpy data type
+        Type the reprojected values are rounded to
+    resampling: Resampling
+        Resampling method of the reprojection
+    warp_mem_limit: int
+        Working memory of the warper in MB. 0 uses the GDAL default
+    num_threads: int
+        Number of threads the warper uses
+
+    Returns
+    -------
+    (array of dst_dtype, rasterio profile to write it with)
+    """
+    nbands = mosaic.shape[0]
+    dst_canvas = np.zeros((nbands, dst_height, dst_width))
+    for i in range(nbands):
+        dst_canvas[i] = reproject(
+            source=mosaic[i],
+            destination=dst_canvas[i],
+            src_transform=profile['transform'],
+            src_crs=profile['crs'],
+            src_nodata=profile.get('nodata'),
+            dst_transform=dst_transform,
+            dst_crs=dst_crs,
+            resampling=resampling,
+            warp_mem_limit=warp_mem_limit,
+            num_threads=num_threads
+        )[0]
+    kwargs = profile.copy()
+    kwargs.update({
+        "width": dst_width,
+        "height": dst_height,
+        "count": nbands,
+        "crs": dst_crs,
+        "transform": dst_transform,
+    })
+    return np.rint(dst_canvas).astype(dst_dtype), kwargs
+
+
 def get_tempfile_name(temp_dir, file_name='mosaic.tif'):
     """
     Create a temporary filename in the tmp directory
@@ -476,7 +1239,7 @@ def get_tempfile_name(temp_dir, file_name='mosaic.tif'):
     )    
     return file_path
 
-def dst_transform(poly, res = 0.005 / 200):
+def dst_transform(poly, res=DST_RES):
     """
     Create transform from boundaries of tiles
     
@@ -502,7 +1265,9 @@ def dst_transform(poly, res = 0.005 / 200):
 def reproject_retile_image(
         src_images, dst_transform, dst_width, dst_height, nbands, dst_crs,
         fileout, temp_dir, dst_dtype=np.int16, inmemory=True, cleanup=True, 
-        verbose=True, log=False
+        verbose=True, log=False, warp_mem_limit=0, num_threads=1,
+        metrics=None, max_fetches=1, resampling=Resampling.cubic,
+        use_overviews=True, stats=None, min_coverage=0
     ):
     """Takes an input images or list of images and merges (if several) and 
     reprojects and retiles it to align to the resolution and extent defined by
@@ -539,10 +1304,31 @@ def reproject_retile_image(
         Print messages to console or not
     log : bool
         Write messages to logger or not
-    
+    warp_mem_limit : int
+        Working memory of the warper in MB. 0 uses the GDAL default
+    num_threads : int
+        Number of threads the warper uses
+    metrics : Metrics
+        Records mosaic and reproject time
+    max_fetches : int
+        Number of images opened concurrently, which hides latency when they
+        are remote
+    resampling : Resampling or str
+        Resampling method of the reprojection
+    use_overviews : bool
+        Read from overviews of the images when the output is coarser, see
+        get_overview_level
+    stats : dict
+        If not None, options of tile_stats.compute_tile_stats, which is run
+        on the output before it is written
+    min_coverage : float
+        Output covering a smaller fraction of the tile is not written.
+        Computes the statistics
+
     Returns
     -------
-    geotiff of retiled image writen to disk 
+    geotiff of retiled image writen to disk, and the statistics of the
+    output if computed
     """
     
     def reproject_retile(src, nbands, dst_height, dst_width, fileout, temp_dir, 
@@ -565,84 +1351,296 @@ def reproject_retile_image(
                 src_crs = src.crs,
                 dst_transform = dst_transform,
                 dst_crs = dst_crs,
-                resampling = Resampling.cubic
+                resampling = resampling,
+                warp_mem_limit = warp_mem_limit,
+                num_threads = num_threads
             )[0]
+        out = np.rint(dst_canvas).astype(dst_dtype)
+        tile_stats = None
+        if stats is not None or min_coverage:
+            with metrics.span("stats"):
+                tile_stats = compute_tile_stats(out, kwargs.get('nodata'),
+                                                **(stats or {}))
+            if tile_stats['coverage'] < min_coverage:
+                return tile_stats
         with rasterio.open(fileout, "w", **kwargs) as dst:
-            dst.write(np.rint(dst_canvas).astype(dst_dtype))
-    
+            dst.write(out)
+        return tile_stats
+
     # initialize logger
     if log:
         logger = logging.getLogger("maputils")
     else:
         logger = None
+    metrics = metrics or Metrics()
+    if isinstance(resampling, str):
+        resampling = Resampling[resampling]
+
+    def open_image(image):
+        return open_source(image, dst_transform, dst_width, dst_height,
+                           dst_crs, use_overviews)
 
-    
     # mosaic if list
     if type(src_images) is list:
         progress_reporter(f"..mosaicking {len(src_images)} images", 
-                          verbose, log, logger)
+                          verbose, log, logger, logging.DEBUG)
         
-        images_to_mosaic = []
-        for idx, image in enumerate(src_images):
+        def try_open_image(image):
             try:
-                src = rasterio.open(image)
-                images_to_mosaic.append(src)
-            except:
-                progress_reporter(f'..file not found: {image}', verbose, log, 
-                                  logger)
-                continue
+                return open_image(image)
+            except Exception:
+                progress_reporter(f'..file not found: {image}', verbose, log,
+                                  logger, logging.WARNING)
+                return None
                 # raise Exception('RasterioIOError: File not found')
 
-        # perform mosaic
-        mosaic, out_trans = merge(images_to_mosaic)
+        with ThreadPoolExecutor(max(max_fetches, 1)) as pool:
+            images_to_mosaic = [
+                src for src in pool.map(try_open_image, src_images)
+                if src is not None
+            ]
+        src = images_to_mosaic[-1]
+        mosaic, out_meta = read_mosaic(images_to_mosaic, dst_transform,
+                                       dst_width, dst_height, dst_crs,
+                                       metrics)
 
-        out_meta = src.meta.copy()
-        out_meta.update({
-            "height": mosaic.shape[1],
-            "width": mosaic.shape[2],
-            "transform": out_trans,
-        })
-        
         if inmemory:
             progress_reporter('....mosaicking in memory', verbose, log, 
-                              logger)
+                              logger, logging.DEBUG)
             with MemoryFile() as memfile:
                 with memfile.open(**out_meta) as dst:
                     dst.write(mosaic)
 
                 msg = f"..reprojecting, retiling {os.path.basename(fileout)}"
-                progress_reporter(msg, verbose, log, logger)
-                reproject_retile(src, nbands, dst_height, dst_width, fileout, 
-                                 temp_dir, dst_dtype)
+                progress_reporter(msg, verbose, log, logger, logging.DEBUG)
+                with metrics.span("reproject"):
+                    tile_stats = reproject_retile(src, nbands, dst_height,
+                                                  dst_width, fileout,
+                                                  temp_dir, dst_dtype)
         else: 
             temp_mosaic = get_tempfile_name(temp_dir, 'mosaic.tif')
             msg = f"....creating temporary mosaick {temp_mosaic}"
-            progress_reporter(msg, verbose, log, logger)
+            progress_reporter(msg, verbose, log, logger, logging.DEBUG)
             with rasterio.open(temp_mosaic, "w", **out_meta) as dst:
                   dst.write(mosaic)
             
             msg = f"..reprojecting, retiling {os.path.basename(fileout)}"
-            progress_reporter(msg, verbose, log, logger)
-            with rasterio.open(temp_mosaic, "r") as src:
-                reproject_retile(src, nbands, dst_height, dst_width, fileout, 
-                                 temp_dir, dst_dtype) 
+            progress_reporter(msg, verbose, log, logger, logging.DEBUG)
+            with rasterio.open(temp_mosaic, "r") as src, \
+                    metrics.span("reproject"):
+                tile_stats = reproject_retile(src, nbands, dst_height,
+                                              dst_width, fileout, temp_dir,
+                                              dst_dtype)
             
             if cleanup: 
                 progress_reporter(f"....removing temporary mosaick {fileout}", 
-                                  verbose, log, logger)
+                                  verbose, log, logger, logging.DEBUG)
                 os.remove(temp_mosaic)
             
     else: 
-        progress_reporter("..retiling from single image", verbose, log, logger)
+        progress_reporter("..retiling from single image", verbose, log, logger,
+                          logging.DEBUG)
         msg = f"..reprojecting, retiling {os.path.basename(fileout)}"
-        progress_reporter(msg, verbose, log, logger)
-        with rasterio.open(src_images, "r") as src:
-            reproject_retile(src, nbands, dst_height, dst_width, fileout, 
-                             temp_dir, dst_dtype) 
+        progress_reporter(msg, verbose, log, logger, logging.DEBUG)
+        with open_image(src_images) as src, metrics.span("reproject"):
+            tile_stats = reproject_retile(src, nbands, dst_height, dst_width,
+                                          fileout, temp_dir, dst_dtype)
     
     msg = f"Retiling and reprojecting of {fileout} complete!"
-    progress_reporter(msg, verbose, log, logger)
+    progress_reporter(msg, verbose, log, logger, logging.DEBUG)
+    return tile_stats
+
+
+
+def job_tiles(jobs):
+    """
+    Tiles of work queue jobs, from the geometry in their payloads
 
+    Parameters:
+    ----------
+    jobs: list
+        Payloads with 'tile', 'geometry' (hex WKB) and 'crs'
+
+    Returns
+    -------
+    GeoDataFrame with a 'tile' column
+    """
+    if not jobs:
+        return gpd.GeoDataFrame({'tile': []}, geometry=[])
+    return gpd.GeoDataFrame(
+        {'tile': [job['tile'] for job in jobs]},
+        geometry=shapely.from_wkb([job['geometry'] for job in jobs]),
+        crs=jobs[0]['crs']
+    )
+
+
+def retile_queue_worker(queue_path, lease_seconds, tiles, quads_gdf,
+                        tile_metas):
+    """
+    Claim tile jobs from a work queue and retile them until none are left
+
+    Parameters:
+    ----------
+    queue_path: str
+        SQLite file of the WorkQueue holding {"tile", "date"} jobs, or
+        {"tile", "dates", "stack"} jobs run with process_tile_dates
+    lease_seconds: float
+        Lease of the queue
+    tiles: GeoDataFrame
+        Tiles of the current chunk. Jobs of other tiles are run on the
+        geometry in their payload
+    quads_gdf: GeoDataFrame
+        Quads of all dates
+    tile_metas: dict
+        Maps date to the tile_meta passed to process_tile
+
+    Returns
+    -------
+    Records of the tiles this worker completed
+    """
+    queue = WorkQueue(queue_path, lease_seconds)
+    index = {str(tile): i for i, tile in enumerate(tiles['tile'])}
+    quads_by_date = {date: quads_gdf[quads_gdf['date'] == date]
+                     for date in tile_metas}
+
+    s3_client = None
+
+    def upload(record):
+        nonlocal s3_client
+        if record is None or "local_path" not in record:
+            return record
+        if s3_client is None:
+            import boto3
+            s3_client = boto3.client("s3")
+        return upload_tile(record, s3_client,
+                           next(iter(tile_metas.values())).get('metrics'))
+
+    def job_tile(job):
+        if job['tile'] in index:
+            return index[job['tile']], tiles
+        if "geometry" not in job:
+            raise ValueError(f"Tile {job['tile']} is not in this chunk and "
+                             "its job has no geometry")
+        return 0, job_tiles([job])
+
+    # uploads finish before the job is completed, so a dead worker's tile
+    # is redone
+    def handler(job):
+        i, job_frame = job_tile(job)
+        if "dates" in job:
+            return [upload(r) for r in process_tile_dates(
+                i, job_frame, quads_gdf,
+                {date: tile_metas[date] for date in job['dates']},
+                job['stack']
+            )]
+        return upload(process_tile(i, job_frame, quads_by_date[job['date']],
+                                   tile_metas[job['date']]))
+
+    def is_error(result):
+        records = result if isinstance(result, list) else [result]
+        return any(r is not None and r['status'] == 'error' for r in records)
+
+    done = run_worker(queue, handler, is_error=is_error)
+    records = []
+    for _, result in done:
+        records.extend(result if isinstance(result, list) else [result])
+    return [r for r in records if r is not None]
+
+
+def upload_tile(record, s3_client, metrics=None):
+    """
+    Upload a tile that process_tile built in temp_dir to its s3:// path
+
+    Parameters:
+    ----------
+    record: dict
+        Record returned by process_tile. Only 'written' records with a
+        'local_path' are uploaded
+    s3_client: boto3.client
+        Client used for the upload
+    metrics: Metrics
+        Records upload time and count
+
+    Returns
+    -------
+    The record without 'local_path', with status 'error' if the upload
+    failed
+    """
+    if record is None or "local_path" not in record:
+        return record
+    metrics = metrics or Metrics()
+    record = dict(record)
+    local_path = record.pop("local_path")
+    if record['status'] != "written":
+        return record
+    parsed = urlparse.urlparse(record['path'])
+    try:
+        with metrics.span("upload"):
+            s3_client.upload_file(local_path, parsed.netloc,
+                                  parsed.path.lstrip("/"))
+    except Exception as e:
+        # the local COG is kept, so the next run uploads it without retiling
+        return {**record, "status": "error", "error": repr(e)}
+    metrics.count("tiles_uploaded")
+    os.remove(local_path)
+    return record
+
+
+def upload_tiles(records, s3_client, upload_threads=4, metrics=None):
+    """
+    Upload tiles as their records arrive, while later tiles are processed
+
+    Parameters:
+    ----------
+    records: iterable
+        Records from process_tile, e.g. a lazy Pool.imap
+    s3_client: boto3.client
+        Client used for uploads. If None, records are returned as they are
+    upload_threads: int
+        Number of concurrent uploads
+    metrics: Metrics
+        Records upload time and count
+
+    Returns
+    -------
+    List of the records, after upload
+    """
+    if s3_client is None:
+        return list(records)
+    with ThreadPoolExecutor(upload_threads) as uploader:
+        futures = [uploader.submit(upload_tile, r, s3_client, metrics)
+                   for r in records]
+    return [f.result() for f in futures]
+
+
+def get_tile_path(tile, date, tile_dir, dst_img_pt):
+    """
+    Output GeoTIFF and COG paths of a tile
+
+    Parameters:
+    ----------
+    tile: str
+        Tile id
+    date: str
+        Date of the tile
+    tile_dir: str
+        Directory or s3:// prefix substituted for <tile_dir>
+    dst_img_pt: str
+        Output path pattern with <tile_dir>, <tile_id> and <date>
+
+    Returns
+    -------
+    (GeoTIFF path, COG path)
+    """
+    dst_img = re.sub('<tile_dir>', tile_dir, dst_img_pt)
+    dst_img = re.sub('<tile_id>', f"{int(float(tile))}", dst_img)
+    dst_img = re.sub('<date>', date, dst_img)
+    return dst_img, re.sub('.tif', '_cog.tif', dst_img)
+
+
+def process_tile_args(args):
+    """process_tile with its arguments in one tuple, for Pool.imap"""
+    return process_tile(*args)
 
 
 def process_tile(i, tiles, quads_gdf, tile_meta):
@@ -659,86 +1657,553 @@ def process_tile(i, tiles, quads_gdf, tile_meta):
         The quad polygons
     tile_meta : dict
         Dictionary holding the variables tile_dir, quad_dir, dst_img_pt,
-        date, log, verbose, dst_width, dst_height, dst_crs, nbands
+        date, log, verbose, dst_width, dst_height, dst_crs, nbands, and
+        optionally gdal_options, warp_mem_mb and profile
+
+    Returns
+    -------
+    record : dict
+        tile, date, path of the COG and status, one of 'written', 'exists',
+        'empty' or 'error' (with the error message in 'error')
     """
-    
-    verbose = tile_meta['verbose']
-    log = tile_meta['log']
-    if log:
-        logger = logging.getLogger("maputils")
-    else:
-        logger = None
-    
-    # tile
+    # The environment is opened per call so it also applies in Pool workers
+    with gdal_env_context(tile_meta.get('gdal_options')), \
+            profile_sample(tile_meta.get('profile'), "process_tile"):
+        return _process_tile(i, tiles, quads_gdf, tile_meta)
+
+
+def process_tile_dates(i, tiles, quads_gdf, tile_metas, stack=False):
+    """
+    Process a single tile for several dates in one task
+
+    The tile is joined with the quads of all dates once, instead of once
+    per date.
+
+    Arguments
+    ---------
+    i : int
+        Iterator index
+    tiles : GeoDataFrame
+        The tile polygons
+    quads_gdf : GeoDataFrame
+        The quad polygons of all dates
+    tile_metas : dict
+        Maps date to the tile_meta of process_tile
+    stack : bool
+        Write one COG per tile with the bands of all dates in date order,
+        named after dst_img_pt with <date> set to 'stack', instead of one
+        COG per date. Dates without quads are left empty (0)
+
+    Returns
+    -------
+    records : list
+        Records as returned by process_tile, one per date or a single one
+        for the stack with the stacked dates in 'dates'
+    """
+    # The environment is opened per call so it also applies in Pool workers
+    meta = next(iter(tile_metas.values()))
+    with gdal_env_context(meta.get('gdal_options')), \
+            profile_sample(meta.get('profile'), "process_tile_dates"):
+        tile_quads = get_tile_quads(tiles.iloc[[int(i)]], quads_gdf)
+        if stack:
+            return [_process_tile_stack(i, tiles, tile_quads, tile_metas)]
+        if meta.get('pipeline_depth'):
+            # the dates of the tile go through the pipeline one after another
+            return _process_tiles_pipelined(
+                [(i, tiles, quads_gdf, tile_meta, tile_quads)
+                 for tile_meta in tile_metas.values()]
+            )
+        return [_process_tile(i, tiles, quads_gdf, tile_meta, tile_quads)
+                for tile_meta in tile_metas.values()]
+
+
+def process_tile_dates_args(args):
+    """process_tile_dates with its arguments in one tuple, for Pool.imap"""
+    return process_tile_dates(*args)
+
+
+def process_tiles(items):
+    """
+    Process several tiles in one task, overlapping their I/O with warping
+
+    A reader thread opens and merges the quads of the next tiles and a
+    writer thread writes and cogifies the finished ones while the calling
+    thread warps, see tile_meta['pipeline_depth'].
+
+    Arguments
+    ---------
+    items : list
+        Arguments of process_tile, one tuple per tile
+
+    Returns
+    -------
+    records : list
+        Records as returned by process_tile, in the order of items
+    """
+    meta = items[0][3]
+    with gdal_env_context(meta.get('gdal_options')), \
+            profile_sample(meta.get('profile'), "process_tiles"):
+        return _process_tiles_pipelined(
+            [(i, tiles, quads_gdf, tile_meta, None)
+             for i, tiles, quads_gdf, tile_meta in items]
+        )
+
+
+def _process_tile_stack(i, tiles, tile_quads, tile_metas):
+    dates = list(tile_metas)
+    meta = {**tile_metas[dates[0]], "date": "stack"}
+    metrics = meta.get('metrics') or Metrics()
+    logger = logging.getLogger("maputils") if meta['log'] else None
+    tile = tiles.iloc[[int(i)]]
+    tile_id = int(float(tile['tile'].values.flatten()[0]))
+
+    record, dst_img, dst_cog = _start_tile(tile_id, "stack", meta, metrics,
+                                           logger)
+    record["dates"] = ";".join(dates)
+    if "status" in record:
+        return record
+
+    # each date is retiled to temp_dir, then copied into its bands
+    date_imgs = {}
+    for date in dates:
+        date_img = get_tempfile_name(meta['temp_dir'],
+                                     f"tile{tile_id}_{date}.tif")
+        fields = _retile_date(i, tile, tile_quads, date_img, tile_metas[date],
+                              metrics, logger)
+        if "status" not in fields:
+            date_imgs[date] = date_img
+        elif fields['status'] == "error":
+            for path in date_imgs.values():
+                os.remove(path)
+            return {**record, **fields}
+    if not date_imgs:
+        return {**record, "status": "empty"}
+
+    nbands = meta['nbands']
+    with rasterio.open(next(iter(date_imgs.values()))) as src:
+        profile = src.profile
+    profile.update(count=nbands * len(dates))
+    with metrics.span("stack"), rasterio.open(dst_img, "w", **profile) as dst:
+        for d, date in enumerate(dates):
+            bands = list(range(d * nbands + 1, (d + 1) * nbands + 1))
+            for b, band in enumerate(bands, 1):
+                dst.set_band_description(band, f"{date}_b{b}")
+            if date not in date_imgs:
+                continue
+            with rasterio.open(date_imgs[date]) as src:
+                dst.write(src.read(), bands)
+            os.remove(date_imgs[date])
+    return _finish_tile({**record, "missing": len(dates) - len(date_imgs)},
+                        dst_img, dst_cog, nbands * len(dates), meta, metrics,
+                        logger)
+
+
+def _process_tile(i, tiles, quads_gdf, tile_meta, tile_quads=None):
+    metrics = tile_meta.get('metrics') or Metrics()
+    logger = logging.getLogger("maputils") if tile_meta['log'] else None
     tile = tiles.iloc[[int(i)]]
+    tile_id = int(float(tile['tile'].values.flatten()[0]))
+
+    record, dst_img, dst_cog = _start_tile(tile_id, tile_meta['date'],
+                                           tile_meta, metrics, logger)
+    if "status" in record:
+        return record
+
+    if tile_quads is None:
+        tile_quads = get_tile_quads(tile, quads_gdf)
+    fields = _retile_date(i, tile, tile_quads, dst_img, tile_meta, metrics,
+                          logger)
+    if "status" in fields:
+        return {**record, **fields}
+    return _finish_tile({**record, **fields}, dst_img, dst_cog,
+                        tile_meta['nbands'], tile_meta, metrics, logger)
+
+
+def get_tile_quads(tile, quads_gdf):
+    """
+    Quads a tile overlaps
 
+    Parameters:
+    ----------
+    tile: GeoDataFrame
+        One tile
+    quads_gdf: GeoDataFrame
+        Quad catalog, of one or several dates
+
+    Returns
+    -------
+    GeoDataFrame of the overlapping quads
+    """
     # Reproject selected tile to quads.crs and join
     tiles_int = sjoin(tile.to_crs(quads_gdf.crs), quads_gdf, how='left')
+    return quads_gdf[quads_gdf['file'].isin(tiles_int['file'])]
 
-    # Name output file paths
-    tile_id = int(float(tile['tile'].values.flatten()[0]))
-    tile_id_str = f"{tile_id}"
-    dst_img = re.sub('<tile_dir>', tile_meta['tile_dir'], 
-                     tile_meta['dst_img_pt'])
-    dst_img = re.sub('<tile_id>', tile_id_str, dst_img)
-    dst_img = re.sub('<date>', tile_meta['date'], dst_img)
-    dst_cog = re.sub('.tif', '_cog.tif', dst_img)
+
+def get_tiles_quads(tiles, quads_gdf):
+    """
+    Quads each tile overlaps, from one join
+
+    Parameters:
+    ----------
+    tiles: GeoDataFrame
+        Tiles
+    quads_gdf: GeoDataFrame
+        Quad catalog with 'file', 'tile' and 'date' columns
+
+    Returns
+    -------
+    dict of the position of each tile in tiles to a list of the
+    (file, quad id, date) of its quads
+    """
+    joined = sjoin(
+        tiles.to_crs(quads_gdf.crs)[['geometry']].reset_index(drop=True),
+        quads_gdf[['geometry', 'file', 'tile', 'date']], how='inner'
+    )
+    tile_quads = {}
+    for i, file, quad_id, date in zip(joined.index, joined['file'],
+                                      joined['tile'], joined['date']):
+        tile_quads.setdefault(i, []).append((file, str(quad_id), date))
+    return tile_quads
+
+
+def _batches(items, size):
+    """Lists of size items, taken from items as they are needed"""
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _error_record(i, tiles, date, tile_meta, e):
+    """Record of a tile that failed before _start_tile made its record"""
+    tile_id = int(float(tiles['tile'].iloc[int(i)]))
+    dst_cog = get_tile_path(tile_id, date, tile_meta['tile_dir'],
+                            tile_meta['dst_img_pt'])[1]
+    return {"tile": tile_id, "date": date, "path": dst_cog,
+            "status": "error", "error": repr(e)}
+
+
+def _start_tile(tile_id, date, tile_meta, metrics, logger):
+    """Output paths and record of a tile, with a status if it is done"""
+    verbose, log = tile_meta['verbose'], tile_meta['log']
+    dst_img, dst_cog = get_tile_path(tile_id, date, tile_meta['tile_dir'],
+                                     tile_meta['dst_img_pt'])
+    # returned to the retiler for its errors and manifest
+    record = {"tile": tile_id, "date": date, "path": dst_cog}
+    if tile_meta.get('remote'):
+        # build in temp_dir, the retiler uploads to dst_cog
+        dst_img = os.path.join(tile_meta['temp_dir'],
+                               os.path.basename(dst_img))
+        dst_cog = os.path.join(tile_meta['temp_dir'],
+                               os.path.basename(dst_cog))
+        record['local_path'] = dst_cog
+        if os.path.exists(dst_cog):
+            # built by an earlier run whose upload did not finish
+            if os.path.exists(dst_img):
+                os.remove(dst_img)
+            return {**record, "status": "written"}, dst_img, dst_cog
 
     # Check if files already exist
     if os.path.exists(dst_img) and os.path.exists(dst_cog):
         os.remove(dst_img)
-        return
+        return {**record, "status": "exists"}, dst_img, dst_cog
 
     if os.path.exists(dst_cog):
         progress_reporter(f"...{tile_id} exists, skipped", verbose, 
-                          log, logger)
-        return
+                          log, logger, logging.DEBUG)
+        metrics.count("tiles_skipped")
+        return {**record, "status": "exists"}, dst_img, dst_cog
+    return record, dst_img, dst_cog
+
 
-    quads_int = quads_gdf[
-        quads_gdf['file'].isin(tiles_int['file'])
+def _tile_sources(tile_quads, tile_meta):
+    """Paths GDAL opens the quads of tile_meta['date'] at"""
+    quads_int = tile_quads[tile_quads['date'] == tile_meta['date']] \
+        if 'date' in tile_quads.columns else tile_quads
+    return [
+        get_quad_source(tile_meta['quad_dir'], file, str(quad_id),
+                        tile_meta['date'], tile_meta.get('quad_url_pt'))
+        for file, quad_id in zip(quads_int['file'], quads_int['tile'])
     ]
-    if len(quads_int['file']) > 1:
-        image_list = [f"{tile_meta['quad_dir']}/{file}" 
-                      for file in quads_int['file']]
-    elif len(quads_int['file']) == 1: 
-        image_list = f"{tile_meta['quad_dir']}/{quads_int['file'].values[0]}"
+
+
+def _warp_threads(gdal_options):
+    warp_threads = gdal_options.get('GDAL_NUM_THREADS', '1')
+    return os.cpu_count() if warp_threads == 'ALL_CPUS' \
+        else int(warp_threads)
+
+
+def _retile_date(i, tile, tile_quads, dst_img, tile_meta, metrics, logger):
+    """Retile the quads of tile_meta['date'] into dst_img
+
+    Returns the fields to add to the record, with a status unless dst_img
+    was written
+    """
+    verbose, log = tile_meta['verbose'], tile_meta['log']
+    gdal_options = tile_meta.get('gdal_options') or {}
+    sources = _tile_sources(tile_quads, tile_meta)
+    if len(sources) > 1:
+        image_list = sources
+    elif len(sources) == 1:
+        image_list = sources[0]
     else:
         progress_reporter(f"{i}, empty quads_int['file']", verbose,
-                          log, logger)
-        # errors.append((tile_id, 'empty'))
-        return
+                          log, logger, logging.DEBUG)
+        return {"status": "empty"}
 
     # get transform from unprojected tiles    
     # poly = tiles[tiles['tile'].isin(tile['tile'])]
     # transform = dst_transform(poly)
-    transform = dst_transform(tile)
+    transform = dst_transform(tile, tile_meta.get('dst_res') or DST_RES)
+    warp_threads = _warp_threads(gdal_options)
 
     # Retile
     progress_reporter(f"Processing tile {dst_img}", 
-                      verbose, log, logger)
+                      verbose, log, logger, logging.DEBUG)
     try:
-        reproject_retile_image(
-            image_list, transform, tile_meta['dst_width'], 
+        stats = reproject_retile_image(
+            image_list, transform, tile_meta['dst_width'],
             tile_meta['dst_height'], tile_meta['nbands'], 
             tile_meta['dst_crs'], dst_img, tile_meta['temp_dir'], 
-            inmemory=False, verbose=verbose, log=log
+            inmemory=False, verbose=verbose, log=log,
+            warp_mem_limit=tile_meta.get('warp_mem_mb', 0),
+            num_threads=warp_threads, metrics=metrics,
+            max_fetches=tile_meta.get('quad_fetches', 1),
+            resampling=tile_meta.get('resampling', "cubic"),
+            use_overviews=tile_meta.get('use_overviews', True),
+            stats=tile_meta.get('stats'),
+            min_coverage=tile_meta.get('min_coverage') or 0
         )
     except Exception as e:
-        progress_reporter(repr(e), verbose, log, logger)
-        # errors.append(repr(e))
+        progress_reporter(repr(e), verbose, log, logger, logging.WARNING)
+        return {"status": "error", "error": repr(e)}
+    return _stats_fields(stats, tile_meta, metrics)
+
+
+def _stats_fields(stats, tile_meta, metrics):
+    """Record fields of a tile's statistics, 'empty' below min_coverage"""
+    if stats is None:
+        return {}
+    if stats['coverage'] < (tile_meta.get('min_coverage') or 0):
+        metrics.count("tiles_below_coverage")
+        return {"status": "empty", "stats": stats}
+    return {"stats": stats}
 
-    # cogification
-    cmd = ['rio', 'cogeo', 'create', '-b', '1,2,3,4', dst_img, 
-           dst_cog]
-    p = run(cmd, capture_output=True)
+
+def _finish_tile(record, dst_img, dst_cog, count, tile_meta, metrics,
+                 logger):
+    """Convert dst_img with count bands to the COG dst_cog"""
+    verbose, log = tile_meta['verbose'], tile_meta['log']
+    gdal_options = tile_meta.get('gdal_options') or {}
+    # cogification, with the same GDAL options as this process
+    cog_env = {**os.environ,
+               **{k: str(v) for k, v in gdal_options.items()}}
+    bands = ",".join(str(b) for b in range(1, count + 1))
+    cmd = ['rio', 'cogeo', 'create', '-b', bands, dst_img, dst_cog]
+    with metrics.span("cogify"):
+        p = run(cmd, capture_output=True, env=cog_env)
     msg = p.stderr.decode().split('\n')
-    progress_reporter(f'...{msg[-2]}', verbose, log, logger)
+    progress_reporter(f'...{msg[-2]}', verbose, log, logger, logging.DEBUG)
 
     cmd = ['rio', 'cogeo', 'validate', dst_cog]
-    p = run(cmd, capture_output = True)
+    p = run(cmd, capture_output = True, env=cog_env)
     msg = p.stdout.decode().split('\n')
-    progress_reporter(f'...{msg[0]}', verbose, log, logger)
+    progress_reporter(f'...{msg[0]}', verbose, log, logger, logging.DEBUG)
 
     if os.path.exists(f"{dst_cog}"):
+        nbytes = os.path.getsize(dst_cog)
+        metrics.count("tiles_written")
+        metrics.count("tile_bytes", nbytes)
         if os.path.exists(f"{dst_img}"):
-            os.remove(dst_img)
\ No newline at end of file
+            os.remove(dst_img)
+        return {**record, "status": "written", "bytes": nbytes}
+    return {**record, "status": "error", "error": "cog not created"}
+
+
+def _read_tile(i, tiles, quads_gdf, tile_meta, tile_quads, metrics, logger):
+    """Reader stage of _process_tiles_pipelined
+
+    Returns the record, the output paths and the tile's grid, and the
+    mosaic and its profile, or None for them when the record has a status
+    """
+    verbose, log = tile_meta['verbose'], tile_meta['log']
+    tile = tiles.iloc[[int(i)]]
+    tile_id = int(float(tile['tile'].values.flatten()[0]))
+    record, dst_img, dst_cog = _start_tile(tile_id, tile_meta['date'],
+                                           tile_meta, metrics, logger)
+    transform = dst_transform(tile, tile_meta.get('dst_res') or DST_RES)
+    grid = (transform, tile_meta['dst_width'], tile_meta['dst_height'],
+            tile_meta['dst_crs'])
+    if "status" in record:
+        return record, dst_img, dst_cog, grid, None, None
+    if tile_quads is None:
+        tile_quads = get_tile_quads(tile, quads_gdf)
+    sources = _tile_sources(tile_quads, tile_meta)
+    if not sources:
+        progress_reporter(f"{i}, empty quads_int['file']", verbose,
+                          log, logger, logging.DEBUG)
+        return {**record, "status": "empty"}, dst_img, dst_cog, grid, None, \
+            None
+
+    def try_open_image(image):
+        try:
+            return open_source(image, *grid, tile_meta.get('use_overviews',
+                                                           True))
+        except Exception:
+            progress_reporter(f'..file not found: {image}', verbose, log,
+                              logger, logging.WARNING)
+            return None
+
+    try:
+        with metrics.span("read"), ExitStack() as stack:
+            with ThreadPoolExecutor(
+                    max(tile_meta.get('quad_fetches', 1), 1)) as pool:
+                images = [stack.enter_context(src) for src in
+                          pool.map(try_open_image, sources)
+                          if src is not None]
+            if not images:
+                raise rasterio.errors.RasterioIOError(
+                    f"No quads of tile {tile_id} could be opened")
+            mosaic, profile = read_mosaic(images, *grid, metrics)
+    except Exception as e:
+        progress_reporter(repr(e), verbose, log, logger, logging.WARNING)
+        return {**record, "status": "error", "error": repr(e)}, dst_img, \
+            dst_cog, grid, None, None
+    return record, dst_img, dst_cog, grid, mosaic, profile
+
+
+def _process_tiles_pipelined(jobs):
+    """Retile jobs with read-ahead and write-behind threads
+
+    Each job is (i, tiles, quads_gdf, tile_meta, tile_quads), with
+    tile_quads None to join the tile with quads_gdf. While this thread
+    warps a tile, a reader thread merges the quads of the next tiles into
+    memory and a writer thread writes and cogifies the previous ones. Each
+    queue holds at most tile_meta['pipeline_depth'] tiles, which bounds the
+    mosaics and outputs held in memory.
+
+    Returns the records of the jobs, in order
+    """
+    meta = jobs[0][3]
+    depth = max(meta.get('pipeline_depth') or 1, 1)
+    metrics = meta.get('metrics') or Metrics()
+    logger = logging.getLogger("maputils") if meta['log'] else None
+    gdal_options = meta.get('gdal_options') or {}
+    read_queue = queue.Queue(depth)
+    write_queue = queue.Queue(depth)
+    records = [None] * len(jobs)
+    # set when this thread stops early, so the reader stops too
+    stop = threading.Event()
+
+    def reader():
+        try:
+            with gdal_env_context(gdal_options):
+                for n, job in enumerate(jobs):
+                    if stop.is_set():
+                        break
+                    try:
+                        read = _read_tile(*job, metrics, logger)
+                    except Exception as e:
+                        # raised outside the read, e.g. by _start_tile. The
+                        # next jobs still run
+                        i, tiles, _, tile_meta, _ = job
+                        progress_reporter(repr(e), tile_meta['verbose'],
+                                          tile_meta['log'], logger,
+                                          logging.WARNING)
+                        read = (_error_record(i, tiles, tile_meta['date'],
+                                              tile_meta, e),
+                                None, None, None, None, None)
+                    read_queue.put((n, job[3]) + read)
+        finally:
+            read_queue.put(None)
+
+    def writer():
+        with gdal_env_context(gdal_options):
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    return
+                n, tile_meta, record, dst_img, dst_cog, out, kwargs = item
+                try:
+                    with metrics.span("write"):
+                        with rasterio.open(dst_img, "w", **kwargs) as dst:
+                            dst.write(out)
+                    records[n] = _finish_tile(
+                        record, dst_img, dst_cog, tile_meta['nbands'],
+                        tile_meta, metrics, logger
+                    )
+                except Exception as e:
+                    progress_reporter(repr(e), tile_meta['verbose'],
+                                      tile_meta['log'], logger,
+                                      logging.WARNING)
+                    records[n] = {**record, "status": "error",
+                                  "error": repr(e)}
+
+    threads = [threading.Thread(target=reader, daemon=True),
+               threading.Thread(target=writer, daemon=True)]
+    for thread in threads:
+        thread.start()
+    read_done = False
+    try:
+        while True:
+            item = read_queue.get()
+            if item is None:
+                read_done = True
+                break
+            n, tile_meta, record, dst_img, dst_cog, grid, mosaic, profile = \
+                item
+            if mosaic is None:
+                records[n] = record
+                continue
+            progress_reporter(f"Processing tile {dst_img}",
+                              tile_meta['verbose'], tile_meta['log'], logger,
+                              logging.DEBUG)
+            resampling = tile_meta.get('resampling', "cubic")
+            try:
+                with metrics.span("reproject"):
+                    out, kwargs = warp_mosaic(
+                        mosaic, profile, *grid,
+                        resampling=Resampling[resampling]
+                        if isinstance(resampling, str) else resampling,
+                        warp_mem_limit=tile_meta.get('warp_mem_mb', 0),
+                        num_threads=_warp_threads(gdal_options)
+                    )
+            except Exception as e:
+                progress_reporter(repr(e), tile_meta['verbose'],
+                                  tile_meta['log'], logger, logging.WARNING)
+                records[n] = {**record, "status": "error", "error": repr(e)}
+                continue
+            del item, mosaic
+            stats = None
+            if tile_meta.get('stats') is not None or \
+                    tile_meta.get('min_coverage'):
+                try:
+                    with metrics.span("stats"):
+                        stats = compute_tile_stats(
+                            out, kwargs.get('nodata'),
+                            **(tile_meta.get('stats') or {})
+                        )
+                except Exception as e:
+                    progress_reporter(repr(e), tile_meta['verbose'],
+                                      tile_meta['log'], logger,
+                                      logging.WARNING)
+                    records[n] = {**record, "status": "error",
+                                  "error": repr(e)}
+                    continue
+            fields = _stats_fields(stats, tile_meta, metrics)
+            if "status" in fields:
+                records[n] = {**record, **fields}
+                continue
+            write_queue.put((n, tile_meta, {**record, **fields}, dst_img,
+                             dst_cog, out, kwargs))
+    finally:
+        # the reader may be waiting on a full queue
+        stop.set()
+        while not read_done:
+            read_done = read_queue.get() is None
+        write_queue.put(None)
+        for thread in threads:
+            thread.join()
+    return records
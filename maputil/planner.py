@@ -0,0 +1,299 @@
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from geopandas.tools import sjoin
+from .planet_downloader import get_quad_path, get_tile_path
+from .metrics import summarize_metrics
+from .sharding import select_tile_shard
+
+# Planet basemap quads: 4096 x 4096 pixels at Web Mercator zoom 15
+QUAD_SIZE = 4096
+QUAD_RES = 4.777314267823516
+
+
+def plan_downloads(quads_gdf, quad_dir, quad_name, nbands=4,
+                   quad_size=QUAD_SIZE, tiles=None, dates=None):
+    """Quads the tiles to retile need and their estimated size
+
+    Parameters
+    ----------
+    quads_gdf : GeoDataFrame
+        Quad catalog with 'date' and 'file' columns
+    quad_dir : str
+        Directory quads are downloaded to
+    quad_name : str
+        Quad file path pattern, see get_quad_path
+    nbands : int
+        Bands per quad
+    quad_size : int
+        Quad width and height in pixels
+    tiles : GeoDataFrame
+        Tiles of the shard. Only quads they overlap are counted, as the
+        retiler only reads those. All quads if None
+    dates : list
+        Dates to retile. Quads of other dates are not counted. All dates if
+        None
+
+    Returns:
+    --------
+    dict with the number of quads, those already on disk and to download,
+    and the estimated GB to download. The size per quad is the mean of the
+    quads on disk, or the uncompressed uint16 size if there are none
+    """
+    if dates is not None:
+        quads_gdf = quads_gdf[quads_gdf['date'].isin(dates)]
+    if tiles is not None:
+        area = tiles.to_crs(quads_gdf.crs)[['geometry']]
+        quads_gdf = quads_gdf[quads_gdf.index.isin(
+            sjoin(quads_gdf, area, how='inner').index
+        )]
+    paths = [get_quad_path(quad_name, quad_dir, f) for f in quads_gdf['file']]
+    sizes = [os.path.getsize(p) for p in paths if os.path.isfile(p)]
+    quad_bytes = np.mean(sizes) if sizes else quad_size ** 2 * nbands * 2
+    missing = len(paths) - len(sizes)
+    return {
+        "quads": len(paths),
+        "quads_on_disk": len(sizes),
+        "quads_to_download": missing,
+        "quad_mb": quad_bytes / 2 ** 20,
+        "quad_mb_measured": bool(sizes),
+        "download_gb": missing * quad_bytes / 2 ** 30,
+    }
+
+
+def plan_tiles(tiles, quads_gdf, dates, tile_dir, dst_img_pt):
+    """Tiles retiler would produce and how many quads each needs
+
+    Parameters
+    ----------
+    tiles : GeoDataFrame
+        Tiles with a 'tile' column
+    quads_gdf : GeoDataFrame
+        Quad catalog with 'date' and 'file' columns
+    dates : list
+        Dates to retile
+    tile_dir : str
+        Output directory. Outputs in S3 are not checked, so that planning
+        stays offline
+    dst_img_pt : str
+        Output path pattern, see get_tile_path
+
+    Returns:
+    --------
+    dict with the number of tile outputs, those already written and to do,
+    outputs without quads, and the distribution of quads per tile
+    """
+    tiles_prj = tiles[["tile", "geometry"]].reset_index(drop=True)\
+        .to_crs(quads_gdf.crs)
+    remote = tile_dir.startswith("s3://") or dst_img_pt.startswith("s3://")
+    outputs = existing = empty = 0
+    quads_per_tile = []
+    for date in dates:
+        quads = quads_gdf[quads_gdf['date'] == date]
+        joined = sjoin(tiles_prj, quads[['geometry']], how='left')
+        counts = joined['index_right'].groupby(level=0).count()
+        outputs += len(tiles)
+        empty += int((counts == 0).sum())
+        quads_per_tile.extend(counts[counts > 0].tolist())
+        if not remote:
+            existing += sum(
+                os.path.exists(get_tile_path(t, date, tile_dir,
+                                             dst_img_pt)[1])
+                for t in tiles['tile']
+            )
+    quads_per_tile = np.array(quads_per_tile, dtype="int64")
+    return {
+        "tiles": len(tiles),
+        "dates": len(dates),
+        "outputs": outputs,
+        "outputs_existing": None if remote else existing,
+        "outputs_to_do": outputs - empty - existing,
+        "outputs_without_quads": empty,
+        "quads_per_tile": {
+            str(n): int((quads_per_tile == n).sum())
+            for n in np.unique(quads_per_tile)
+        },
+    }
+
+
+def estimate_worker_resources(tiles, dst_width, dst_height, nbands,
+                              gdal_options=None, warp_mem_mb=0,
+                              quad_res=QUAD_RES):
+    """Temp disk and RAM one retile worker needs for its largest tile
+
+    The largest tile in source pixels sets the mosaic. A worker holds the
+    uint16 mosaic, the float64 warp canvas and its int16 copy in memory,
+    plus the GDAL block cache and warp memory, and keeps the temporary
+    mosaic, the GeoTIFF and the COG on disk.
+
+    Parameters
+    ----------
+    tiles : GeoDataFrame
+        Tiles to retile
+    dst_width : int
+        Width of output tiles
+    dst_height : int
+        Height of output tiles
+    nbands : int
+        Number of bands
+    gdal_options : dict
+        Options from get_gdal_options for the worker
+    warp_mem_mb : int
+        Warp memory per worker
+    quad_res : float
+        Quad resolution in metres
+
+    Returns:
+    --------
+    dict with temp_disk_mb and ram_mb per worker
+    """
+    bounds = tiles.to_crs(epsg=3857).bounds
+    src_pixels = ((bounds['maxx'] - bounds['minx']) / quad_res) * \
+        ((bounds['maxy'] - bounds['miny']) / quad_res)
+    mosaic_mb = float(src_pixels.max()) * nbands * 2 / 2 ** 20 \
+        if len(tiles) else 0.0
+    dst_mb = dst_width * dst_height * nbands * 2 / 2 ** 20
+    cache_mb = int((gdal_options or {}).get("GDAL_CACHEMAX", 0))
+    return {
+        "temp_disk_mb": mosaic_mb + 2 * dst_mb,
+        "ram_mb": mosaic_mb + 5 * dst_mb + cache_mb + warp_mem_mb,
+    }
+
+
+def estimate_wall_time(metrics_path, tiles_to_do, download_gb):
+    """Wall time of a run from the throughput of the last recorded run
+
+    Parameters
+    ----------
+    metrics_path : str
+        Metrics file of earlier runs
+    tiles_to_do : int
+        Tile outputs to retile
+    download_gb : float
+        GB to download
+
+    Returns:
+    --------
+    dict with retile_s and download_s, None where no throughput has been
+    recorded. Download throughput is taken over the wall time of the
+    downloads, which run download_threads at once
+    """
+    estimate = {"retile_s": None, "download_s": None}
+    if not metrics_path or not os.path.isfile(metrics_path):
+        return estimate
+    summary = summarize_metrics(metrics_path)
+    tiles_per_s = summary["gauges"].get("retile_tiles_per_s")
+    if tiles_per_s:
+        estimate["retile_s"] = tiles_to_do / tiles_per_s
+    # the 'download' spans of concurrent downloads overlap, their sum is
+    # not the time taken. Runs without download_all spans downloaded one
+    # quad at a time
+    download_s = summary["stages"].get(
+        "download_all", summary["stages"].get("download", {})
+    ).get("total_s")
+    download_bytes = summary["counters"].get("download_bytes")
+    if download_s and download_bytes:
+        estimate["download_s"] = download_gb * 2 ** 30 / \
+            (download_bytes / download_s)
+    return estimate
+
+
+def plan_run(quads_gdf, tiles, dates, quad_dir, quad_name, tile_dir,
+             dst_img_pt, dst_width, dst_height, nbands, num_cores=1,
+             gdal_options=None, warp_mem_mb=0, metrics_path=None,
+             shard_index=0, shard_count=1):
+    """Estimate the work of a download and retile run without doing it
+
+    Only the catalog, the tile file and the outputs on disk are read, no
+    rasters and no network.
+
+    Parameters
+    ----------
+    quads_gdf : GeoDataFrame
+        Quad catalog
+    tiles : str, GeoDataFrame or iterable
+        Tile file, tiles, or chunks of tiles from iter_tile_grid
+    dates : list
+        Dates to retile
+    quad_dir, quad_name, tile_dir, dst_img_pt, dst_width, dst_height, nbands
+        As in the config
+    num_cores : int
+        Retile workers per node
+    gdal_options : dict
+        Options from get_gdal_options for num_cores workers
+    warp_mem_mb : int
+        Warp memory per worker
+    metrics_path : str
+        Metrics of earlier runs, for throughput
+    shard_index : int
+        Shard to plan
+    shard_count : int
+        Number of shards
+
+    Returns:
+    --------
+    plan: dict
+        'downloads', 'tiles', 'worker' and 'wall_time' sections
+    """
+    if isinstance(tiles, str):
+        tiles = gpd.read_file(tiles)
+    if isinstance(tiles, gpd.GeoDataFrame):
+        tiles = [tiles]
+    # shards of chunks are taken per chunk, as retiler does
+    chunks = [
+        select_tile_shard(chunk.astype({"tile": "str"}), shard_index,
+                          shard_count)
+        for chunk in tiles
+    ]
+    tiles = pd.concat(chunks, ignore_index=True) if chunks else \
+        gpd.GeoDataFrame({"tile": []}, geometry=[], crs="EPSG:4326")
+    downloads = plan_downloads(quads_gdf, quad_dir, quad_name, nbands,
+                               tiles=tiles, dates=dates)
+    tile_plan = plan_tiles(tiles, quads_gdf, dates, tile_dir, dst_img_pt)
+    worker = estimate_worker_resources(tiles, dst_width, dst_height, nbands,
+                                       gdal_options, warp_mem_mb)
+    worker["workers"] = num_cores
+    worker["node_ram_mb"] = worker["ram_mb"] * num_cores
+    worker["node_temp_disk_mb"] = worker["temp_disk_mb"] * num_cores
+    return {
+        "shard": f"{shard_index} of {shard_count}",
+        "downloads": downloads,
+        "tiles": tile_plan,
+        "worker": worker,
+        "wall_time": estimate_wall_time(metrics_path,
+                                        tile_plan["outputs_to_do"],
+                                        downloads["download_gb"]),
+    }
+
+
+def format_plan(plan):
+    """Render a plan from plan_run as text"""
+    d, t, w, wt = (plan["downloads"], plan["tiles"], plan["worker"],
+                   plan["wall_time"])
+
+    def hours(s):
+        return "unknown (no recorded throughput)" if s is None \
+            else f"{s / 3600:.1f} h"
+
+    existing = "unknown (S3)" if t["outputs_existing"] is None \
+        else t["outputs_existing"]
+    size = "measured" if d["quad_mb_measured"] else "uncompressed"
+    lines = [
+        f"Plan for shard {plan['shard']}",
+        f"Quads: {d['quads']}, {d['quads_on_disk']} on disk, "
+        f"{d['quads_to_download']} to download "
+        f"({d['download_gb']:.1f} GB at {d['quad_mb']:.0f} MB, {size})",
+        f"Tiles: {t['tiles']} x {t['dates']} dates = {t['outputs']} outputs,"
+        f" {existing} existing, {t['outputs_without_quads']} without quads,"
+        f" {t['outputs_to_do']} to do",
+        "Quads per tile: " + ", ".join(
+            f"{n}: {c}" for n, c in t["quads_per_tile"].items()
+        ),
+        f"Per worker: {w['ram_mb']:.0f} MB RAM, {w['temp_disk_mb']:.0f} MB "
+        f"temp disk; {w['workers']} workers: {w['node_ram_mb']:.0f} MB RAM, "
+        f"{w['node_temp_disk_mb']:.0f} MB temp disk",
+        f"Download time: {hours(wt['download_s'])}",
+        f"Retile time: {hours(wt['retile_s'])}",
+    ]
+    return "\n".join(lines)
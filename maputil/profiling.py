@@ -0,0 +1,411 @@
+import os
+import sys
+import json
+import glob
+import math
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# profiles of this process, by file name
+_profiles = {}
+# per label, calls seen and calls profiled in this process
+_samples = defaultdict(lambda: [0, 0])
+# (call site, GDAL operation) to [calls, seconds]
+_gdal = defaultdict(lambda: [0, 0.0])
+_lock = threading.Lock()
+_local = threading.local()
+_recording = 0
+# (owner, name, attribute before the timer) of the installed GDAL timers,
+# and the profiles using them
+_timers = []
+_timer_users = 0
+_MISSING = object()
+
+
+def _reset_after_fork():
+    """A forked Pool worker starts its own profiles"""
+    global _lock, _local, _recording, _timer_users
+    for profiler in _profiles.values():
+        # the parent's profiler would otherwise keep running in the worker
+        profiler.disable()
+    _profiles.clear()
+    _restore_gdal_timers()
+    _timer_users = 0
+    _samples.clear()
+    _gdal.clear()
+    _lock = threading.Lock()
+    _local = threading.local()
+    _recording = 0
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def profile_options(profile, run_id=None):
+    """
+    Normalize the profile config section
+
+    Parameters:
+    ----------
+    profile: dict
+        The profile config section. Profiling is off unless it has a 'dir'
+    run_id: str
+        Names the profile files of the run, e.g. Metrics.run_id so that
+        they match the metrics. Defaults to the start time and PID
+
+    Returns
+    -------
+    dict with 'dir', 'run', 'stages', 'sample', 'max_samples' and 'top', or
+    None if profiling is off. It is passed as is to Pool workers
+    """
+    if not profile or not profile.get("dir"):
+        return None
+    return {
+        "dir": profile["dir"],
+        "run": run_id or "{}-{}".format(time.strftime("%Y%m%dT%H%M%S"),
+                                        os.getpid()),
+        "stages": profile.get("stages", True),
+        "sample": float(profile.get("sample", 0.05)),
+        "max_samples": int(profile.get("max_samples", 20)),
+        "top": int(profile.get("top", 30)),
+    }
+
+
+def _call_site():
+    """file:line function of the innermost maputil frame calling GDAL"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        path = frame.f_code.co_filename
+        if path.startswith(_PACKAGE_DIR) and path != __file__:
+            return "{}:{} {}".format(os.path.basename(path), frame.f_lineno,
+                                     frame.f_code.co_name)
+        frame = frame.f_back
+    return "<outside maputil>"
+
+
+def _gdal_timer(func, op):
+    def _gdal_call(*args, **kwargs):
+        # nested calls, e.g. the reads of a merge, count once
+        if not _recording or getattr(_local, "depth", 0):
+            return func(*args, **kwargs)
+        site = _call_site()
+        _local.depth = 1
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - t0
+            _local.depth = 0
+            with _lock:
+                entry = _gdal[(site, op)]
+                entry[0] += 1
+                entry[1] += elapsed
+    _gdal_call.__wrapped__ = func
+    return _gdal_call
+
+
+def _install_gdal_timers():
+    """
+    Time rasterio calls into GDAL per call site while a profile records
+
+    rasterio calls GDAL from compiled code that cProfile does not see, so
+    its time would be counted as the own time of whichever maputil
+    function made the call. The rio cogeo subprocesses that make COGs are
+    timed as well, they show up in the profiles as a poll. The timers are
+    removed by _remove_gdal_timers when the last profile ends.
+    """
+    global _timer_users
+    with _lock:
+        _timer_users += 1
+        if _timers:
+            return
+        _patch_gdal_calls()
+
+
+def _patch_gdal_calls():
+    import rasterio
+    import rasterio.features
+    import rasterio.io
+    import rasterio.vrt
+    import rasterio.warp
+    import subprocess
+
+    targets = [(rasterio, "open", "open"),
+               (rasterio.warp, "_reproject", "reproject"),
+               (rasterio.features, "_rasterize", "rasterize"),
+               (rasterio.io.DatasetReader, "read", "read"),
+               (rasterio.io.DatasetReader, "read_masks", "read"),
+               (rasterio.vrt.WarpedVRT, "read", "warped_read"),
+               (rasterio.vrt.WarpedVRT, "read_masks", "warped_read"),
+               (subprocess.Popen, "communicate", "subprocess")]
+    for cls in (rasterio.io.DatasetWriter, rasterio.io.BufferedDatasetWriter):
+        # the GTiff and COG drivers write most of the file on close
+        targets += [(cls, "read", "read"), (cls, "write", "write"),
+                    (cls, "close", "write")]
+    for owner, name, op in targets:
+        # inherited methods are timed on the subclass and deleted again
+        _timers.append((owner, name, vars(owner).get(name, _MISSING)))
+        setattr(owner, name, _gdal_timer(getattr(owner, name), op))
+
+
+def _restore_gdal_timers():
+    while _timers:
+        owner, name, original = _timers.pop()
+        if original is _MISSING:
+            delattr(owner, name)
+        else:
+            setattr(owner, name, original)
+
+
+def _remove_gdal_timers():
+    """Restore the rasterio and subprocess calls when no profile records"""
+    global _timer_users
+    with _lock:
+        _timer_users -= 1
+        if not _timer_users:
+            _restore_gdal_timers()
+
+
+def _profile_path(options, label):
+    return os.path.join(options["dir"], "{}-{}-{}.prof".format(
+        options["run"], label, os.getpid()))
+
+
+def _dump(options, path, profiler):
+    profiler.dump_stats(path)
+    with _lock:
+        record = {
+            "pid": os.getpid(),
+            "samples": {k: v[1] for k, v in _samples.items()},
+            "gdal": [[site, op, calls, seconds]
+                     for (site, op), (calls, seconds) in _gdal.items()],
+        }
+    tmp = os.path.join(options["dir"], "{}-gdal-{}.json.tmp".format(
+        options["run"], os.getpid()))
+    with open(tmp, "w") as f:
+        json.dump(record, f)
+    os.replace(tmp, tmp[:-len(".tmp")])
+
+
+@contextmanager
+def _profiling(options, label):
+    global _recording
+    os.makedirs(options["dir"], exist_ok=True)
+    path = _profile_path(options, label)
+    profiler = _profiles.setdefault(path, cProfile.Profile())
+    _install_gdal_timers()
+    with _lock:
+        _recording += 1
+    _local.active = True
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _local.active = False
+        with _lock:
+            _recording -= 1
+        _remove_gdal_timers()
+        # written after every call, since Pool workers are terminated
+        # without running exit handlers
+        _dump(options, path, profiler)
+
+
+@contextmanager
+def profile_stage(options, stage):
+    """
+    Profile a pipeline stage of the parent process, e.g. 'retile'
+
+    Writes <dir>/<run>-<stage>-<pid>.prof. Only the calling thread is
+    profiled, the GDAL time of other threads is still timed.
+
+    Parameters:
+    ----------
+    options: dict
+        From profile_options. Nothing is profiled if None or if its
+        'stages' is false
+    stage: str
+        Name of the stage
+    """
+    if not options or not options["stages"] or \
+            getattr(_local, "active", False):
+        yield
+        return
+    with _profiling(options, stage):
+        yield
+
+
+@contextmanager
+def profile_sample(options, label):
+    """
+    Profile a sample of the calls of a task, e.g. process_tile in Pool
+    workers
+
+    The options travel with the task arguments, so this works in Pool
+    workers of any start method. Each process profiles its first call and
+    evenly spaced calls after it, a fraction options['sample'] of them and
+    at most options['max_samples'], into <dir>/<run>-<label>-<pid>.prof.
+    Calls inside a profiled stage of the same thread are already in its
+    profile.
+
+    Parameters:
+    ----------
+    options: dict
+        From profile_options. Nothing is profiled if None
+    label: str
+        Name of the task
+    """
+    if not options or getattr(_local, "active", False):
+        yield
+        return
+    with _lock:
+        counts = _samples[label]
+        n = counts[0]
+        counts[0] += 1
+        # calls 0, 1 / sample, 2 / sample, ... are sampled
+        sampled = counts[1] < options["max_samples"] and \
+            math.floor(n * options["sample"]) > \
+            math.floor((n - 1) * options["sample"])
+        if sampled:
+            counts[1] += 1
+    if not sampled:
+        yield
+        return
+    with _profiling(options, label):
+        yield
+
+
+def merge_profiles(profile_dir, run_id=None):
+    """
+    Combine the profiles of all processes of a run
+
+    Parameters:
+    ----------
+    profile_dir: str
+        The profile 'dir'
+    run_id: str
+        Run to merge. Defaults to the last run profiled in profile_dir
+
+    Returns
+    -------
+    dict with 'run', 'files', 'stats' mapping each stage or task label to a
+    pstats.Stats over the profiles of all processes, 'samples' mapping
+    task label to its calls profiled in all processes, and 'gdal'
+    mapping (call site, operation) to [calls, seconds]
+    """
+    if run_id is None:
+        gdal_files = sorted(glob.glob(os.path.join(profile_dir, "*-gdal-*.json")),
+                            key=os.path.getmtime)
+        if not gdal_files:
+            return {"run": None, "files": [], "stats": {}, "samples": {},
+                    "gdal": {}}
+        run_id = os.path.basename(gdal_files[-1]).rsplit("-gdal-", 1)[0]
+    files = sorted(glob.glob(os.path.join(profile_dir, f"{run_id}-*.prof")))
+    by_label = defaultdict(list)
+    for path in files:
+        # <run>-<label>-<pid>.prof
+        label = os.path.basename(path)[len(run_id) + 1:].rsplit("-", 1)[0]
+        by_label[label].append(path)
+    samples = defaultdict(int)
+    gdal = defaultdict(lambda: [0, 0.0])
+    for path in glob.glob(os.path.join(profile_dir, f"{run_id}-gdal-*.json")):
+        with open(path, "r") as f:
+            record = json.load(f)
+        for label, profiled in record["samples"].items():
+            samples[label] += profiled
+        for site, op, calls, seconds in record["gdal"]:
+            gdal[(site, op)][0] += calls
+            gdal[(site, op)][1] += seconds
+    return {
+        "run": run_id,
+        "files": files,
+        "stats": {label: pstats.Stats(*paths)
+                  for label, paths in by_label.items()},
+        "samples": dict(samples),
+        "gdal": dict(gdal),
+    }
+
+
+def _short_name(func):
+    path, line, name = func
+    if path == "~":
+        return name  # a built-in
+    for root in sorted(sys.path, key=len, reverse=True):
+        if root and path.startswith(root + os.sep):
+            path = path[len(root) + 1:]
+            break
+    return f"{path}:{line}({name})"
+
+
+def format_profile_report(merged, top=30):
+    """
+    Render merged profiles as a text report of the hot functions and of
+    the GDAL time of each call site
+
+    Parameters:
+    ----------
+    merged: dict
+        From merge_profiles
+    top: int
+        Number of functions and call sites listed
+
+    Returns
+    -------
+    str
+    """
+    lines = [f"Profile of run {merged['run']}: {len(merged['files'])} files"]
+    for label, profiled in sorted(merged["samples"].items()):
+        lines.append(f"  {label}: {profiled} calls profiled")
+    # a stage's own time is mostly waiting for its workers, so stages and
+    # tasks are listed apart
+    for label, stats in sorted(merged["stats"].items()):
+        lines += ["", f"Hot functions of {label} by own time, "
+                  f"{stats.total_tt:.2f} s profiled",
+                  f"{'calls':>10}{'own s':>10}{'cum s':>10}  function"]
+        rows = sorted(stats.stats.items(), key=lambda x: -x[1][2])[:top]
+        for func, (cc, nc, tt, ct, callers) in rows:
+            lines.append(f"{nc:>10}{tt:>10.3f}{ct:>10.3f}  "
+                         f"{_short_name(func)}")
+    if merged["gdal"]:
+        # also counts threads of the profiled calls, e.g. quad opens
+        total = sum(s for _, s in merged["gdal"].values())
+        lines += ["", f"GDAL time by call site, {total:.2f} s",
+                  f"{'calls':>10}{'total s':>10}{'mean s':>10}  call site"]
+        rows = sorted(merged["gdal"].items(), key=lambda x: -x[1][1])[:top]
+        for (site, op), (calls, seconds) in rows:
+            lines.append(f"{calls:>10}{seconds:>10.3f}"
+                         f"{seconds / calls:>10.4f}  {site} [{op}]")
+    return "\n".join(lines)
+
+
+def report_profiles(options):
+    """
+    Print the merged profile report of a run and write it next to the
+    profiles as <dir>/<run>-report.txt
+
+    Parameters:
+    ----------
+    options: dict
+        From profile_options. Nothing is reported if None
+
+    Returns
+    -------
+    Path of the report, or None
+    """
+    if not options or not os.path.isdir(options["dir"]):
+        return None
+    merged = merge_profiles(options["dir"], options["run"])
+    if not merged["files"]:
+        return None
+    report = format_profile_report(merged, options["top"])
+    print(report)
+    path = os.path.join(options["dir"], f"{options['run']}-report.txt")
+    with open(path, "w") as f:
+        f.write(report + "\n")
+    return path
@@ -0,0 +1,212 @@
+import os
+import threading
+from collections import Counter, OrderedDict, deque
+from .metrics import Metrics
+
+
+class QuadCache():
+    """Quads on local disk, kept under a byte budget
+
+    Quads are fetched when a tile needs them and pinned until the tile is
+    done. Each quad counts the pending tiles that still need it. To make
+    room, quads no pending tile needs are deleted first, then the least
+    recently used of the rest, which are fetched again if a later tile
+    needs them. When everything on disk is pinned by tiles in progress, a
+    fetch waits for one of them to finish. A single tile whose quads do not
+    fit in the budget is still let through, so the cache never deadlocks.
+    """
+
+    def __init__(self, quad_dir, budget_bytes, fetch, quad_bytes=128 * 2 ** 20,
+                 metrics=None) -> None:
+        """
+        Parameters:
+        ----------
+        quad_dir: str
+            Directory the quads are kept in
+        budget_bytes: int
+            Bytes the quads may take up on disk
+        fetch: callable
+            Called with a quad, as passed to acquire, and the path to write
+            it to
+        quad_bytes: int
+            Size assumed for a quad before any is on disk
+        metrics: Metrics
+            Records fetches, hits, evictions and the bytes on disk
+        """
+        self.quad_dir = quad_dir
+        self.budget_bytes = budget_bytes
+        self.fetch = fetch
+        self.quad_bytes = quad_bytes
+        self.metrics = metrics or Metrics()
+        self.sizes = OrderedDict()  # file: bytes, least recently used first
+        self.refs = Counter()
+        self.pins = Counter()
+        self.fetching = set()
+        self.fetched = set()
+        self.reserved = 0
+        self.pending = deque()
+        self.cond = threading.Condition()
+        os.makedirs(quad_dir, exist_ok=True)
+
+    def path(self, file):
+        return os.path.join(self.quad_dir, file)
+
+    def need(self, quads):
+        """Count a pending tile for each quad, one entry per tile and quad
+
+        Quads already in quad_dir, e.g. from an earlier run, are taken into
+        the cache.
+        """
+        with self.cond:
+            for quad in quads:
+                file = quad[0]
+                self.refs[file] += 1
+                if file not in self.sizes and os.path.isfile(self.path(file)):
+                    self.sizes[file] = os.path.getsize(self.path(file))
+                    self.sizes.move_to_end(file, last=False)
+
+    def _evict_one(self):
+        unpinned = [f for f in self.sizes if not self.pins[f]]
+        if not unpinned:
+            return False
+        done = [f for f in unpinned if self.refs[f] <= 0]
+        victim = done[0] if done else unpinned[0]
+        os.remove(self.path(victim))
+        del self.sizes[victim]
+        self.metrics.count("quads_evicted", needed=bool(self.refs[victim]))
+        return True
+
+    def _make_room(self, nbytes, own):
+        while sum(self.sizes.values()) + self.reserved + nbytes > \
+                self.budget_bytes:
+            if self._evict_one():
+                continue
+            others = [f for f, n in self.pins.items() if n and f not in own]
+            if not others and not self.fetching:
+                return  # only this tile's quads left, let it through
+            self.cond.wait()
+
+    def acquire(self, quads):
+        """Make a tile's quads available locally and pin them
+
+        Parameters:
+        ----------
+        quads: list
+            (file, quad_id, date) of each quad, passed to fetch
+
+        Returns
+        -------
+        Local paths of the quads
+        """
+        files = [quad[0] for quad in quads]
+        with self.cond:
+            self.pins.update(files)
+        try:
+            for quad in quads:
+                self._get(quad, set(files))
+        except Exception:
+            self.release(quads, done=False)
+            raise
+        return [self.path(file) for file in files]
+
+    def _get(self, quad, own):
+        file = quad[0]
+        with self.cond:
+            while file in self.fetching:
+                self.cond.wait()
+            if file in self.sizes:
+                self.sizes.move_to_end(file)
+                self.metrics.count("quad_cache_hits")
+                return
+            nbytes = max(self.sizes.values(), default=self.quad_bytes)
+            self._make_room(nbytes, own)
+            self.fetching.add(file)
+            self.reserved += nbytes
+        try:
+            self.fetch(quad, self.path(file))
+        finally:
+            with self.cond:
+                self.fetching.discard(file)
+                self.reserved -= nbytes
+                if os.path.isfile(self.path(file)):
+                    self.sizes[file] = os.path.getsize(self.path(file))
+                    self.metrics.count("quads_refetched" if file in
+                                       self.fetched else "quads_fetched")
+                    self.fetched.add(file)
+                self.metrics.gauge("quad_cache_bytes",
+                                   sum(self.sizes.values()))
+                self.cond.notify_all()
+
+    def release(self, quads, done=True):
+        """Unpin a tile's quads, and count the tile as no longer pending
+
+        Parameters:
+        ----------
+        quads: list
+            Quads passed to acquire
+        done: bool
+            If False the tile still needs its quads, e.g. acquire failed
+        """
+        files = [quad[0] for quad in quads]
+        with self.cond:
+            self.pins.subtract(files)
+            if done:
+                self.refs.subtract(files)
+            self.cond.notify_all()
+
+    def acquire_each(self, items, quads_of, on_error=None):
+        """Acquire the quads of each item before yielding it
+
+        Blocking here holds back a Pool's task feeder, so tiles are only
+        handed out as their quads fit on disk. Pair with release_each on
+        the results, which come back in the order of the items. An item
+        whose quads could not be fetched is not yielded, release_each
+        puts its error result in its place.
+
+        Parameters:
+        ----------
+        items: iterable
+            Tasks, e.g. the arguments of process_tile
+        quads_of: callable
+            Quads of an item, see acquire
+        on_error: callable
+            Called with an item and the exception of its fetch, returns
+            the result of the item. Defaults to a record with status
+            'error'
+        """
+        for item in items:
+            quads = quads_of(item)
+            try:
+                self.acquire(quads)
+            except Exception as e:
+                with self.cond:
+                    # the tile is done, its quads are no longer needed
+                    self.refs.subtract(quad[0] for quad in quads)
+                    self.pending.append((
+                        None, on_error(item, e) if on_error else
+                        {"status": "error", "error": repr(e)}
+                    ))
+                continue
+            with self.cond:
+                self.pending.append((quads, None))
+            yield item
+
+    def release_each(self, results):
+        """Release the quads of each item as its result arrives, with the
+        results of the items acquire_each could not fetch in their place"""
+        def failed():
+            # items that failed before the next one yielded
+            while True:
+                with self.cond:
+                    if not self.pending or self.pending[0][0] is not None:
+                        return
+                    _, result = self.pending.popleft()
+                yield result
+
+        for result in results:
+            yield from failed()
+            with self.cond:
+                quads, _ = self.pending.popleft()
+            self.release(quads)
+            yield result
+        yield from failed()
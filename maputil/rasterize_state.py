@@ -0,0 +1,188 @@
+import os
+import json
+import urllib.parse as urlparse
+from collections import defaultdict
+
+# files of a shapefile whose edits change the rasterized labels
+SHAPEFILE_PARTS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+
+def _shapefile_parts(path):
+    """The path and, for a .shp, the paths of its sidecar files"""
+    root, ext = os.path.splitext(path)
+    if ext.lower() != ".shp":
+        return [path]
+    return [path] + [root + part for part in SHAPEFILE_PARTS[1:]]
+
+
+def load_state(state_file, s3_client=None):
+    """Read the rasterization state file
+
+    Parameters
+    ----------
+    state_file : str
+        Local path or s3:// URL of the JSON state file
+    s3_client : boto3.client
+        Client used when state_file is on S3
+
+    Returns:
+    --------
+    state: dict
+        Mapping of grid name to the inputs it was last rasterized from. Empty
+        if the state file does not exist yet
+    """
+    if state_file.startswith("s3"):
+        parsed = urlparse.urlparse(state_file)
+        try:
+            obj = s3_client.get_object(Bucket=parsed.netloc,
+                                       Key=parsed.path.lstrip("/"))
+        except s3_client.exceptions.NoSuchKey:
+            return {}
+        return json.loads(obj['Body'].read())
+    if not os.path.isfile(state_file):
+        return {}
+    with open(state_file, "r") as f:
+        return json.load(f)
+
+
+def save_state(state, state_file, s3_client=None):
+    """Write the rasterization state file
+
+    The local file is replaced atomically so an interrupted run never leaves
+    a truncated state behind.
+
+    Parameters
+    ----------
+    state : dict
+        Mapping of grid name to the inputs it was rasterized from
+    state_file : str
+        Local path or s3:// URL of the JSON state file
+    s3_client : boto3.client
+        Client used when state_file is on S3
+    """
+    body = json.dumps(state, sort_keys=True)
+    if state_file.startswith("s3"):
+        parsed = urlparse.urlparse(state_file)
+        s3_client.put_object(Bucket=parsed.netloc,
+                             Key=parsed.path.lstrip("/"),
+                             Body=body.encode())
+        return
+    tmp = "{}.tmp".format(state_file)
+    with open(tmp, "w") as f:
+        f.write(body)
+    os.replace(tmp, state_file)
+
+
+def get_source_stamps(paths, s3_client=None):
+    """Get a change stamp for each source shapefile
+
+    Local files are stamped with their size and mtime. S3 objects are stamped
+    with their ETag, collected with one paginated listing per prefix rather
+    than a HEAD request per object. The stamp of a .shp also covers its
+    .shx, .dbf, .prj and .cpg files, so edits to the attributes alone are
+    seen.
+
+    Parameters
+    ----------
+    paths : iterable
+        Local paths or s3:// URLs of the source shapefiles
+    s3_client : boto3.client
+        Client used to list S3 prefixes
+
+    Returns:
+    --------
+    stamps: dict
+        Mapping of path to stamp. Paths that cannot be found are left out
+    """
+    paths = set(paths)
+    file_stamps = {}
+    by_prefix = defaultdict(set)
+    for path in paths:
+        for part in _shapefile_parts(path):
+            if part.startswith("s3"):
+                parsed = urlparse.urlparse(part)
+                key = parsed.path.lstrip("/")
+                prefix = os.path.dirname(key)
+                prefix = "{}/".format(prefix) if prefix else ""
+                by_prefix[(parsed.netloc, prefix)].add(key)
+            elif os.path.exists(part):
+                st = os.stat(part)
+                file_stamps[part] = "{}-{}".format(st.st_size, st.st_mtime_ns)
+
+    for (bucket, prefix), keys in by_prefix.items():
+        paginator = s3_client.get_paginator("list_objects_v2")
+        # Delimiter keeps the listing to the prefix itself, not subfolders
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix,
+                                       Delimiter="/"):
+            for obj in page.get("Contents", []):
+                if obj["Key"] in keys:
+                    url = "s3://{}/{}".format(bucket, obj["Key"])
+                    file_stamps[url] = obj["ETag"].strip('"')
+
+    stamps = {}
+    for path in paths:
+        if path in file_stamps:
+            stamps[path] = ";".join(file_stamps[part] for part in _shapefile_parts(path)
+                                    if part in file_stamps)
+    return stamps
+
+
+def select_changed_grids(grids, col_shp, state, stamps, run_params):
+    """Keep only the grids whose inputs changed since the last run
+
+    A grid is selected if it has no state entry, or if its source shapefile,
+    the shapefile's stamp or the rasterization parameters differ from those
+    recorded.
+
+    Parameters
+    ----------
+    grids : DataFrame
+        Grids joined with the catalog, with a 'name_col_row' column
+    col_shp : str
+        Column holding the source shapefile path
+    state : dict
+        State loaded with load_state
+    stamps : dict
+        Source stamps from get_source_stamps
+    run_params : dict
+        Parameters that affect the output chips
+
+    Returns:
+    --------
+    DataFrame of the grids that need to be rasterized
+    """
+    def changed(row):
+        entry = state.get(str(row['name_col_row']))
+        if entry is None:
+            return True
+        return (entry.get('source') != row[col_shp]
+                or entry.get('stamp') != stamps.get(row[col_shp])
+                or entry.get('params') != run_params)
+
+    if len(grids) == 0:
+        return grids
+    return grids[grids.apply(changed, axis=1)]
+
+
+def update_state(state, grids, col_shp, stamps, run_params):
+    """Record the inputs of rasterized grids in the state
+
+    Parameters
+    ----------
+    state : dict
+        State to update in place
+    grids : DataFrame
+        Grids that were rasterized
+    col_shp : str
+        Column holding the source shapefile path
+    stamps : dict
+        Source stamps from get_source_stamps
+    run_params : dict
+        Parameters that affect the output chips
+    """
+    for name, source in zip(grids['name_col_row'], grids[col_shp]):
+        state[str(name)] = {
+            'source': source,
+            'stamp': stamps.get(source),
+            'params': run_params
+        }
@@ -0,0 +1,455 @@
+import os, geopandas as gpd, shapely
+import shapely.affinity
+import pandas as pd
+
+import rasterio
+from rasterio import features
+from rasterio.crs import CRS
+from rasterio.io import MemoryFile
+from affine import Affine
+import urllib.parse as urlparse
+from functools import lru_cache
+
+import numpy as np
+from .utils import read_table, get_gdal_options, gdal_env_context
+from .metrics import Metrics
+from .sharding import select_grid_shard_names, get_manifest_path, write_manifest
+from .rasterize_state import load_state, save_state, get_source_stamps, \
+    select_changed_grids, update_state
+from .work_queue import WorkQueue, run_worker
+from .output_index import append_index
+from .profiling import profile_sample
+
+
+def get_grid_from_centroid(centroid, width=0.0025, height=0.0025, crs_old=4326, crs_new=4326):
+    gf = gpd.GeoDataFrame({
+        'lat': centroid[0],
+        'lon': centroid[1],
+        'width': width,
+        'height': height,
+        'center': [shapely.geometry.Point(centroid[0], centroid[1])]
+    }, index=[0], geometry='center', crs='EPSG:{}'.format(crs_old))
+
+    gf = gf.to_crs(epsg=crs_new)
+
+    # create polygon using width and height
+    gf['center'] = gf['center'].buffer(1)
+    gf['polygon'] = gf.apply(lambda x: shapely.affinity.scale(x['center'], height, width), axis=1)
+    gf = gf.set_geometry('polygon')
+
+    # get bounding box of created polygon
+    gf['geometry'] = gf['polygon'].envelope
+    gf = gf \
+        .set_geometry('geometry') \
+        .set_crs(epsg=crs_new, allow_override=True) \
+        .filter(items=['lat', 'lon', 'geometry'])
+    return gf
+
+
+def get_chip_meta(grid, resolution, crs):
+    """Build the raster metadata of a label chip
+
+    Parameters
+    ----------
+    grid : GeoDataFrame
+        Chip polygon from get_grid_from_centroid
+    resolution : float
+        Pixel size in units of crs
+    crs : int
+        EPSG code of the chip
+
+    Returns:
+    --------
+    shape: tuple
+        (width, height) of the chip in pixels
+    meta: dict
+        rasterio profile of the chip
+    """
+    minx, miny, maxx, maxy = grid.total_bounds
+    shape = (int(round((maxx - minx) / resolution)), int(round((maxy - miny) / resolution)))
+
+    transform = Affine(resolution, 0.0, minx, 0.0, -resolution, maxy)
+    meta = ({
+        'driver': 'GTiff',
+        'dtype': 'int16',
+        'nodata': None,
+        'width': shape[0],
+        'height': shape[1],
+        'count': 1,
+        'crs': CRS.from_epsg(crs),
+        'transform': transform
+
+    })
+    return shape, meta
+
+
+@lru_cache(maxsize=32)
+def _read_labels(path):
+    return gpd.read_file(path)
+
+
+def load_labels(path):
+    """Read a labeller shapefile
+
+    Neighbouring grids usually share a shapefile, so recently read files are
+    kept in memory and a copy is returned to the caller.
+
+    Parameters
+    ----------
+    path : str
+        Local path or URL of the shapefile
+
+    Returns:
+    --------
+    GeoDataFrame of label polygons
+    """
+    return _read_labels(path).copy()
+
+
+class BinaryScheme():
+    """Burn label polygons as 1 on a background of 0"""
+
+    def prepare(self, shp, resolution, buf_dist):
+        """Add the columns the scheme needs before clipping to the chip"""
+        shp['category'] = 1
+        return shp
+
+    def burn(self, shp, out_arr, transform, resolution):
+        """Rasterize clipped polygons into a copy of out_arr"""
+        shapes = ((geom, value) for geom, value in zip(shp['geometry'], shp['category']))
+        return features.rasterize(shapes=shapes, fill=0, out=out_arr.copy(), transform=transform)
+
+
+class ThreeClassScheme(BinaryScheme):
+    """Burn background, field interior and field boundary as separate classes
+
+    Boundaries are found by rasterizing the polygons shrunk and grown by
+    buf_dist and comparing them with the unbuffered burn.
+    """
+
+    def prepare(self, shp, resolution, buf_dist):
+        shp['category'] = 1
+        shp['buffer_in'] = shp.geometry.buffer(buf_dist)
+        shp['buffer_out'] = shp.geometry.buffer(-buf_dist)
+        return shp
+
+    def burn(self, shp, out_arr, transform, resolution):
+        burned = super().burn(shp, out_arr, transform, resolution)
+
+        try:
+            shapes_shrink = ((geom, value) for geom, value in zip(shp['buffer_in'], shp['category']))
+            shrinked = features.rasterize(shapes=shapes_shrink, fill=0, out=out_arr.copy(), transform=transform)
+            shapes_explode = ((geom, value) for geom, value in zip(shp['buffer_out'], shp['category']))
+            exploded = features.rasterize(shapes=shapes_explode, fill=0, out=out_arr.copy(),
+                                          transform=transform)
+        except:
+            shp['buffer'] = shp.geometry.buffer(-1 * resolution)
+            shapes_shrink = ((geom, value) for geom, value in zip(shp['buffer'], shp['category']))
+            shrinked = features.rasterize(shapes=shapes_shrink, fill=0, out=out_arr.copy(), transform=transform)
+            shp['buffer'] = shp.geometry.buffer(resolution)
+            shapes_explode = ((geom, value) for geom, value in zip(shp['buffer'], shp['category']))
+            exploded = features.rasterize(shapes=shapes_explode, fill=0, out=out_arr.copy(),
+                                          transform=transform)
+
+        return burned * 2 - shrinked + np.where((exploded * 2 - burned) == 1, 0, exploded * 2 - burned).astype(
+            np.int16)
+
+
+# raster_mode -> class scheme. New schemes subclass BinaryScheme and are added
+# here with register_scheme
+CLASS_SCHEMES = {
+    'binary': BinaryScheme(),
+    'three_class': ThreeClassScheme()
+}
+
+
+def register_scheme(name, scheme):
+    """Make a class scheme available as a raster_mode
+
+    Parameters
+    ----------
+    name : str
+        Value of raster_mode selecting the scheme
+    scheme : BinaryScheme
+        Object implementing prepare and burn
+    """
+    CLASS_SCHEMES[name] = scheme
+
+
+def write_chip(out, meta, out_fn, dir_out, s3_client, metrics=None):
+    """Write a label chip to a local directory or an S3 prefix
+
+    Parameters
+    ----------
+    out : numpy.ndarray
+        Label array, or (bands, rows, cols) array of an image chip
+    meta : dict
+        rasterio profile from get_chip_meta
+    out_fn : str
+        File name of the chip
+    dir_out : str
+        Local directory or s3:// prefix
+    s3_client : boto3.client
+        Client used when dir_out is on S3
+    metrics : Metrics
+        Records write or upload time and bytes
+
+    Returns:
+    --------
+    Local path or s3:// URL of the written chip
+    """
+    metrics = metrics or Metrics()
+    indexes = 1 if out.ndim == 2 else None
+    if dir_out.startswith("s3"):
+
+        dir_out_parsed = urlparse.urlparse(dir_out)
+        bucket = dir_out_parsed.netloc
+        prefix = dir_out_parsed.path
+        with MemoryFile() as memfile:
+            with metrics.span("write"):
+                with memfile.open(**meta) as src:
+                    src.write(out, indexes)
+            # upload_fileobj closes the file, so size it first
+            memfile.seek(0, 2)
+            metrics.count("chip_bytes", memfile.tell())
+            memfile.seek(0)
+            with metrics.span("upload"):
+                s3_client.upload_fileobj(Fileobj=memfile,
+                                         Bucket=bucket,
+                                         Key=os.path.join(prefix + out_fn))
+        out_path = "s3://{}/{}".format(bucket, os.path.join(prefix + out_fn).lstrip("/"))
+    else:
+        out_path = os.path.join(dir_out, out_fn)
+        with metrics.span("write"):
+            with rasterio.open(out_path, "w+", **meta) as dst:
+                dst.write(out, indexes)
+        metrics.count("chip_bytes", os.path.getsize(out_path))
+    metrics.count("chips_written")
+    return out_path
+
+
+def write_label_by_grid(grid_df, col_shp, resolution, diam, crs, dir_out, s3_client, scheme, buf_dist=None,
+                        metrics=None):
+    """Rasterize the labels of one grid with a class scheme and write the chip
+
+    Parameters
+    ----------
+    grid_df : Series
+        Grid row with 'x', 'y', 'name_col_row' and the shapefile column
+    col_shp : str
+        Column holding the source shapefile path
+    resolution : float
+        Pixel size in units of crs
+    diam : float
+        Width and height of the chip in units of crs
+    crs : int
+        EPSG code of the chip
+    dir_out : str
+        Local directory or s3:// prefix
+    s3_client : boto3.client
+        Client used when dir_out is on S3
+    scheme : str or BinaryScheme
+        Class scheme, or its name in CLASS_SCHEMES
+    buf_dist : float
+        Boundary buffer distance for schemes that use one. Defaults to
+        -resolution
+    metrics : Metrics
+        Records the time of each stage
+
+    Returns:
+    --------
+    Local path or s3:// URL of the written chip
+    """
+    if isinstance(scheme, str):
+        scheme = CLASS_SCHEMES[scheme]
+    if buf_dist is None:
+        buf_dist = -1 * resolution
+    metrics = metrics or Metrics()
+
+    # rasterize and write
+    with metrics.span("chip_geometry"):
+        centroid = (grid_df['x'], grid_df['y'])
+        grid = get_grid_from_centroid(centroid, diam, diam, crs, crs)
+        shape, meta = get_chip_meta(grid, resolution, crs)
+
+    with metrics.span("read"):
+        shp = load_labels(grid_df[col_shp])
+    with metrics.span("buffer"):
+        shp = scheme.prepare(shp, resolution, buf_dist)
+    with metrics.span("overlay"):
+        shp = gpd.overlay(grid, shp, how='intersection')
+
+    out_fn = "{}.tif".format(grid_df['name_col_row'])
+    out_arr = np.zeros(shape).astype('int16')
+    if len(shp) > 0:
+        print(out_fn)
+        with metrics.span("rasterize"):
+            out = scheme.burn(shp, out_arr, meta['transform'], resolution)
+    else:
+        out = out_arr
+
+    return write_chip(out, meta, out_fn, dir_out, s3_client, metrics)
+
+
+# three class
+def write_threeclass_by_grid(grid_df, col_shp, resolution, diam, crs, buf_dist, dir_out, s3_client):
+    return write_label_by_grid(grid_df, col_shp, resolution, diam, crs, dir_out, s3_client, 'three_class', buf_dist)
+
+
+# Binary
+def write_binary_by_grid(grid_df, col_shp, resolution, diam, crs, dir_out, s3_client):
+    return write_label_by_grid(grid_df, col_shp, resolution, diam, crs, dir_out, s3_client, 'binary')
+
+
+def rasterize_grids(params, run_local, metrics=None):
+    """Rasterize labeller shapefiles into label chips for every grid
+
+    Parameters
+    ----------
+    params : dict
+        The Rasterize_Labels and AWS sections of the config. If
+        'grid_chunksize' is set, the grid table is streamed in chunks of that
+        many rows. 'gdal_env' holds the gdal_env config section. With
+        'shard_index' and 'shard_count' only the grids of one shard are
+        rasterized, and with 'manifest_dir' the written chips are listed in
+        a manifest per shard. With 'queue_path' the grids are claimed from a
+        WorkQueue shared with other nodes, which take over the grids of a
+        node that dies once its 'lease_seconds' run out. Grids already done
+        in the queue are not rasterized again, so use a new queue_path for a
+        new run. With 'image_sources', a vector file of images with a
+        'path' column, an image chip on the grid of each label chip is
+        written to 'dir_images' and listed in the manifest. With
+        'index_dir' the chips are added to a GeoParquet index, see
+        output_index.append_index. With 'profile', options from
+        profiling.profile_options, a sample of the chips is profiled
+    run_local : bool
+        Whether AWS credentials come from params (True) or the environment
+    metrics : Metrics
+        Records stage timings and counters
+    """
+    metrics = metrics or Metrics()
+    mode = params['raster_mode']
+    assert mode in CLASS_SCHEMES
+    dir_grids = params['dir_grids']
+    dir_catalog = params['dir_catalog']
+    col_shp = params['col_shapefile']
+    dir_out = params['dir_out']
+    if not dir_out.startswith("s3") and not os.path.exists(dir_out):
+        os.mkdir(dir_out)
+    # params concerning raster
+    rst_res = params['resolution']
+    diam = params['diam']
+    crs_epsg = params['crs_epsg']
+    # optional state file for incremental runs
+    state_file = params.get('state_file')
+    chunksize = params.get('grid_chunksize')
+    shard_index = params.get('shard_index') or 0
+    shard_count = params.get('shard_count') or 1
+    manifest_dir = params.get('manifest_dir')
+    manifest_path = get_manifest_path(manifest_dir, shard_index, shard_count, 'labels') \
+        if manifest_dir else None
+    queue_path = params.get('queue_path')
+    queue = WorkQueue(queue_path, params.get('lease_seconds') or 600) if queue_path else None
+    dir_images = params.get('dir_images')
+    index_dir = params.get('index_dir')
+    image_sources = gpd.read_file(params['image_sources']) if params.get('image_sources') else None
+    import boto3
+    if run_local:
+        creds = {'aws_key': params['aws_access'],
+                 'aws_secret': params['aws_secret'],
+                 'aws_region': params['aws_region']}
+        s3_client = boto3.client("s3",
+                                 aws_access_key_id=creds['aws_key'],
+                                 aws_secret_access_key=creds['aws_secret'],
+                                 region_name=creds['aws_region']
+                                 )
+    else:
+        creds = {}
+        s3_client = boto3.client("s3") \
+            if any(d.startswith("s3") for d in (dir_out, state_file or "", dir_images or "",
+                                                index_dir or "")) else None
+
+    # only the columns the rasterizer uses, wherever they live
+    columns = ['name', 'name_col_row', 'x', 'y', col_shp]
+    dtype = {'name': str, 'name_col_row': str, 'x': 'float64', 'y': 'float64', col_shp: str}
+    with metrics.span("load_tables"):
+        catalog = read_table(dir_catalog, columns=columns, dtype=dtype, **creds)
+    if shard_count > 1:
+        # first pass over x, y only, to split the shapefiles between shards
+        with metrics.span("shard"):
+            site_chunks = read_table(dir_grids, columns=['name', 'x', 'y'], dtype=dtype,
+                                     chunksize=chunksize, **creds)
+            shard_names = select_grid_shard_names(site_chunks if chunksize else [site_chunks],
+                                                  shard_index, shard_count)
+        catalog = catalog[catalog['name'].isin(shard_names)]
+        print("Shard {} of {}: {} shapefiles".format(shard_index, shard_count, len(catalog)))
+    grid_chunks = read_table(dir_grids, columns=columns, dtype=dtype, chunksize=chunksize, **creds)
+    if not chunksize:
+        grid_chunks = [grid_chunks]
+
+    if state_file:
+        state = load_state(state_file, s3_client)
+        stamps = {}
+        run_params = {'raster_mode': mode, 'resolution': rst_res, 'diam': diam,
+                      'crs_epsg': crs_epsg, 'dir_out': dir_out}
+
+    profile = params.get('profile')
+
+    def rasterize(row):
+        with profile_sample(profile, 'write_label_by_grid'):
+            return write_label_by_grid(row, col_shp, rst_res, diam, crs_epsg, dir_out, s3_client, mode,
+                                       metrics=metrics)
+
+    def rasterize_queued(wait):
+        # jobs may come from any node, so outputs are taken from their payloads
+        done = run_worker(queue, lambda row: rasterize(pd.Series(row)), wait=wait)
+        return pd.DataFrame([row for row, _ in done], columns=columns), [p for _, p in done]
+
+    def record_done(grids, paths):
+        if image_sources is not None:
+            from .chips import extract_image_chips
+            image_paths = extract_image_chips(grids, image_sources, rst_res, diam, crs_epsg, dir_images,
+                                              s3_client, params.get('image_resampling') or "nearest",
+                                              metrics=metrics)
+        records = [{'name': n, 'name_col_row': g, 'path': p}
+                   for n, g, p in zip(grids['name'], grids['name_col_row'], paths)]
+        if image_sources is not None:
+            for record, image_path in zip(records, image_paths):
+                record['image_path'] = image_path
+        if manifest_path:
+            write_manifest(records, manifest_path)
+        if index_dir:
+            # the footprint of the chip made by get_grid_from_centroid
+            written = [(r, shapely.geometry.box(x - diam, y - diam, x + diam, y + diam))
+                       for r, x, y in zip(records, grids['x'], grids['y']) if r['path']]
+            append_index([r for r, _ in written], [g for _, g in written],
+                         'EPSG:{}'.format(crs_epsg), index_dir, 'chips', s3_client)
+        if state_file:
+            # checkpoint after every chunk so an interrupted run keeps progress
+            update_state(state, grids[grids[col_shp].isin(stamps)], col_shp, stamps, run_params)
+            save_state(state, state_file, s3_client)
+
+    with gdal_env_context(get_gdal_options(params.get('gdal_env'))):
+        for grids in grid_chunks:
+            grids = grids.merge(catalog, how='inner', on=['name'])
+
+            if state_file:
+                new_sources = set(grids[col_shp]) - set(stamps)
+                if s3_client is None and any(p.startswith("s3") for p in new_sources):
+                    s3_client = boto3.client("s3")
+                stamps.update(get_source_stamps(new_sources, s3_client))
+                n_grids = len(grids)
+                grids = select_changed_grids(grids, col_shp, state, stamps, run_params)
+                print("{} of {} grids changed since last run".format(len(grids), n_grids))
+
+            if queue is not None:
+                queue.add(zip(grids['name_col_row'], grids[columns].to_dict('records')))
+                grids, paths = rasterize_queued(wait=False)
+            else:
+                paths = [rasterize(row) for _, row in grids.iterrows()]
+            record_done(grids, paths)
+
+        if queue is not None:
+            # wait for grids leased by other nodes, retrying those whose node died
+            record_done(*rasterize_queued(wait=True))
+            print("Work queue {}: {}".format(queue_path, queue.counts()))
@@ -0,0 +1,208 @@
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+import requests
+from .metrics import Metrics
+
+# responses worth retrying: throttled, or a transient server error
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header
+
+    Parameters:
+    ----------
+    value: str
+        Header value, either seconds or an HTTP date
+
+    Returns
+    -------
+    Seconds as a float, or None if the header is missing or malformed
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(),
+                   0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter():
+    """Pace the requests of all threads that share one API quota
+
+    A token bucket starts requests at no more than rate per second, with
+    bursts of up to burst. On top of that an AIMD limit caps the requests
+    in flight: it grows by about one per round of successful requests and
+    halves when a request is throttled or fails, so concurrency settles
+    just under what the API accepts. A Retry-After from the API pauses
+    every thread until it has passed.
+    """
+
+    def __init__(self, rate=5.0, burst=None, max_concurrency=8,
+                 min_concurrency=1, metrics=None) -> None:
+        """
+        Parameters:
+        ----------
+        rate: float
+            Requests started per second, e.g. a little under the quota
+        burst: int
+            Requests that can start at once after an idle period. Defaults
+            to max_concurrency
+        max_concurrency: int
+            Upper bound of requests in flight
+        min_concurrency: int
+            Lower bound the limit shrinks to when throttled
+        metrics: Metrics
+            Records throttled responses and the concurrency limit
+        """
+        self.rate = rate
+        self.burst = burst or max_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.metrics = metrics or Metrics()
+        self.concurrency = float(max(min_concurrency, 1))
+        self.in_flight = 0
+        self.tokens = float(self.burst)
+        self.refilled = time.monotonic()
+        self.paused_until = 0.0
+        self.decreased = 0.0
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.tokens + (now - self.refilled) * self.rate,
+                          self.burst)
+        self.refilled = now
+
+    def acquire(self):
+        """Wait for a request slot and a token
+
+        Returns
+        -------
+        Start time of the request, to pass to release
+        """
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.in_flight >= int(self.concurrency):
+                        wait = None  # until a request finishes
+                    else:
+                        self._refill(now)
+                        if self.tokens >= 1:
+                            self.tokens -= 1
+                            self.in_flight += 1
+                            return now
+                        wait = (1 - self.tokens) / self.rate
+                self.cond.wait(wait)
+
+    def release(self, started, throttled=False, retry_after=None):
+        """Free a request slot and adapt the limit to how the request went
+
+        Parameters:
+        ----------
+        started: float
+            Start time from acquire
+        throttled: bool
+            The request was throttled or failed transiently
+        retry_after: float
+            Seconds the API asked to wait, from parse_retry_after
+        """
+        with self.cond:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if throttled:
+                # requests in flight when the limit dropped were sent at the
+                # old limit, so their throttles do not count again
+                if started >= self.decreased:
+                    self.concurrency = max(self.concurrency / 2,
+                                           self.min_concurrency)
+                    self.decreased = now
+                    self.tokens = 0.0
+                    self.metrics.gauge("http_concurrency", self.concurrency)
+                self.metrics.count("http_throttled")
+                if retry_after:
+                    self.paused_until = max(self.paused_until,
+                                            now + retry_after)
+            else:
+                self.concurrency = min(
+                    self.concurrency + 1 / self.concurrency,
+                    self.max_concurrency
+                )
+            self.cond.notify_all()
+
+
+def send_request(session, method, url, limiter=None, max_retries=5,
+                 backoff=1.0, handle=None, metrics=None, **kwargs):
+    """Send a request through a RateLimiter and retry when throttled
+
+    Responses with a status in RETRY_STATUS, connection errors and broken
+    transfers are retried after the Retry-After of the response, or else
+    after an exponential backoff with jitter.
+
+    Parameters:
+    ----------
+    session: requests.Session
+        Session to send with
+    method: str
+        HTTP method
+    url: str
+        URL to request
+    limiter: RateLimiter
+        Shared limiter. None sends right away
+    max_retries: int
+        Retries before giving up
+    backoff: float
+        Seconds before the first retry without Retry-After, doubled after
+        each one
+    handle: callable
+        Called with a successful response while its request slot is still
+        held, e.g. to stream the body to a file. Its return value is
+        returned
+    metrics: Metrics
+        Records retries
+    kwargs
+        Passed to session.request
+
+    Returns
+    -------
+    The return value of handle, or else the response, which is the last
+    throttled one if retries ran out
+    """
+    metrics = metrics or (limiter.metrics if limiter else Metrics())
+    for attempt in range(max_retries + 1):
+        started = limiter.acquire() if limiter else None
+        throttled, retry_after, res = True, None, None
+        try:
+            res = session.request(method, url, **kwargs)
+            if res.status_code not in RETRY_STATUS:
+                # an error in handle, e.g. raise_for_status on a 404, is
+                # not a throttle
+                throttled = False
+                return handle(res) if handle is not None else res
+            retry_after = parse_retry_after(res.headers.get("Retry-After"))
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError):
+            if attempt == max_retries:
+                raise
+        finally:
+            if limiter:
+                limiter.release(started, throttled, retry_after)
+        if attempt == max_retries:
+            return res
+        metrics.count("http_retries",
+                      status=res.status_code if res is not None else "error")
+        if res is not None:
+            res.close()
+        if retry_after is None:
+            time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        elif limiter is None:
+            time.sleep(retry_after)
+        # else the limiter holds every thread until Retry-After has passed
@@ -0,0 +1,218 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+def hilbert_index(x, y, bounds=None, order=16):
+    """Position of points along a Hilbert curve
+
+    Parameters
+    ----------
+    x : array-like
+        X coordinates
+    y : array-like
+        Y coordinates
+    bounds : tuple
+        (minx, miny, maxx, maxy) the curve spans. Defaults to the bounds of
+        the points
+    order : int
+        Number of bits per axis
+
+    Returns:
+    --------
+    numpy.ndarray of int64 curve positions. Points close on the curve are
+    close in space
+    """
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    if bounds is None:
+        bounds = (x.min(), y.min(), x.max(), y.max()) if len(x) else (0, 0, 1, 1)
+    minx, miny, maxx, maxy = bounds
+    n = 2 ** order
+    xi = ((x - minx) / max(maxx - minx, 1e-12) * (n - 1)).astype("int64")
+    yi = ((y - miny) / max(maxy - miny, 1e-12) * (n - 1)).astype("int64")
+    xi = np.clip(xi, 0, n - 1)
+    yi = np.clip(yi, 0, n - 1)
+
+    d = np.zeros(len(xi), dtype="int64")
+    s = n // 2
+    while s > 0:
+        rx = (xi & s) > 0
+        ry = (yi & s) > 0
+        d += s * s * ((3 * rx.astype("int64")) ^ ry.astype("int64"))
+        # rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        xi = np.where(flip, n - 1 - xi, xi)
+        yi = np.where(flip, n - 1 - yi, yi)
+        xi, yi = np.where(~ry, yi, xi), np.where(~ry, xi, yi)
+        s //= 2
+    return d
+
+
+def assign_shards(x, y, shard_count, weights=None, keys=None):
+    """Split points into spatially coherent shards of similar weight
+
+    Points are ordered along a Hilbert curve and cut into shard_count
+    contiguous runs, so each shard covers a compact area. The result only
+    depends on the points, not on their order, so every node computes the
+    same split.
+
+    Parameters
+    ----------
+    x : array-like
+        X coordinates
+    y : array-like
+        Y coordinates
+    shard_count : int
+        Number of shards
+    weights : array-like
+        Work per point, e.g. the number of chips of a shapefile. Defaults
+        to 1
+    keys : array-like
+        Unique ids used to break ties between points at the same position
+
+    Returns:
+    --------
+    numpy.ndarray of shard indices, one per point
+    """
+    n = len(x)
+    weights = np.ones(n) if weights is None else np.asarray(weights, "float64")
+    keys = np.arange(n) if keys is None else np.asarray(keys).astype(str)
+    order = np.lexsort((keys, hilbert_index(x, y)))
+    cum = np.cumsum(weights[order]) - weights[order]
+    total = weights.sum()
+    shards = np.empty(n, dtype="int64")
+    shards[order] = np.minimum(
+        (cum / total * shard_count).astype("int64") if total else 0,
+        shard_count - 1
+    )
+    return shards
+
+
+def select_tile_shard(tiles, shard_index, shard_count):
+    """Tiles belonging to one shard
+
+    Parameters
+    ----------
+    tiles : GeoDataFrame
+        Tiles with a 'tile' id column
+    shard_index : int
+        Shard to select, from 0 to shard_count - 1
+    shard_count : int
+        Number of shards
+
+    Returns:
+    --------
+    GeoDataFrame of the shard's tiles
+    """
+    check_shard(shard_index, shard_count)
+    if shard_count == 1 or len(tiles) == 0:
+        return tiles
+    centroids = tiles.geometry.centroid
+    shards = assign_shards(centroids.x.values, centroids.y.values,
+                           shard_count, keys=tiles['tile'].values)
+    return tiles[shards == shard_index]
+
+
+def select_grid_shard_names(grid_chunks, shard_index, shard_count):
+    """Shapefile names whose grids belong to one shard
+
+    Grids are sharded by shapefile so that each node reads as few shapefiles
+    as possible. Shapefiles are placed by the centroid of their grids and
+    balanced by their number of grids.
+
+    Parameters
+    ----------
+    grid_chunks : iterable
+        DataFrames with 'name', 'x' and 'y' columns, e.g. the chunks of a
+        grid table
+    shard_index : int
+        Shard to select, from 0 to shard_count - 1
+    shard_count : int
+        Number of shards
+
+    Returns:
+    --------
+    set of shapefile names
+    """
+    check_shard(shard_index, shard_count)
+    sums = []
+    for chunk in grid_chunks:
+        sums.append(chunk.groupby('name')[['x', 'y']].agg(['sum', 'count']))
+    if not sums:
+        return set()
+    sites = pd.concat(sums).groupby(level=0).sum()
+    count = sites[('x', 'count')]
+    shards = assign_shards((sites[('x', 'sum')] / count).values,
+                           (sites[('y', 'sum')] / count).values,
+                           shard_count, weights=count.values,
+                           keys=sites.index.values)
+    return set(sites.index[shards == shard_index])
+
+
+def check_shard(shard_index, shard_count):
+    """Raise ValueError unless 0 <= shard_index < shard_count"""
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(f"Invalid shard {shard_index} of {shard_count}")
+
+
+def get_manifest_path(manifest_dir, shard_index, shard_count, prefix):
+    """Path of the manifest a shard writes its outputs to"""
+    return os.path.join(
+        manifest_dir,
+        f"{prefix}_shard{shard_index:04d}of{shard_count:04d}.csv"
+    )
+
+
+def write_manifest(records, manifest_path):
+    """Append output records to a shard manifest
+
+    Parameters
+    ----------
+    records : list
+        One dict per output
+    manifest_path : str
+        CSV file, created with a header if it does not exist
+    """
+    if not records:
+        return
+    if os.path.dirname(manifest_path):
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    frame = pd.DataFrame(records)
+    if not os.path.isfile(manifest_path):
+        frame.to_csv(manifest_path, index=False)
+        return
+    columns = pd.read_csv(manifest_path, nrows=0).columns
+    if set(frame.columns) <= set(columns):
+        # keep appended rows aligned with the header, e.g. without 'error'
+        frame.reindex(columns=columns).to_csv(manifest_path, mode="a",
+                                              header=False, index=False)
+    else:
+        # a new column, rewrite the manifest with it
+        pd.concat([pd.read_csv(manifest_path), frame]).to_csv(
+            manifest_path, index=False
+        )
+
+
+def merge_manifests(manifest_paths, out_path=None):
+    """Combine shard manifests into one table
+
+    Parameters
+    ----------
+    manifest_paths : list
+        Manifest CSVs written by the shards
+    out_path : str
+        If given, the merged table is written here
+
+    Returns:
+    --------
+    DataFrame of all outputs, with the last record kept for outputs that
+    were written more than once
+    """
+    frames = [pd.read_csv(p) for p in manifest_paths if os.path.isfile(p)]
+    merged = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if 'path' in merged.columns:
+        merged = merged.drop_duplicates('path', keep='last')
+    if out_path:
+        merged.to_csv(out_path, index=False)
+    return merged
@@ -0,0 +1,148 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+
+# a global grid in degrees, anchored at the top left corner of EPSG:4326
+GRID_ORIGIN = (-180.0, 90.0)
+GRID_EXTENT = (360.0, 180.0)
+
+
+def _grid_range(bounds, step, origin, extent):
+    """First and last (exclusive) rows and columns that intersect bounds"""
+    minx, miny, maxx, maxy = bounds
+    ox, oy = origin
+    ncols = int(np.ceil(extent[0] / step))
+    nrows = int(np.ceil(extent[1] / step))
+    col0 = max(int(np.floor((minx - ox) / step)), 0)
+    col1 = min(max(int(np.ceil((maxx - ox) / step)), col0 + 1), ncols)
+    row0 = max(int(np.floor((oy - maxy) / step)), 0)
+    row1 = min(max(int(np.ceil((oy - miny) / step)), row0 + 1), nrows)
+    return row0, row1, col0, col1, ncols
+
+
+def _grid_tiles(row0, row1, col0, col1, ncols, tile_size, res, buffer,
+                origin):
+    """Ids, bounds and transforms of a block of grid rows and columns"""
+    ox, oy = origin
+    step = tile_size * res
+    rows, cols = np.meshgrid(np.arange(row0, row1, dtype="int64"),
+                             np.arange(col0, col1, dtype="int64"),
+                             indexing="ij")
+    rows, cols = rows.ravel(), cols.ravel()
+    width = (tile_size + 2 * buffer) * res
+    minx = ox + cols * step - buffer * res
+    maxy = oy - rows * step + buffer * res
+    n = len(rows)
+    transform = np.column_stack([
+        np.full(n, res), np.zeros(n), minx,
+        np.zeros(n), np.full(n, -res), maxy
+    ])
+    return {
+        "tile": rows * ncols + cols,
+        "col": cols,
+        "row": rows,
+        "minx": minx,
+        "miny": maxy - width,
+        "maxx": minx + width,
+        "maxy": maxy,
+        "transform": transform,
+    }
+
+
+def tile_grid_bounds(bounds, tile_size, res, buffer=0, origin=GRID_ORIGIN,
+                     extent=GRID_EXTENT):
+    """Tiles of a fixed global grid that intersect a bounding box
+
+    The grid has its top left corner at origin and steps tile_size pixels
+    of res, so a tile keeps its id and bounds whatever the AOI. Tiles are
+    widened by buffer pixels on each side, so they overlap their neighbours
+    and are tile_size + 2 * buffer pixels wide.
+
+    Parameters
+    ----------
+    bounds : tuple
+        (minx, miny, maxx, maxy) of the area, in the grid's CRS
+    tile_size : int
+        Pixels between the corners of neighbouring tiles
+    res : float
+        Pixel size
+    buffer : int
+        Pixels added on each side of a tile
+    origin : tuple
+        (x, y) of the top left corner of the grid
+    extent : tuple
+        Width and height the grid spans, which sets the number of columns
+        in tile ids
+
+    Returns:
+    --------
+    dict of numpy arrays, one entry per tile: 'tile' ids (row * columns of
+    the grid + column), 'col', 'row', 'minx', 'miny', 'maxx', 'maxy' and
+    'transform', the (a, b, c, d, e, f) coefficients of each tile's Affine
+    transform
+    """
+    row0, row1, col0, col1, ncols = _grid_range(bounds, tile_size * res,
+                                                origin, extent)
+    return _grid_tiles(row0, row1, col0, col1, ncols, tile_size, res, buffer,
+                       origin)
+
+
+def iter_tile_grid(aoi, tile_size, res, buffer=0, crs="EPSG:4326",
+                   coverage=None, chunk_size=10000, origin=GRID_ORIGIN,
+                   extent=GRID_EXTENT):
+    """Tiles of an AOI in chunks, in the form retiler takes
+
+    The grid is generated a band of rows at a time, so no more than about
+    chunk_size tiles exist at once however large the AOI is.
+
+    Parameters
+    ----------
+    aoi : tuple or GeoDataFrame
+        (minx, miny, maxx, maxy) in crs, or shapes. Tiles of shapes are
+        kept if they intersect them, not only their bounding box
+    tile_size : int
+        Pixels between the corners of neighbouring tiles
+    res : float
+        Pixel size, the retiler's dst_res
+    buffer : int
+        Pixels added on each side of a tile. The retiler's dst_width and
+        dst_height must be tile_size + 2 * buffer
+    crs : str
+        CRS of the grid, the retiler's dst_crs
+    coverage : GeoDataFrame
+        Quad catalog. If given, tiles that no quad intersects are dropped
+    chunk_size : int
+        Approximate number of tiles per chunk
+    origin, extent : tuple
+        Grid placement, see tile_grid_bounds
+
+    Yields:
+    -------
+    GeoDataFrame with 'tile' (str) and geometry columns for each non empty
+    chunk
+    """
+    shapes = None
+    if isinstance(aoi, gpd.GeoDataFrame):
+        aoi = aoi.to_crs(crs)
+        shapes = aoi.geometry
+        aoi = tuple(aoi.total_bounds)
+    if coverage is not None:
+        coverage = coverage.to_crs(crs)
+    row0, row1, col0, col1, ncols = _grid_range(aoi, tile_size * res,
+                                                origin, extent)
+    band = max(chunk_size // (col1 - col0), 1)
+    for start in range(row0, row1, band):
+        grid = _grid_tiles(start, min(start + band, row1), col0, col1, ncols,
+                           tile_size, res, buffer, origin)
+        geoms = shapely.box(grid["minx"], grid["miny"], grid["maxx"],
+                            grid["maxy"])
+        keep = np.ones(len(geoms), dtype=bool)
+        for layer in (shapes, coverage):
+            if layer is not None:
+                hits = layer.sindex.query(geoms, predicate="intersects")
+                keep &= np.isin(np.arange(len(geoms)), hits[0])
+        if keep.any():
+            yield gpd.GeoDataFrame(
+                {"tile": grid["tile"][keep].astype(str)},
+                geometry=geoms[keep], crs=crs
+            )
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+from .sharding import write_manifest
+
+
+def compute_tile_stats(arr, nodata=None, bins=64, hist_range=(0, 10000)):
+    """
+    Band statistics and coverage of a tile in memory
+
+    A pixel is covered if any band differs from nodata (0 if the tile has
+    no nodata value), so tiles past the edge of the quads or over their
+    no-data areas get a low coverage.
+
+    Parameters:
+    ----------
+    arr: numpy.ndarray
+        (bands, rows, cols) array of the tile
+    nodata: number
+        Nodata value of the tile
+    bins: int
+        Number of histogram bins of each band
+    hist_range: tuple
+        (min, max) of the histograms, the same for every tile so that they
+        can be summed over tiles. Values outside fall in the outer bins
+
+    Returns
+    -------
+    dict with 'valid_pixels', 'coverage' and for each band n 'b<n>_min',
+    'b<n>_max', 'b<n>_mean' and 'b<n>_std' of the covered pixels and
+    'b<n>_hist', the bin counts joined by ';'
+    """
+    fill = 0 if nodata is None else nodata
+    valid = np.any(arr != fill, axis=0)
+    n = int(valid.sum())
+    stats = {"valid_pixels": n, "coverage": n / valid.size}
+    lo, hi = hist_range
+    for b, band in enumerate(arr, 1):
+        values = band[valid]
+        stats[f"b{b}_min"] = float(values.min()) if n else np.nan
+        stats[f"b{b}_max"] = float(values.max()) if n else np.nan
+        stats[f"b{b}_mean"] = float(values.mean(dtype=np.float64)) \
+            if n else np.nan
+        stats[f"b{b}_std"] = float(values.std(dtype=np.float64)) \
+            if n else np.nan
+        idx = np.clip(((values - lo) * (bins / (hi - lo))).astype(np.int64),
+                      0, bins - 1)
+        stats[f"b{b}_hist"] = ";".join(
+            str(c) for c in np.bincount(idx, minlength=bins)
+        )
+    return stats
+
+
+def write_tile_stats(records, stats_path):
+    """
+    Append the statistics of retiled tiles to a sidecar table
+
+    Parameters:
+    ----------
+    records: list
+        Records of the retiler. Those with 'stats' are written
+    stats_path: str
+        CSV file, created with a header if it does not exist
+    """
+    write_manifest([
+        {"tile": r["tile"], "date": r["date"], "path": r["path"],
+         "status": r["status"], **r["stats"]}
+        for r in records if r is not None and r.get("stats")
+    ], stats_path)
+
+
+def summarize_tile_stats(stats_path):
+    """
+    Statistics of each band over all tiles written, e.g. to normalize
+    model inputs
+
+    Parameters:
+    ----------
+    stats_path: str
+        Sidecar table of write_tile_stats, or merged tables of several
+        shards
+
+    Returns
+    -------
+    dict of band number to its 'min', 'max', 'mean', 'std', 'valid_pixels'
+    and summed 'hist'
+    """
+    table = pd.read_csv(stats_path)
+    table = table[(table["status"] == "written") & (table["valid_pixels"] > 0)]
+    n = table["valid_pixels"]
+    summary = {}
+    if table.empty:
+        return summary
+    bands = sorted(int(c[1:-5]) for c in table.columns
+                   if c.startswith("b") and c.endswith("_mean"))
+    for b in bands:
+        mean = (table[f"b{b}_mean"] * n).sum() / n.sum()
+        # pooled variance from each tile's mean and std
+        sq = ((table[f"b{b}_std"] ** 2 + table[f"b{b}_mean"] ** 2) * n).sum()
+        hist = np.sum([np.array(h.split(";"), dtype=np.int64)
+                       for h in table[f"b{b}_hist"]], axis=0)
+        summary[b] = {
+            "min": float(table[f"b{b}_min"].min()),
+            "max": float(table[f"b{b}_max"].max()),
+            "mean": float(mean),
+            "std": float(np.sqrt(max(sq / n.sum() - mean ** 2, 0))),
+            "valid_pixels": int(n.sum()),
+            "hist": hist.tolist(),
+        }
+    return summary
@@ -1,23 +1,191 @@
+import io
 import os
 import urllib.parse as urlparse
+import atexit
 import logging
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
 import pandas as pd
-from smart_open import smart_open
 from datetime import datetime
-import joblib
 from filelock import FileLock
 
+def read_table(path, columns=None, dtype=None, aws_key=None, aws_secret=None,
+               aws_region=None, chunksize=None):
+    """Read a CSV or Parquet table from a local path or S3
+
+    Parameters
+    ----------
+    path : str
+        Local path or s3:// URL. Files ending in .parquet or .pq are read as
+        Parquet, anything else as CSV
+    columns : list
+        Columns to keep. Columns the table does not have are ignored.
+        Defaults to all columns
+    dtype : dict
+        Column dtypes. Entries for columns the table does not have are
+        ignored
+    aws_key : str
+        AWS access key id. Defaults to the boto3 credential chain
+    aws_secret : str
+        AWS secret access key
+    aws_region : str
+        AWS region
+    chunksize : int
+        If given, return an iterator of DataFrames of at most chunksize rows
+        that streams through the table instead of loading it whole
+
+    Returns:
+    --------
+    DataFrame, or an iterator of DataFrames if chunksize is given
+    """
+    is_parquet = path.lower().endswith((".parquet", ".pq"))
+    if path.startswith("s3"):
+        import boto3
+        parsed = urlparse.urlparse(path)
+        s3_client = boto3.client("s3", aws_access_key_id=aws_key,
+                                 aws_secret_access_key=aws_secret,
+                                 region_name=aws_region)
+        body = s3_client.get_object(Bucket=parsed.netloc,
+                                    Key=parsed.path.lstrip("/"))["Body"]
+        # parquet needs random access to its footer, csv can be streamed
+        src = io.BytesIO(body.read()) if is_parquet else body
+    else:
+        src = path
+
+    if not is_parquet:
+        usecols = (lambda c: c in columns) if columns is not None else None
+        return pd.read_csv(src, usecols=usecols, dtype=dtype,
+                           chunksize=chunksize)
+
+    import pyarrow.parquet as pq
+    pf = pq.ParquetFile(src)
+    if columns is not None:
+        columns = [c for c in pf.schema_arrow.names if c in columns]
+
+    def to_frame(table):
+        df = table.to_pandas()
+        if dtype:
+            df = df.astype({k: v for k, v in dtype.items() if k in df.columns})
+        return df
+
+    if chunksize:
+        return (to_frame(batch) for batch in
+                pf.iter_batches(batch_size=chunksize, columns=columns))
+    return to_frame(pf.read(columns=columns))
+
+
 def reads3csv_with_credential(old_url, aws_key, aws_secret):
-    parsed = urlparse.urlparse(old_url)
-    new_url = urlparse.urlunparse(
-        parsed._replace(
-            netloc="{}:{}@{}".format(aws_key, aws_secret, parsed.netloc)
-        )
-    )
-    df = pd.read_csv(smart_open(new_url))
-    return df
+    return read_table(old_url, aws_key=aws_key, aws_secret=aws_secret)
+
+
+def list_s3_urls(urls, s3_client):
+    """Which of a set of s3:// URLs exist
+
+    Objects are listed with one paginated listing per prefix rather than
+    one request per URL, so checking thousands of outputs under one prefix
+    costs a handful of requests.
+
+    Parameters
+    ----------
+    urls : iterable
+        s3:// URLs to check
+    s3_client : boto3.client
+        Client used for listing
+
+    Returns
+    -------
+    set of the URLs that exist
+    """
+    prefixes = {}
+    for url in urls:
+        parsed = urlparse.urlparse(url)
+        key = (parsed.netloc, os.path.dirname(parsed.path.lstrip("/")))
+        prefixes.setdefault(key, set()).add(url)
+    existing = set()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for (bucket, prefix), wanted in prefixes.items():
+        prefix = f"{prefix}/" if prefix else ""
+        # Delimiter keeps the listing to the prefix itself, not subfolders
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix,
+                                       Delimiter="/"):
+            for obj in page.get("Contents", []):
+                url = f"s3://{bucket}/{obj['Key']}"
+                if url in wanted:
+                    existing.add(url)
+    return existing
+
+# GDAL settings applied when the gdal_env config section does not override
+# them. The VSI settings only matter when rasters are read over HTTP or S3
+DEFAULT_GDAL_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.tiff,.TIF",
+    "GDAL_HTTP_MULTIRANGE": "YES",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MAX_RETRY": 3,
+    "GDAL_HTTP_RETRY_DELAY": 2,
+    "VSI_CACHE": "TRUE",
+}
+
+
+def get_gdal_options(gdal_env=None, num_cores=1):
+    """Resolve the gdal_env config section into GDAL config options
+
+    Parameters
+    ----------
+    gdal_env : dict
+        The gdal_env config section. Recognised keys are cache_mb (block
+        cache shared by all workers), num_threads (GDAL threads per worker),
+        vsi_cache_mb (per open file, per worker), curl_cache_mb (ranges
+        fetched over HTTP or S3, shared by all files a worker reads) and
+        options (any other GDAL config options)
+    num_cores : int
+        Number of worker processes the options are applied in. The block and
+        VSI caches are divided between them so workers do not oversubscribe
+        RAM, and by default the CPUs are too
+
+    Returns:
+    --------
+    options: dict
+        Keyword arguments for rasterio.Env
+    """
+    gdal_env = gdal_env or {}
+    num_cores = max(int(num_cores or 1), 1)
+    options = dict(DEFAULT_GDAL_OPTIONS)
+    options.update(gdal_env.get("options") or {})
 
-def progress_reporter(msg, verbose, log, logger=None):
+    cache_mb = gdal_env.get("cache_mb")
+    if cache_mb:
+        options["GDAL_CACHEMAX"] = max(int(cache_mb) // num_cores, 16)
+    vsi_cache_mb = gdal_env.get("vsi_cache_mb")
+    if vsi_cache_mb:
+        options["VSI_CACHE_SIZE"] = int(vsi_cache_mb) * 1024 * 1024
+    curl_cache_mb = gdal_env.get("curl_cache_mb")
+    if curl_cache_mb:
+        options["CPL_VSIL_CURL_CACHE_SIZE"] = int(curl_cache_mb) * 1024 * 1024
+    num_threads = gdal_env.get("num_threads")
+    if num_threads is None:
+        num_threads = max((os.cpu_count() or 1) // num_cores, 1)
+    options["GDAL_NUM_THREADS"] = str(num_threads)
+    return options
+
+
+def gdal_env_context(gdal_options):
+    """Open a rasterio.Env with the given GDAL config options
+
+    Parameters
+    ----------
+    gdal_options : dict
+        Options from get_gdal_options. None opens a default environment
+
+    Returns:
+    --------
+    rasterio.Env
+    """
+    import rasterio
+    return rasterio.Env(**(gdal_options or {}))
+
+
+def progress_reporter(msg, verbose, log, logger=None, level=logging.INFO):
     """Helps control print statements and log writes
 
     Parameters
@@ -30,6 +198,10 @@ def progress_reporter(msg, verbose, log, logger=None):
         Whether to write to logs or not (requires logger to exist)
     logger : logging.logger
         logger (defaults to none)
+    level : int
+        Logging level of the message. Per-tile messages use logging.DEBUG so
+        they are dropped without being handled when the logger's level is
+        higher
       
     Returns:
     --------  
@@ -39,12 +211,23 @@ def progress_reporter(msg, verbose, log, logger=None):
     if verbose:
         print(msg)
 
-    if log and logger:
-        logger.info(msg)
+    if log and logger and logger.isEnabledFor(level):
+        logger.log(level, msg)
+
+
+# queue and listener of the logger set up in this process
+_log_queue = None
+_log_listener = None
 
-def setup_logger(log_dir, log_name, use_date=False):
+
+def setup_logger(log_dir, log_name, use_date=False, level=logging.DEBUG):
     """Create logger
 
+    Records are put on a multiprocessing queue and written to the log file
+    by a single listener thread in this process, so logging never blocks on
+    the file and Pool workers (see init_worker_logging) do not contend for
+    it.
+
     Parameters
     ----------
     log_dir : str
@@ -53,11 +236,15 @@ def setup_logger(log_dir, log_name, use_date=False):
         What to name the name
     use_date : bool
         Use today's date and time in file name
+    level : int or str
+        Lowest level that is logged
       
     Returns:
     --------  
-        Message to console and or log
+        The logging.handlers.QueueListener writing the log file. It is
+        stopped, flushing queued records, at exit
     """
+    global _log_queue, _log_listener
     if use_date:
         dt = datetime.now().strftime("%d%m%Y_%H%M")
         log = "{}/{}_{}.log".format(log_dir, log_name, dt)
@@ -66,10 +253,9 @@ def setup_logger(log_dir, log_name, use_date=False):
 
     log_format = (
         f"%(asctime)s::%(levelname)s::%(name)s::%(filename)s::"
-        f"%(lineno)d::%(message)s"
+        f"%(lineno)d::%(processName)s::%(message)s"
     )
     
-    level = logging.DEBUG
     logger = logging.getLogger("maputils")
     logger.setLevel(level)
     log_file = log
@@ -80,7 +266,48 @@ def setup_logger(log_dir, log_name, use_date=False):
     # add formatter to ch
     ch.setFormatter(formatter)       
 
-    logger.addHandler(ch)
+    _stop_log_listener()
+    _log_queue = multiprocessing.Queue(-1)
+    _log_listener = QueueListener(_log_queue, ch, respect_handler_level=True)
+    _log_listener.start()
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(_log_queue))
     logger.info("Setup logger in PID {}".format(os.getpid()))
-    
+    return _log_listener
+
+
+@atexit.register
+def _stop_log_listener():
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+def get_log_queue():
+    """Queue of the logger set up with setup_logger, or None"""
+    return _log_queue
+
 
+def init_worker_logging(queue, level=logging.DEBUG):
+    """Route the "maputils" logger of a Pool worker to the parent's queue
+
+    Use as a Pool initializer, e.g.
+    Pool(n, init_worker_logging, (get_log_queue(), logger.level))
+
+    Parameters
+    ----------
+    queue : multiprocessing.Queue
+        Queue from get_log_queue. If None, worker logging is left as is
+    level : int
+        Lowest level that is logged
+    """
+    if queue is None:
+        return
+    logger = logging.getLogger("maputils")
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(queue))
+    logger.setLevel(level)
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from filelock import FileLock
+
+
+def get_worker_id():
+    """Identifier of this process that is unique across machines"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue():
+    """A job table that worker processes claim jobs from under a lease
+
+    Jobs live in a SQLite file. Every change is made under a file lock next
+    to it, so workers on several machines can share the queue through a
+    shared filesystem, where SQLite's own locking is unreliable. A claimed
+    job is leased to one worker. The worker extends the lease with
+    heartbeats while it works, and a job whose lease expires (its worker
+    died) is handed out again, up to max_attempts times.
+    """
+
+    def __init__(self, path, lease_seconds=600, max_attempts=3) -> None:
+        """
+        Parameters:
+        ----------
+        path: str
+            SQLite file holding the job table. Created if missing
+        lease_seconds: float
+            How long a claimed job stays with its worker without a heartbeat
+        max_attempts: int
+            Claims per job before it is marked failed
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = FileLock(f"{path}.lock")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._transaction() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, payload TEXT, status TEXT, worker TEXT, "
+                "lease_expires REAL, attempts INTEGER DEFAULT 0, result TEXT, "
+                "updated REAL)"
+            )
+            con.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)"
+            )
+
+    @contextmanager
+    def _transaction(self):
+        with self.lock:
+            # rollback journal rather than WAL, which needs shared memory
+            con = sqlite3.connect(self.path, timeout=60)
+            try:
+                with con:
+                    yield con
+            finally:
+                con.close()
+
+    def add(self, jobs):
+        """Add jobs, ignoring ids that are already in the table
+
+        Parameters:
+        ----------
+        jobs: iterable
+            (job_id, payload) pairs. Payloads must be JSON serializable
+
+        Returns
+        -------
+        Number of jobs added
+        """
+        now = time.time()
+        rows = [(str(job_id), json.dumps(payload), "pending", now)
+                for job_id, payload in jobs]
+        with self._transaction() as con:
+            before = con.total_changes
+            con.executemany(
+                "INSERT OR IGNORE INTO jobs (id, payload, status, updated) "
+                "VALUES (?, ?, ?, ?)", rows
+            )
+            return con.total_changes - before
+
+    def claim(self, worker_id):
+        """Lease the next pending or expired job to worker_id
+
+        Returns
+        -------
+        (job_id, payload), or None if no job is available
+        """
+        now = time.time()
+        with self._transaction() as con:
+            row = con.execute(
+                "SELECT id, payload FROM jobs WHERE (status = 'pending' OR "
+                "(status = 'leased' AND lease_expires < ?)) AND attempts < ? "
+                "ORDER BY attempts, rowid LIMIT 1",
+                (now, self.max_attempts)
+            ).fetchone()
+            if row is None:
+                # expired jobs that used up their attempts are failed
+                con.execute(
+                    "UPDATE jobs SET status = 'failed', updated = ? WHERE "
+                    "status = 'leased' AND lease_expires < ? AND "
+                    "attempts >= ?", (now, now, self.max_attempts)
+                )
+                return None
+            con.execute(
+                "UPDATE jobs SET status = 'leased', worker = ?, "
+                "lease_expires = ?, attempts = attempts + 1, updated = ? "
+                "WHERE id = ?",
+                (worker_id, now + self.lease_seconds, now, row[0])
+            )
+        return row[0], json.loads(row[1])
+
+    def heartbeat(self, job_id, worker_id):
+        """Extend the lease of a job still held by worker_id
+
+        Returns
+        -------
+        False if the lease was lost, e.g. it expired and was reclaimed
+        """
+        now = time.time()
+        with self._transaction() as con:
+            cur = con.execute(
+                "UPDATE jobs SET lease_expires = ?, updated = ? WHERE id = ? "
+                "AND worker = ? AND status = 'leased'",
+                (now + self.lease_seconds, now, job_id, worker_id)
+            )
+            return cur.rowcount == 1
+
+    def complete(self, job_id, worker_id, result=None):
+        """Mark a job held by worker_id done and store its result
+
+        Returns
+        -------
+        Number of jobs updated, 0 if the lease was lost, e.g. it expired
+        and another worker reclaimed the job
+        """
+        with self._transaction() as con:
+            return con.execute(
+                "UPDATE jobs SET status = 'done', result = ?, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (json.dumps(result), time.time(), job_id, worker_id)
+            ).rowcount
+
+    def fail(self, job_id, worker_id, error=None):
+        """Release a job held by worker_id after an error
+
+        The job is retried by the next claim unless it has used up its
+        attempts, in which case it is marked failed.
+
+        Returns
+        -------
+        Number of jobs updated, 0 if the lease was lost
+        """
+        with self._transaction() as con:
+            return con.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts < ? THEN "
+                "'pending' ELSE 'failed' END, result = ?, updated = ? "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (self.max_attempts, json.dumps(error), time.time(), job_id,
+                 worker_id)
+            ).rowcount
+
+    def counts(self):
+        """Number of jobs in each status"""
+        with self._transaction() as con:
+            return dict(con.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall())
+
+    def results(self, status="done"):
+        """(job_id, payload, result) of the jobs in a status"""
+        with self._transaction() as con:
+            rows = con.execute(
+                "SELECT id, payload, result FROM jobs WHERE status = ?",
+                (status,)
+            ).fetchall()
+        return [(i, json.loads(p), json.loads(r) if r else None)
+                for i, p, r in rows]
+
+
+@contextmanager
+def keep_lease(queue, job_id, worker_id):
+    """Send heartbeats for a job from a background thread while in the block
+
+    The thread beats three times per lease period, so one missed beat does
+    not lose the job.
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(queue.lease_seconds / 3):
+            if not queue.heartbeat(job_id, worker_id):
+                break
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_worker(queue, handler, worker_id=None, is_error=None, wait=True):
+    """Claim and run jobs until the queue has none left
+
+    Parameters:
+    ----------
+    queue: WorkQueue
+        Queue to pull jobs from
+    handler: callable
+        Called with each job's payload. Its return value is stored as the
+        job result and must be JSON serializable
+    worker_id: str
+        Defaults to get_worker_id()
+    is_error: callable
+        Called with a result. If it returns True the job is failed rather
+        than completed. Exceptions raised by handler always fail the job
+    wait: bool
+        When no job is claimable but other workers still hold leases, wait
+        for them to finish or expire instead of returning
+
+    Returns
+    -------
+    results: list
+        (payload, result) of the jobs this worker completed. Jobs whose
+        lease was lost before they finished are left to the worker that
+        reclaimed them
+    """
+    worker_id = worker_id or get_worker_id()
+    results = []
+    while True:
+        job = queue.claim(worker_id)
+        if job is None:
+            if not wait or not queue.counts().get("leased"):
+                return results
+            time.sleep(min(queue.lease_seconds / 3, 30))
+            continue
+        job_id, payload = job
+        try:
+            with keep_lease(queue, job_id, worker_id):
+                result = handler(payload)
+        except Exception as e:
+            queue.fail(job_id, worker_id, repr(e))
+            continue
+        if is_error is not None and is_error(result):
+            queue.fail(job_id, worker_id, result)
+        elif queue.complete(job_id, worker_id, result):
+            results.append((payload, result))
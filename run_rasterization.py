@@ -1,16 +1,19 @@
-import boto3
 import yaml
 import click
 import urllib.parse as urlparse
 
-from maputil import *
+from maputil.get_rasterization import get_rasterization
+from maputil.metrics import Metrics, report_metrics
+from maputil.profiling import profile_options, profile_stage, report_profiles
 
 
-def run_rasterization(dir_config, run_local):
+def run_rasterization(dir_config, run_local, shard_index=None, shard_count=None, merge=False,
+                      profile_dir=None):
 
     assert isinstance(run_local, bool)
     # params
     if dir_config.startswith("s3"):
+        import boto3
         parsed = urlparse.urlparse(dir_config)
         config = yaml.load(boto3.resource('s3').Bucket(parsed.netloc).Object(parsed.path).get()['Body'].read())
 
@@ -19,8 +22,29 @@ def run_rasterization(dir_config, run_local):
             config = yaml.safe_load(config)
     # useful params
     params = {**config['Rasterize_Labels'], **config['AWS']}
+    params.setdefault('gdal_env', config.get('gdal_env'))
+    # command line shard options override the config
+    if shard_index is not None:
+        params['shard_index'] = shard_index
+    if shard_count is not None:
+        params['shard_count'] = shard_count
+    if profile_dir:
+        config['profile'] = {**(config.get('profile') or {}), 'dir': profile_dir}
+    if merge:
+        # fold the index parts of all shards into <index_dir>/chips.parquet
+        from maputil.output_index import merge_index
+        if not params.get('index_dir'):
+            raise click.ClickException("Set index_dir to merge the index")
+        merged = merge_index(params['index_dir'], 'chips')
+        print("{} chips in the index of {}".format(len(merged), params['index_dir']))
+        return
 
-    get_rasterization(params, run_local=run_local)
+    metrics = Metrics(config.get('metrics_path'))
+    params['profile'] = profile_options(config.get('profile'), metrics.run_id)
+    with profile_stage(params['profile'], 'rasterize'):
+        get_rasterization(params, run_local=run_local, metrics=metrics)
+    report_metrics(metrics, config.get('metrics_prom_path'))
+    report_profiles(params['profile'])
 
 
 @click.command()
@@ -28,7 +52,15 @@ def run_rasterization(dir_config, run_local):
               help='Directory of config file')
 @click.option('--run-local', is_flag=True,
               help='Whether the scripts are run in local conputer')
-def main(dir_config, run_local):
-    run_rasterization(dir_config, run_local)
+@click.option('--shard-index', type=int, default=None,
+              help='Shard of the grids to rasterize, from 0')
+@click.option('--shard-count', type=int, default=None,
+              help='Number of shards the grids are split into')
+@click.option('--merge-index', 'merge', is_flag=True,
+              help='Merge the chip index parts of all shards and exit')
+@click.option('--profile', 'profile_dir', default=None,
+              help='Directory for profiles of the run, overrides profile.dir of the config')
+def main(dir_config, run_local, shard_index, shard_count, merge, profile_dir):
+    run_rasterization(dir_config, run_local, shard_index, shard_count, merge, profile_dir)
 
 main()
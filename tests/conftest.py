@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+DATE = "2021-06"
+TILE_RES = 0.005 / 200
+TILE_SIZE = 128
+
+
+@pytest.fixture
+def quads(tmp_path):
+    """One synthetic 4-band quad in Web Mercator and its catalog"""
+    import geopandas as gpd
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.warp import transform_bounds
+    from shapely.geometry import box
+
+    quad_dir = tmp_path / "quads"
+    quad_dir.mkdir()
+    size, res = 512, 4.777314267823516
+    transform = from_origin(-111319.49, 782715.17, res, res)
+    data = np.random.default_rng(0).integers(1, 10000, (4, size, size),
+                                             dtype=np.int16)
+    name = f"planet_medres_normalized_analytic_{DATE}_mosaic_0-0.tif"
+    with rasterio.open(quad_dir / name, "w", driver="GTiff", width=size,
+                       height=size, count=4, dtype="int16",
+                       crs="EPSG:3857", transform=transform) as dst:
+        dst.write(data)
+        bounds = transform_bounds(dst.crs, "EPSG:4326", *dst.bounds)
+    return quad_dir, gpd.GeoDataFrame(
+        {"tile": ["0-0"], "date": [DATE], "file": [name]},
+        geometry=[box(*bounds)], crs="EPSG:4326"
+    )
+
+
+@pytest.fixture
+def tiles(quads):
+    """Two tiles inside the quad"""
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    minx, miny, maxx, maxy = quads[1].total_bounds
+    side = TILE_SIZE * TILE_RES
+    x, y = minx + side, maxy - 2 * side
+    return gpd.GeoDataFrame(
+        {"tile": ["1", "2"]},
+        geometry=[box(x, y, x + side, y + side),
+                  box(x + side, y, x + 2 * side, y + side)],
+        crs="EPSG:4326"
+    )
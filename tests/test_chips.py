@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+import rasterio
+from rasterio.warp import reproject, Resampling
+from shapely.geometry import box
+
+from conftest import DATE, TILE_RES, TILE_SIZE
+from maputil.chips import (extract_image_chips, quad_sources, tile_sources,
+                           _aligned_window)
+from maputil.planet_downloader import PlanetDownloader
+from maputil.rasterizer import write_label_by_grid
+
+# chips of 2 * DIAM, 40 pixels
+DIAM = 20 * TILE_RES
+
+
+@pytest.fixture
+def tile_dir(tmp_path, quads, tiles):
+    quad_dir, catalog = quads
+    (tmp_path / "temp").mkdir()
+    PlanetDownloader().retiler(
+        str(tmp_path / "tiles"), str(quad_dir), str(tmp_path / "temp"),
+        tiles, [DATE], TILE_SIZE, TILE_SIZE, 4, "EPSG:4326",
+        "<tile_dir>/tile<tile_id>_<date>.tif", verbose=False,
+        quads_gdf=catalog
+    )
+    return str(tmp_path / "tiles")
+
+
+def label_chip(tmp_path, x, y):
+    """Rasterize a field over the chip centred on x, y and open it"""
+    labels = tmp_path / "labels.geojson"
+    gpd.GeoDataFrame(geometry=[box(x - DIAM / 2, y - DIAM / 2, x, y)],
+                     crs="EPSG:4326").to_file(labels)
+    grids = pd.DataFrame({"x": [x], "y": [y], "name_col_row": ["chip"],
+                          "labels": [str(labels)]})
+    (tmp_path / "labels").mkdir()
+    path = write_label_by_grid(grids.iloc[0], "labels", TILE_RES, DIAM, 4326,
+                               str(tmp_path / "labels"), None, "binary")
+    return grids, rasterio.open(path)
+
+
+def chip_meta(label):
+    return {"crs": label.crs, "transform": label.transform,
+            "width": label.width, "height": label.height}
+
+
+def assert_on_label_grid(image, label):
+    assert image.crs == label.crs
+    assert image.transform.almost_equals(label.transform, precision=1e-12)
+    assert (image.width, image.height) == (label.width, label.height)
+
+
+def test_chip_from_tile_is_read_on_the_tile_grid(tmp_path, tiles, tile_dir):
+    sources = tile_sources(tiles, tile_dir,
+                           "<tile_dir>/tile<tile_id>_<date>.tif", DATE)
+    with rasterio.open(sources['path'][0]) as tile:
+        t = tile.transform
+        # chip corner 10 pixels into the tile, on its grid
+        x, y = t.c + (10 * TILE_RES + DIAM), t.f - (12 * TILE_RES + DIAM)
+        grids, label = label_chip(tmp_path, x, y)
+        with label:
+            # read in the batch of chips aligned with the tile
+            assert _aligned_window(tile, chip_meta(label)) is not None
+            expected = tile.read(window=((12, 12 + label.height),
+                                         (10, 10 + label.width)))
+            path, = extract_image_chips(grids, sources, TILE_RES, DIAM, 4326,
+                                        str(tmp_path / "images"), None)
+            with rasterio.open(path) as image:
+                assert_on_label_grid(image, label)
+                assert image.count == 4
+                np.testing.assert_array_equal(image.read(), expected)
+
+
+def test_chip_from_quad_is_warped_onto_the_label_grid(tmp_path, quads,
+                                                      tiles):
+    quad_dir, catalog = quads
+    sources = quad_sources(catalog, str(quad_dir), DATE)
+    x, y = tiles.geometry[0].centroid.coords[0]
+    grids, label = label_chip(tmp_path, x, y)
+    with label:
+        path, = extract_image_chips(grids, sources, TILE_RES, DIAM, 4326,
+                                    str(tmp_path / "images"), None)
+        with rasterio.open(path) as image, \
+                rasterio.open(sources['path'][0]) as quad:
+            assert _aligned_window(quad, chip_meta(label)) is None
+            assert_on_label_grid(image, label)
+            expected = np.zeros((4, label.height, label.width), "int16")
+            reproject(quad.read(), expected, src_transform=quad.transform,
+                      src_crs=quad.crs, dst_transform=label.transform,
+                      dst_crs=label.crs, resampling=Resampling.nearest)
+            np.testing.assert_array_equal(image.read(), expected)
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+import requests
+
+from maputil import planet_downloader
+from maputil.planet_downloader import PlanetDownloader
+from maputil.rate_limit import RateLimiter, send_request
+
+
+class Response(requests.Response):
+    def __init__(self, status, body=b""):
+        super().__init__()
+        self.status_code = status
+        self._content = body
+        self._content_consumed = True
+        self.url = "https://example.com"
+
+
+class Session():
+    def __init__(self, responses):
+        self.responses = responses
+
+    def request(self, method, url, **kwargs):
+        return self.responses(url)
+
+
+def test_handle_error_is_not_a_throttle():
+    limiter = RateLimiter(max_concurrency=8, min_concurrency=1)
+    limiter.concurrency = 4.0
+
+    def handle(res):
+        res.raise_for_status()
+
+    with pytest.raises(requests.HTTPError):
+        send_request(Session(lambda url: Response(404)), "GET", "u", limiter,
+                     handle=handle)
+    assert limiter.concurrency > 4.0
+    assert limiter.in_flight == 0
+
+
+def test_throttle_shrinks_the_limit():
+    limiter = RateLimiter(max_concurrency=8, min_concurrency=1)
+    limiter.concurrency = 4.0
+    res = send_request(Session(lambda url: Response(429)), "GET", "u",
+                       limiter, max_retries=0)
+    assert res.status_code == 429
+    assert limiter.concurrency == 2.0
+
+
+def test_listed_quads_download_to_files_of_their_own(tmp_path, monkeypatch):
+    ids = ["0-0", "0-1", "1-0", "1-1"]
+    listing = {"items": [{"id": i, "_links": {"download": f"https://q/{i}"}}
+                         for i in ids]}
+    monkeypatch.setattr(planet_downloader, "list_quads",
+                        lambda *args, **kwargs: (listing, "mosaic", None))
+    monkeypatch.setattr(requests, "Session", lambda: Session(
+        lambda url: Response(200, url.encode())
+    ))
+    PlanetDownloader().download_tiles(
+        None, str(tmp_path), "<quad_dir>/<qname>.tif",
+        list_quad_URL="https://list", dates=["2021-06"], download_threads=4
+    )
+    for i in ids:
+        with open(tmp_path / f"mosaic_{i}.tif", "rb") as f:
+            assert f.read() == f"https://q/{i}".encode()
+    assert len(os.listdir(tmp_path)) == len(ids)
@@ -0,0 +1,75 @@
+import threading
+
+import pandas as pd
+import pytest
+
+from conftest import DATE, TILE_SIZE
+from maputil import planet_downloader
+from maputil.planet_downloader import PlanetDownloader
+
+
+def retile(tmp_path, quads, tiles, **kwargs):
+    quad_dir, catalog = quads
+    tile_dir = tmp_path / "tiles"
+    tile_dir.mkdir(exist_ok=True)
+    (tmp_path / "temp").mkdir(exist_ok=True)
+    errors = PlanetDownloader().retiler(
+        str(tile_dir), str(quad_dir), str(tmp_path / "temp"), tiles, [DATE],
+        TILE_SIZE, TILE_SIZE, 4, "EPSG:4326",
+        "<tile_dir>/tile<tile_id>_<date>.tif", verbose=False,
+        quads_gdf=catalog, manifest_path=str(tmp_path / "manifest.csv"),
+        pipeline_depth=1, **kwargs
+    )
+    manifest = pd.read_csv(tmp_path / "manifest.csv")
+    return errors, dict(zip(manifest["tile"], manifest["status"]))
+
+
+def test_pipeline_writes_tiles(tmp_path, quads, tiles):
+    assert retile(tmp_path, quads, tiles) == \
+        ([], {1: "written", 2: "written"})
+
+
+def test_start_error_fails_only_its_tile(tmp_path, quads, tiles,
+                                         monkeypatch):
+    start_tile = planet_downloader._start_tile
+
+    def failing(tile_id, *args):
+        if tile_id == 1:
+            raise OSError("no space left")
+        return start_tile(tile_id, *args)
+
+    monkeypatch.setattr(planet_downloader, "_start_tile", failing)
+    errors, statuses = retile(tmp_path, quads, tiles)
+    assert statuses == {1: "error", 2: "written"}
+    assert [e["tile"] for e in errors] == [1]
+
+
+def test_stats_error_fails_only_its_tile(tmp_path, quads, tiles,
+                                         monkeypatch):
+    compute = planet_downloader.compute_tile_stats
+    calls = []
+
+    def failing(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise ValueError("bad histogram range")
+        return compute(*args, **kwargs)
+
+    monkeypatch.setattr(planet_downloader, "compute_tile_stats", failing)
+    errors, statuses = retile(tmp_path, quads, tiles,
+                              stats_path=str(tmp_path / "stats.csv"))
+    assert statuses == {1: "error", 2: "written"}
+    assert len(errors) == 1
+
+
+def test_warp_thread_error_stops_the_pipeline(tmp_path, quads, tiles,
+                                              monkeypatch):
+    def failing(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(planet_downloader, "warp_mosaic", failing)
+    before = threading.active_count()
+    with pytest.raises(KeyboardInterrupt):
+        retile(tmp_path, quads, tiles)
+    # reader and writer have stopped
+    assert threading.active_count() == before
@@ -0,0 +1,25 @@
+import subprocess
+
+import rasterio
+import rasterio.io
+import rasterio.warp
+
+from maputil.profiling import merge_profiles, profile_options, profile_stage
+
+
+def patched():
+    return (rasterio.open, rasterio.warp._reproject,
+            rasterio.io.DatasetReader.read, subprocess.Popen.communicate,
+            vars(rasterio.io.BufferedDatasetWriter).get("read"))
+
+
+def test_gdal_timers_only_while_profiling(tmp_path):
+    options = profile_options({"dir": str(tmp_path)})
+    before = patched()
+    with profile_stage(options, "outer"):
+        assert rasterio.open is not before[0]
+        assert hasattr(rasterio.io.DatasetReader.read, "__wrapped__")
+        subprocess.run(["true"], capture_output=True)
+    assert patched() == before
+    gdal = merge_profiles(str(tmp_path), options["run"])["gdal"]
+    assert [op for _, op in gdal] == ["subprocess"]
@@ -0,0 +1,129 @@
+import os
+import shutil
+
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+from conftest import DATE, TILE_RES, TILE_SIZE
+from maputil import planet_downloader
+from maputil.planet_downloader import PlanetDownloader
+from maputil.quad_cache import QuadCache
+
+
+def quad(name):
+    return (name, name, DATE)
+
+
+class Fetcher():
+    """Writes quads of nbytes and fails for the files in fail"""
+
+    def __init__(self, nbytes=100, fail=()):
+        self.nbytes = nbytes
+        self.fail = set(fail)
+        self.fetched = []
+
+    def __call__(self, quad, path):
+        self.fetched.append(quad[0])
+        if quad[0] in self.fail:
+            raise OSError(f"404 for {quad[0]}")
+        with open(path, "wb") as f:
+            f.write(b"0" * self.nbytes)
+
+
+def test_quads_are_fetched_once_and_pinned(tmp_path):
+    fetch = Fetcher()
+    cache = QuadCache(str(tmp_path), 1000, fetch)
+    cache.need([quad("a"), quad("b"), quad("a")])
+    paths = cache.acquire([quad("a"), quad("b")])
+    assert paths == [str(tmp_path / "a"), str(tmp_path / "b")]
+    cache.acquire([quad("a")])
+    assert fetch.fetched == ["a", "b"]
+    assert cache.pins["a"] == 2
+    cache.release([quad("a"), quad("b")])
+    cache.release([quad("a")])
+    assert +cache.pins == {} and +cache.refs == {}
+
+
+def test_quads_no_tile_needs_are_evicted_first(tmp_path):
+    cache = QuadCache(str(tmp_path), 250, Fetcher())
+    cache.need([quad("a"), quad("b"), quad("b"), quad("c")])
+    for name in "ab":
+        cache.acquire([quad(name)])
+        cache.release([quad(name)])
+    # a is done, b is still needed by a pending tile
+    cache.acquire([quad("c")])
+    assert sorted(os.listdir(tmp_path)) == ["b", "c"]
+
+
+def test_needed_quads_are_refetched_after_eviction(tmp_path):
+    fetch = Fetcher()
+    cache = QuadCache(str(tmp_path), 150, fetch)
+    cache.need([quad("a"), quad("b"), quad("a")])
+    for name in "aba":
+        cache.acquire([quad(name)])
+        cache.release([quad(name)])
+    assert fetch.fetched == ["a", "b", "a"]
+    assert os.listdir(tmp_path) == ["a"]
+
+
+def test_tile_larger_than_the_budget_is_let_through(tmp_path):
+    cache = QuadCache(str(tmp_path), 150, Fetcher())
+    cache.need([quad("a"), quad("b")])
+    cache.acquire([quad("a"), quad("b")])
+    assert sorted(os.listdir(tmp_path)) == ["a", "b"]
+
+
+def test_failed_fetch_gives_an_error_result(tmp_path):
+    cache = QuadCache(str(tmp_path), 1000, Fetcher(fail=["b"]))
+    items = [["a"], ["b"], ["a", "b"], ["c"]]
+
+    def quads_of(item):
+        return [quad(name) for name in item]
+
+    cache.need(q for item in items for q in quads_of(item))
+    acquired = cache.acquire_each(items, quads_of,
+                                  lambda item, e: ("failed", item))
+    results = list(cache.release_each(("done", item) for item in acquired))
+    assert results == [("done", ["a"]), ("failed", ["b"]),
+                       ("failed", ["a", "b"]), ("done", ["c"])]
+    assert not cache.pending
+    assert +cache.pins == {} and +cache.refs == {}
+
+
+@pytest.mark.parametrize("options", [
+    {}, {"pipeline_depth": 1}, {"by_tile": True},
+    # the quads are acquired in the task feeder of the Pool
+    {"num_cores": 2}, {"num_cores": 2, "pipeline_depth": 1},
+])
+def test_retile_goes_on_when_a_quad_fails(tmp_path, quads, tiles,
+                                          monkeypatch, options):
+    quad_dir, catalog = quads
+    # two quads of the same raster, tile 2 also needs the right one
+    minx, miny, maxx, maxy = catalog.total_bounds
+    split = tiles.total_bounds[0] + 1.5 * TILE_SIZE * TILE_RES
+    name = catalog['file'][0]
+    catalog = catalog.iloc[[0, 0]].reset_index(drop=True)
+    catalog['tile'] = ["left", "right"]
+    catalog['file'] = ["left.tif", "right.tif"]
+    catalog['geometry'] = [box(minx, miny, split, maxy),
+                           box(split, miny, maxx, maxy)]
+
+    def download(url, path, *args, **kwargs):
+        if url.endswith("right"):
+            raise OSError("404")
+        shutil.copy(quad_dir / name, path)
+
+    monkeypatch.setattr(planet_downloader, "download_tiles_helper", download)
+    (tmp_path / "temp").mkdir()
+    errors = PlanetDownloader().retiler(
+        str(tmp_path / "tiles"), str(tmp_path / "cache"),
+        str(tmp_path / "temp"), tiles, [DATE], TILE_SIZE, TILE_SIZE, 4,
+        "EPSG:4326", "<tile_dir>/tile<tile_id>_<date>.tif", verbose=False,
+        quads_gdf=catalog, manifest_path=str(tmp_path / "manifest.csv"),
+        quad_url_pt="https://quads/<id>", quad_cache_gb=1, **options
+    )
+    manifest = pd.read_csv(tmp_path / "manifest.csv")
+    assert dict(zip(manifest["tile"], manifest["status"])) == \
+        {1: "written", 2: "error"}
+    assert [(e["tile"], e["date"]) for e in errors] == [(2, DATE)]
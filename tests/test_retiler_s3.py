@@ -0,0 +1,83 @@
+import os
+
+import pandas as pd
+import pytest
+
+from conftest import DATE, TILE_SIZE
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+BUCKET = "maputil-test"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def retile(tmp_path, quads, tiles, manifest):
+    from maputil.planet_downloader import PlanetDownloader
+
+    quad_dir, catalog = quads
+    temp_dir = tmp_path / "temp"
+    temp_dir.mkdir(exist_ok=True)
+    return PlanetDownloader().retiler(
+        f"s3://{BUCKET}/tiles", str(quad_dir), str(temp_dir), tiles, [DATE],
+        TILE_SIZE, TILE_SIZE, 4, "EPSG:4326",
+        "<tile_dir>/tile<tile_id>_<date>.tif", verbose=False,
+        quads_gdf=catalog, manifest_path=str(tmp_path / manifest)
+    )
+
+
+def keys(s3):
+    return sorted(o["Key"] for o in
+                  s3.list_objects_v2(Bucket=BUCKET).get("Contents", []))
+
+
+def statuses(path):
+    manifest = pd.read_csv(path)
+    return dict(zip(manifest["tile"], manifest["status"]))
+
+
+def test_tiles_are_uploaded(tmp_path, quads, tiles, s3):
+    assert retile(tmp_path, quads, tiles, "m.csv") == []
+    assert keys(s3) == [f"tiles/tile1_{DATE}_cog.tif",
+                        f"tiles/tile2_{DATE}_cog.tif"]
+    assert statuses(tmp_path / "m.csv") == {1: "written", 2: "written"}
+    # nothing is left in temp_dir once uploaded
+    assert os.listdir(tmp_path / "temp") == []
+
+
+def test_uploaded_tiles_are_skipped(tmp_path, quads, tiles, s3):
+    retile(tmp_path, quads, tiles, "first.csv")
+    before = {k: s3.head_object(Bucket=BUCKET, Key=k)["ETag"]
+              for k in keys(s3)}
+    assert retile(tmp_path, quads, tiles, "second.csv") == []
+    assert statuses(tmp_path / "second.csv") == {1: "exists", 2: "exists"}
+    assert {k: s3.head_object(Bucket=BUCKET, Key=k)["ETag"]
+            for k in keys(s3)} == before
+
+
+def test_leftover_local_cog_is_uploaded(tmp_path, quads, tiles, s3):
+    retile(tmp_path, quads, tiles, "first.csv")
+    key = f"tiles/tile1_{DATE}_cog.tif"
+    # an earlier run built the COG but died before uploading it
+    leftover = tmp_path / "temp" / os.path.basename(key)
+    s3.download_file(BUCKET, key, str(leftover))
+    with open(leftover, "ab") as f:
+        f.write(b"leftover")
+    s3.delete_object(Bucket=BUCKET, Key=key)
+
+    assert retile(tmp_path, quads, tiles, "second.csv") == []
+    assert statuses(tmp_path / "second.csv") == {1: "written", 2: "exists"}
+    body = s3.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+    # uploaded as left, not retiled again
+    assert body.endswith(b"leftover")
+    assert not leftover.exists()
@@ -0,0 +1,102 @@
+import time
+
+import pytest
+
+from maputil.work_queue import WorkQueue, run_worker
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return WorkQueue(str(tmp_path / "queue.sqlite"), lease_seconds=60,
+                     max_attempts=2)
+
+
+def test_add_ignores_existing_ids(queue):
+    assert queue.add([("a", {"n": 1}), ("b", {"n": 2})]) == 2
+    assert queue.add([("a", {"n": 3}), ("c", {"n": 4})]) == 1
+    assert queue.counts() == {"pending": 3}
+
+
+def test_claim_leases_each_job_once(queue):
+    queue.add([("a", {"n": 1}), ("b", {"n": 2})])
+    assert queue.claim("w1") == ("a", {"n": 1})
+    assert queue.claim("w2") == ("b", {"n": 2})
+    assert queue.claim("w3") is None
+    assert queue.counts() == {"leased": 2}
+
+
+def test_expired_lease_is_reclaimed(queue):
+    queue.lease_seconds = 0.05
+    queue.add([("a", {})])
+    assert queue.claim("w1")[0] == "a"
+    assert queue.claim("w2") is None
+    time.sleep(0.1)
+    assert queue.claim("w2")[0] == "a"
+    # the first worker lost the job
+    assert not queue.heartbeat("a", "w1")
+    assert queue.complete("a", "w1", "late") == 0
+    assert queue.fail("a", "w1", "late") == 0
+    assert queue.complete("a", "w2", "ok") == 1
+    assert queue.results() == [("a", {}, "ok")]
+
+
+def test_heartbeat_keeps_lease(queue):
+    queue.lease_seconds = 0.2
+    queue.add([("a", {})])
+    queue.claim("w1")
+    for _ in range(3):
+        time.sleep(0.1)
+        assert queue.heartbeat("a", "w1")
+    assert queue.claim("w2") is None
+
+
+def test_failed_job_is_retried_until_max_attempts(queue):
+    queue.add([("a", {})])
+    queue.claim("w1")
+    assert queue.fail("a", "w1", "boom") == 1
+    assert queue.counts() == {"pending": 1}
+    queue.claim("w1")
+    queue.fail("a", "w1", "boom again")
+    assert queue.counts() == {"failed": 1}
+    assert queue.claim("w1") is None
+    assert queue.results("failed") == [("a", {}, "boom again")]
+
+
+def test_expired_job_out_of_attempts_is_failed(queue):
+    queue.lease_seconds = 0.05
+    queue.add([("a", {})])
+    queue.claim("w1")
+    time.sleep(0.1)
+    queue.claim("w2")
+    time.sleep(0.1)
+    assert queue.claim("w3") is None
+    assert queue.counts() == {"failed": 1}
+
+
+def test_run_worker_completes_and_fails_jobs(queue):
+    queue.add([(str(n), {"n": n}) for n in range(4)])
+
+    def handler(payload):
+        if payload["n"] == 3:
+            raise ValueError("bad job")
+        return payload["n"] * 10
+
+    results = run_worker(queue, handler, worker_id="w1",
+                         is_error=lambda r: r == 20)
+    assert sorted(r for _, r in results) == [0, 10]
+    assert queue.counts() == {"done": 2, "failed": 2}
+
+
+def test_run_worker_drops_results_of_lost_leases(queue):
+    queue.lease_seconds = 0.05
+    queue.add([("a", {})])
+    # w1 stalls, so its lease runs out and w2 takes the job
+    queue.heartbeat = lambda job_id, worker_id: True
+
+    def handler(payload):
+        time.sleep(0.1)
+        assert queue.claim("w2")[0] == "a"
+        return "late"
+
+    assert run_worker(queue, handler, worker_id="w1", wait=False) == []
+    assert queue.counts() == {"leased": 1}